@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+#
+# LSST Data Management System
+# Copyright 2008-2018 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+"""Compare repeated addToCoadd calls with a single addManyToCoadd call
+
+Reports the wall time of each approach and a model of the memory traffic
+for the accumulator (coadd image, coadd mask and weight map):
+- repeated addToCoadd reads and writes the overlap region of the accumulator
+  once per input
+- addManyToCoadd reads and writes each accumulator tile once, provided a tile
+  fits in cache (see --tileSize); all inputs are added while it is resident
+
+Input traffic (image, mask and variance of each input) is the same for both.
+For measured numbers, run this script under e.g. `perf stat -e LLC-load-misses`.
+"""
+import argparse
+import time
+
+import numpy as np
+
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.afw.image.testUtils as afwTestUtils
+import lsst.coadd.chisquared as coaddChiSq
+
+
+def makeInputs(coaddBBox, numInputs, inputSize):
+    """Make numInputs Gaussian noise masked images scattered over coaddBBox
+    """
+    maskedImageList = []
+    for i in range(numInputs):
+        maskedImage = afwTestUtils.makeGaussianNoiseMaskedImage(
+            dimensions=(inputSize, inputSize), sigma=1.0, variance=1.0)
+        x0 = np.random.randint(coaddBBox.getMinX() - inputSize // 2, coaddBBox.getMaxX() - inputSize // 2)
+        y0 = np.random.randint(coaddBBox.getMinY() - inputSize // 2, coaddBBox.getMaxY() - inputSize // 2)
+        maskedImage.setXY0(afwGeom.Point2I(x0, y0))
+        maskedImageList.append(maskedImage)
+    return maskedImageList
+
+
+def accumulatorBytesPerPixel(coadd, weightMap):
+    """Return bytes per pixel of coadd image + coadd mask + weight map
+    """
+    return (coadd.getImage().getArray().itemsize + coadd.getMask().getArray().itemsize +
+            weightMap.getArray().itemsize)
+
+
+def runBenchmark(coaddSize, numInputs, inputSize, tileSize, numThreads, numRepeats):
+    coaddBBox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(coaddSize, coaddSize))
+    badPixelMask = afwImage.Mask.getPlaneBitMask("EDGE")
+    maskedImageList = makeInputs(coaddBBox, numInputs, inputSize)
+    weightList = [1.0] * numInputs
+
+    singleTimes = []
+    manyTimes = []
+    for i in range(numRepeats):
+        coadd = afwImage.MaskedImageF(coaddBBox)
+        weightMap = afwImage.ImageF(coaddBBox)
+        startTime = time.time()
+        overlapBBoxList = [coaddChiSq.addToCoadd(coadd, weightMap, maskedImage, badPixelMask, weight,
+                                                 numThreads=numThreads)
+                           for maskedImage, weight in zip(maskedImageList, weightList)]
+        singleTimes.append(time.time() - startTime)
+
+        manyCoadd = afwImage.MaskedImageF(coaddBBox)
+        manyWeightMap = afwImage.ImageF(coaddBBox)
+        startTime = time.time()
+        coaddChiSq.addManyToCoadd(manyCoadd, manyWeightMap, maskedImageList, badPixelMask, weightList,
+                                  tileSize=tileSize, numThreads=numThreads)
+        manyTimes.append(time.time() - startTime)
+
+        if not (np.array_equal(coadd.getImage().getArray(), manyCoadd.getImage().getArray()) and
+                np.array_equal(weightMap.getArray(), manyWeightMap.getArray())):
+            raise RuntimeError("addManyToCoadd result differs from repeated addToCoadd")
+
+    bytesPerPixel = accumulatorBytesPerPixel(coadd, weightMap)
+    sumOverlapArea = sum(bbox.getArea() for bbox in overlapBBoxList if not bbox.isEmpty())
+    covered = np.zeros((coaddSize, coaddSize), dtype=bool)
+    for bbox in overlapBBoxList:
+        if not bbox.isEmpty():
+            covered[bbox.getMinY():bbox.getMaxY() + 1, bbox.getMinX():bbox.getMaxX() + 1] = True
+    coveredArea = np.count_nonzero(covered)
+    # read + write of each accumulator pixel
+    singleTraffic = 2 * bytesPerPixel * sumOverlapArea
+    manyTraffic = 2 * bytesPerPixel * coveredArea
+    tileBytes = bytesPerPixel * tileSize**2
+
+    print("coadd %dx%d, %d inputs of %dx%d, tileSize=%d (%.0f KiB/tile), numThreads=%d" %
+          (coaddSize, coaddSize, numInputs, inputSize, inputSize, tileSize, tileBytes / 1024.0, numThreads))
+    print("%-24s %12s %18s" % ("method", "best time (s)", "accumulator MiB"))
+    print("%-24s %12.4f %18.1f" % ("repeated addToCoadd", min(singleTimes), singleTraffic / 2.0**20))
+    print("%-24s %12.4f %18.1f" % ("addManyToCoadd", min(manyTimes), manyTraffic / 2.0**20))
+    if manyTraffic > 0:
+        print("accumulator traffic reduced by a factor of %.1f; speedup %.2f" %
+              (singleTraffic / float(manyTraffic), min(singleTimes) / min(manyTimes)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--coaddSize", type=int, default=4000, help="width and height of coadd (pixels)")
+    parser.add_argument("--numInputs", type=int, default=50, help="number of input masked images")
+    parser.add_argument("--inputSize", type=int, default=3000, help="width and height of each input")
+    parser.add_argument("--tileSize", type=int, default=128, help="addManyToCoadd tile size")
+    parser.add_argument("--numThreads", type=int, default=1, help="number of threads for both methods")
+    parser.add_argument("--numRepeats", type=int, default=3, help="number of times to run each method")
+    args = parser.parse_args()
+
+    np.random.seed(0)
+    runBenchmark(coaddSize=args.coaddSize, numInputs=args.numInputs, inputSize=args.inputSize,
+                 tileSize=args.tileSize, numThreads=args.numThreads, numRepeats=args.numRepeats)
@@ -0,0 +1,338 @@
+#!/usr/bin/env python
+
+#
+# LSST Data Management System
+# Copyright 2008-2018 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+"""Benchmark suite for addToCoadd and Coadd.addExposure
+
+Times:
+- addToCoadd for each instantiated (coadd pixel, weight pixel) type pair,
+  with input pixels of the coadd pixel type, over a range of image sizes
+  and fractions of bad pixels; the input covers the coadd exactly
+- addToCoadd for inputs that overlap the coadd fully, by half, by a
+  quarter, by a sliver of columns, and not at all
+- addToCoadd dividing by the variance plane, compared to passing a
+  VarianceModel of a constant variance or of one variance per amplifier,
+  which is not read from the variance plane
+- the overhead of Coadd.addExposure per call, compared to addToCoadd
+- Coadd.addExposures reading exposures from FITS files on worker threads,
+  compared to reading and adding them in a serial loop; since afw does not
+  release the GIL while reading, at best the time spent in addToCoadd is
+  hidden
+
+Each result is the best wall time of --numRepeats runs. Results can be
+written to a JSON file with --output, and compared with such a file from an
+earlier run (e.g. the previous release) with --baseline; the script exits
+with status 1 if any benchmark is more than --tolerance slower than its
+baseline.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.coadd.chisquared as coaddChiSq
+
+# instantiated pixel types: (name, MaskedImage class) of the coadd and input
+CoaddTypes = (("double", afwImage.MaskedImageD), ("float", afwImage.MaskedImageF))
+# instantiated weight map types: (name, Image class)
+WeightTypes = (("double", afwImage.ImageD), ("float", afwImage.ImageF), ("int", afwImage.ImageI),
+               ("uint16", afwImage.ImageU))
+# input offsets, as fractions of the input size, and the part of the coadd each overlaps
+OverlapGeometries = (("full", 0.0, 0.0), ("half", 0.5, 0.0), ("quarter", 0.5, 0.5),
+                     ("sliver", 0.99, 0.0), ("none", 1.0, 1.0))
+
+
+def timeIt(func, numRepeats):
+    """Return the best wall time of numRepeats calls to func
+    """
+    times = []
+    for i in range(numRepeats):
+        startTime = time.time()
+        func()
+        times.append(time.time() - startTime)
+    return min(times)
+
+
+def makeMaskedImage(MaskedImageClass, size, badFraction, xy0=(0, 0)):
+    """Make a Gaussian noise masked image with some pixels flagged as EDGE
+    """
+    maskedImage = MaskedImageClass(afwGeom.Box2I(afwGeom.Point2I(*xy0), afwGeom.Extent2I(size, size)))
+    maskedImage.getImage().getArray()[:] = np.random.normal(size=(size, size))
+    maskedImage.getVariance().getArray()[:] = 1.0
+    badPixelMask = afwImage.Mask.getPlaneBitMask("EDGE")
+    maskArr = maskedImage.getMask().getArray()
+    maskArr[:] = np.where(np.random.random_sample(maskArr.shape) < badFraction, badPixelMask, 0)
+    return maskedImage
+
+
+def benchmarkTypes(sizeList, badFractionList, numThreads, numRepeats):
+    """Time addToCoadd for each type pair, image size and bad pixel fraction
+
+    Returns a dict of benchmark name: result dict.
+    """
+    badPixelMask = afwImage.Mask.getPlaneBitMask("EDGE")
+    results = {}
+    for size in sizeList:
+        bbox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(size, size))
+        for coaddName, MaskedImageClass in CoaddTypes:
+            coadd = MaskedImageClass(bbox)
+            for badFraction in badFractionList:
+                maskedImage = makeMaskedImage(MaskedImageClass, size, badFraction)
+                for weightName, ImageClass in WeightTypes:
+                    weightMap = ImageClass(bbox)
+                    # an integer weight map needs an integer weight
+                    seconds = timeIt(lambda: coaddChiSq.addToCoadd(coadd, weightMap, maskedImage,
+                                                                   badPixelMask, 1, numThreads=numThreads),
+                                     numRepeats)
+                    name = "addToCoadd/coadd=%s/weight=%s/size=%d/bad=%g" % \
+                        (coaddName, weightName, size, badFraction)
+                    results[name] = dict(seconds=seconds, pixels=size**2)
+                    del weightMap
+                del maskedImage
+            del coadd
+    return results
+
+
+def benchmarkOverlaps(size, numThreads, numRepeats):
+    """Time addToCoadd for inputs that partly overlap a float coadd
+
+    Returns a dict of benchmark name: result dict; pixels is the overlap area.
+    """
+    bbox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(size, size))
+    badPixelMask = afwImage.Mask.getPlaneBitMask("EDGE")
+    coadd = afwImage.MaskedImageF(bbox)
+    weightMap = afwImage.ImageF(bbox)
+    results = {}
+    for geometryName, xFraction, yFraction in OverlapGeometries:
+        xy0 = (int(round(xFraction * size)), int(round(yFraction * size)))
+        maskedImage = makeMaskedImage(afwImage.MaskedImageF, size, 0.1, xy0=xy0)
+        overlapBBox = coaddChiSq.addToCoadd(coadd, weightMap, maskedImage, badPixelMask, 1.0)
+        seconds = timeIt(lambda: coaddChiSq.addToCoadd(coadd, weightMap, maskedImage, badPixelMask, 1.0,
+                                                       numThreads=numThreads),
+                         numRepeats)
+        name = "overlap/%s/size=%d" % (geometryName, size)
+        results[name] = dict(seconds=seconds, pixels=0 if overlapBBox.isEmpty() else overlapBBox.getArea())
+    return results
+
+
+def benchmarkVarianceModel(size, numThreads, numRepeats):
+    """Time addToCoadd for a float coadd with and without a model of the
+    input variance
+
+    Returns a dict of benchmark name: result dict.
+    """
+    bbox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(size, size))
+    badPixelMask = afwImage.Mask.getPlaneBitMask("EDGE")
+    coadd = afwImage.MaskedImageF(bbox)
+    weightMap = afwImage.ImageF(bbox)
+    maskedImage = makeMaskedImage(afwImage.MaskedImageF, size, 0.1)
+    # 16 x 2 amplifiers
+    cellVariance = np.random.uniform(0.5, 1.5, size=(2, 16)).astype(np.float32)
+    maskedImage.getVariance().getArray()[:] = np.repeat(np.repeat(cellVariance, size // 2, axis=0),
+                                                        size // 16, axis=1)
+    varianceModels = (
+        ("none", None),
+        ("constant", coaddChiSq.VarianceModel(1.0)),
+        ("amplifiers", coaddChiSq.VarianceModel(afwImage.makeImageFromArray(cellVariance),
+                                                size // 16, size // 2)),
+    )
+    results = {}
+    for modelName, varianceModel in varianceModels:
+        seconds = timeIt(lambda: coaddChiSq.addToCoadd(coadd, weightMap, maskedImage, badPixelMask, 1.0,
+                                                       numThreads=numThreads, varianceModel=varianceModel),
+                         numRepeats)
+        results["varianceModel/%s/size=%d" % (modelName, size)] = dict(seconds=seconds, pixels=size**2)
+    return results
+
+
+def benchmarkAddExposure(size, numCalls, numRepeats):
+    """Time Coadd.addExposure and addToCoadd for many small exposures
+
+    Returns a dict of benchmark name: result dict; seconds is per call and
+    the overhead result is the difference.
+    """
+    bbox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(size, size))
+    badPixelMask = afwImage.Mask.getPlaneBitMask("EDGE")
+    exposure = afwImage.ExposureF(makeMaskedImage(afwImage.MaskedImageF, size, 0.1))
+    maskedImage = exposure.getMaskedImage()
+    coadd = coaddChiSq.Coadd(bbox=bbox, wcs=exposure.getWcs(), badMaskPlanes=["EDGE"])
+    accumulator = afwImage.MaskedImageF(bbox)
+    weightMap = afwImage.ImageF(bbox)
+
+    def addExposures():
+        for i in range(numCalls):
+            coadd.addExposure(exposure)
+
+    def addMaskedImages():
+        for i in range(numCalls):
+            coaddChiSq.addToCoadd(accumulator, weightMap, maskedImage, badPixelMask, 1.0)
+
+    addExposureSeconds = timeIt(addExposures, numRepeats) / numCalls
+    addToCoaddSeconds = timeIt(addMaskedImages, numRepeats) / numCalls
+    return {
+        "addExposure/size=%d" % (size,): dict(seconds=addExposureSeconds, pixels=size**2),
+        "addExposure/addToCoadd/size=%d" % (size,): dict(seconds=addToCoaddSeconds, pixels=size**2),
+        "addExposure/overhead/size=%d" % (size,): dict(seconds=addExposureSeconds - addToCoaddSeconds,
+                                                       pixels=0),
+    }
+
+
+def benchmarkAddExposures(size, numExposures, maxWorkersList, numRepeats):
+    """Time Coadd.addExposures, reading each exposure from a FITS file, and
+    the equivalent serial loop of reads and Coadd.addExposure calls
+
+    Returns a dict of benchmark name: result dict; seconds is for all
+    exposures.
+    """
+    bbox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(size, size))
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        pathList = []
+        for i in range(numExposures):
+            path = os.path.join(directory, "exposure%d.fits" % (i,))
+            afwImage.ExposureF(makeMaskedImage(afwImage.MaskedImageF, size, 0.1)).writeFits(path)
+            pathList.append(path)
+
+        def makeCoadd():
+            return coaddChiSq.Coadd(bbox=bbox, wcs=None, badMaskPlanes=["EDGE"])
+
+        def addSerially():
+            coadd = makeCoadd()
+            for path in pathList:
+                coadd.addExposure(afwImage.ExposureF(path))
+
+        seconds = timeIt(addSerially, numRepeats)
+        results["addExposures/serial/size=%d" % (size,)] = dict(seconds=seconds,
+                                                                pixels=numExposures * size**2)
+        for maxWorkers in maxWorkersList:
+            seconds = timeIt(lambda: makeCoadd().addExposures(pathList, prepare=afwImage.ExposureF,
+                                                              maxWorkers=maxWorkers),
+                             numRepeats)
+            results["addExposures/maxWorkers=%d/size=%d" % (maxWorkers, size)] = \
+                dict(seconds=seconds, pixels=numExposures * size**2)
+    return results
+
+
+def compareWithBaseline(results, baseline, tolerance):
+    """Print each result beside its baseline and return the names of those
+    that are slower than the baseline by more than tolerance (a fraction)
+    """
+    regressions = []
+    print("%-56s %12s %12s %8s" % ("benchmark", "baseline (s)", "time (s)", "ratio"))
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        baselineSeconds = baseline[name]["seconds"]
+        ratio = result["seconds"] / baselineSeconds if baselineSeconds > 0 else float("nan")
+        flag = ""
+        if ratio > 1.0 + tolerance:
+            regressions.append(name)
+            flag = " SLOWER"
+        print("%-56s %12.6f %12.6f %8.2f%s" % (name, baselineSeconds, result["seconds"], ratio, flag))
+    return regressions
+
+
+def printResults(results):
+    """Print a table of results
+    """
+    print("%-56s %12s %10s" % ("benchmark", "time (s)", "Mpix/s"))
+    for name, result in sorted(results.items()):
+        mpixPerSec = result["pixels"] / result["seconds"] / 1e6 if result["seconds"] > 0 else 0.0
+        print("%-56s %12.6f %10.1f" % (name, result["seconds"], mpixPerSec))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, nargs="+", default=[256, 1024, 4096, 8192],
+                        help="widths and heights of the images for the type benchmarks (pixels)")
+    parser.add_argument("--badFraction", type=float, nargs="+", default=[0.0, 0.1, 0.5],
+                        help="fractions of bad input pixels for the type benchmarks")
+    parser.add_argument("--overlapSize", type=int, default=2048,
+                        help="width and height of the coadd and input for the overlap benchmarks")
+    parser.add_argument("--varianceModelSize", type=int, default=4096,
+                        help="width and height of the coadd and input for the variance model benchmarks; "
+                             "a multiple of 16")
+    parser.add_argument("--addExposureSize", type=int, default=64,
+                        help="width and height of the exposures for the addExposure benchmark")
+    parser.add_argument("--numCalls", type=int, default=1000,
+                        help="number of calls per run of the addExposure benchmark")
+    parser.add_argument("--addExposuresSize", type=int, default=2048,
+                        help="width and height of the exposures for the addExposures benchmark")
+    parser.add_argument("--numExposures", type=int, default=8,
+                        help="number of exposures read and added by the addExposures benchmark")
+    parser.add_argument("--maxWorkers", type=int, nargs="+", default=[1, 4],
+                        help="numbers of threads for the addExposures benchmark")
+    parser.add_argument("--numThreads", type=int, default=1, help="number of threads for addToCoadd")
+    parser.add_argument("--numRepeats", type=int, default=5, help="number of times to run each benchmark")
+    parser.add_argument("--output", help="path of JSON file to which to write the results")
+    parser.add_argument("--baseline", help="path of JSON results file from an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="fraction by which a benchmark may be slower than its baseline")
+    args = parser.parse_args()
+
+    np.random.seed(0)
+    results = {}
+    results.update(benchmarkTypes(sizeList=args.size, badFractionList=args.badFraction,
+                                  numThreads=args.numThreads, numRepeats=args.numRepeats))
+    results.update(benchmarkOverlaps(size=args.overlapSize, numThreads=args.numThreads,
+                                     numRepeats=args.numRepeats))
+    results.update(benchmarkVarianceModel(size=args.varianceModelSize, numThreads=args.numThreads,
+                                          numRepeats=args.numRepeats))
+    results.update(benchmarkAddExposure(size=args.addExposureSize, numCalls=args.numCalls,
+                                        numRepeats=args.numRepeats))
+    results.update(benchmarkAddExposures(size=args.addExposuresSize, numExposures=args.numExposures,
+                                         maxWorkersList=args.maxWorkers, numRepeats=args.numRepeats))
+    printResults(results)
+
+    if args.output:
+        with open(args.output, "w") as outfile:
+            json.dump(dict(
+                metadata=dict(
+                    time=time.strftime("%Y-%m-%dT%H:%M:%S"),
+                    machine=platform.machine(),
+                    processor=platform.processor(),
+                    python=platform.python_version(),
+                    numThreads=args.numThreads,
+                    numRepeats=args.numRepeats,
+                ),
+                results=results,
+            ), outfile, indent=2, sort_keys=True)
+        print("Wrote results to %s" % (args.output,))
+
+    if args.baseline:
+        with open(args.baseline, "r") as infile:
+            baseline = json.load(infile)["results"]
+        print()
+        regressions = compareWithBaseline(results, baseline, tolerance=args.tolerance)
+        if regressions:
+            print("%d benchmarks are more than %.0f%% slower than the baseline" %
+                  (len(regressions), args.tolerance * 100))
+            sys.exit(1)
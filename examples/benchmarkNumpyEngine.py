@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+#
+# LSST Data Management System
+# Copyright 2008-2018 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+"""Compare the speed of the NumPy accumulation engine with the C++ addToCoadd
+"""
+import argparse
+import time
+
+import numpy as np
+
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.afw.image.testUtils as afwTestUtils
+import lsst.coadd.chisquared as coaddChiSq
+import lsst.coadd.chisquared.numpy_engine as numpyEngine
+
+
+def timeIt(func, numRepeats):
+    """Return the best wall time of numRepeats calls to func
+    """
+    times = []
+    for i in range(numRepeats):
+        startTime = time.time()
+        func()
+        times.append(time.time() - startTime)
+    return min(times)
+
+
+def runBenchmark(size, chunkSizeList, numRepeats):
+    bbox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(size, size))
+    badPixelMask = afwImage.Mask.getPlaneBitMask("EDGE")
+    maskedImage = afwTestUtils.makeGaussianNoiseMaskedImage(dimensions=(size, size), sigma=1.0, variance=1.0)
+    maskArr = maskedImage.getMask().getArray()
+    maskArr[:] = np.where(np.random.random_sample(maskArr.shape) < 0.1, badPixelMask, 0)
+
+    coadd = afwImage.MaskedImageF(bbox)
+    weightMap = afwImage.ImageF(bbox)
+    cppTime = timeIt(lambda: coaddChiSq.addToCoadd(coadd, weightMap, maskedImage, badPixelMask, 1.0),
+                     numRepeats)
+
+    arrays = dict(
+        coadd=coadd.getImage().getArray(),
+        coaddMask=coadd.getMask().getArray(),
+        weightMap=weightMap.getArray(),
+        image=maskedImage.getImage().getArray(),
+        mask=maskedImage.getMask().getArray(),
+        variance=maskedImage.getVariance().getArray(),
+    )
+    print("image %dx%d; best of %d" % (size, size, numRepeats))
+    print("%-32s %10s %10s" % ("method", "time (s)", "Mpix/s"))
+    print("%-32s %10.4f %10.1f" % ("C++ addToCoadd", cppTime, size**2 / cppTime / 1e6))
+    for chunkSize in chunkSizeList:
+        numpyTime = timeIt(lambda: numpyEngine.addToCoadd(badPixelMask=badPixelMask, weight=1.0,
+                                                          chunkSize=chunkSize, **arrays),
+                           numRepeats)
+        print("%-32s %10.4f %10.1f" % ("numpy_engine chunkSize=%d" % (chunkSize,), numpyTime,
+                                       size**2 / numpyTime / 1e6))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--size", type=int, default=4000, help="width and height of image (pixels)")
+    parser.add_argument("--chunkSize", type=int, nargs="+", default=[1 << 14, 1 << 16, 1 << 20],
+                        help="numpy_engine chunk sizes to try (pixels)")
+    parser.add_argument("--numRepeats", type=int, default=5, help="number of times to run each method")
+    args = parser.parse_args()
+
+    np.random.seed(0)
+    runBenchmark(size=args.size, chunkSizeList=args.chunkSize, numRepeats=args.numRepeats)
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Demonstrate how to coadd several patches of sky in one pass over the
+input exposures.
+
+The region covered by the first exposure is divided into a grid of patches,
+and `lsst.coadd.chisquared.multiPatchCoadd.multiPatchCoadd` reads each
+exposure once and warps it into every patch that it overlaps.
+"""
+import argparse
+import sys
+
+import lsst.afw.image as afwImage
+from lsst.coadd.chisquared.multiPatchCoadd import MultiPatchCoaddConfig, makePatchGrid, multiPatchCoadd
+from lsst.coadd.chisquared.warpAndCoadd import readExposurePathList
+from lsst.log import Log
+
+
+def main(outputDir, exposureListPath, numX, numY, config):
+    """Coadd a grid of patches covering the first exposure
+    """
+    exposurePathList = readExposurePathList(exposureListPath)
+    if not exposurePathList:
+        print("No exposures", file=sys.stderr)
+        sys.exit(1)
+    reference = afwImage.ExposureF(exposurePathList[0])
+    patches = makePatchGrid(reference.getWcs(), reference.getBBox(), numX, numY)
+    del reference
+
+    result = multiPatchCoadd(patches, exposurePathList, config, outputDir)
+
+    print("Read %d exposures once each and added them to %d patches %d times; failed %d and skipped %d "
+          "that overlap no patch" %
+          (result.numExposuresRead, len(patches), result.numPatchExposures, result.numExposuresFailed,
+           result.numExposuresSkipped), file=sys.stderr)
+    print("Accumulators were spilled %d times and read back %d times; elapsed time %.1f seconds" %
+          (result.numSpills, result.numReloads, result.elapsedTime), file=sys.stderr)
+    for name, coaddPath in result.coaddPaths.items():
+        print("Patch %s: %s" % (name, coaddPath), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    Log.getLogger('coadd').setLevel(Log.INFO)
+    parser = argparse.ArgumentParser(description="Coadd a grid of patches, reading each exposure once")
+    parser.add_argument("outputDir", help="directory in which to write the coadd of each patch")
+    parser.add_argument("exposureListPath",
+                        help="file containing a list of paths to exposures, one per line; the patches "
+                             "cover the first exposure; empty lines and lines that start with # "
+                             "are ignored")
+    parser.add_argument("--grid", type=int, nargs=2, default=(2, 2), metavar=("NX", "NY"),
+                        help="number of patches in x and y")
+    parser.add_argument("--max-open", type=int, default=4, dest="maxOpen",
+                        help="maximum number of patch accumulators held in memory")
+    args = parser.parse_args()
+
+    config = MultiPatchCoaddConfig()
+    config.maxOpenAccumulators = args.maxOpen
+    main(args.outputDir, args.exposureListPath, args.grid[0], args.grid[1], config)
@@ -22,43 +22,21 @@
 # see <http://www.lsstcorp.org/LegalNotices/>.
 #
 """Demonstrate how to create a coadd by warping and adding.
+
+The work is done by `lsst.coadd.chisquared.warpAndCoadd`, which warps
+exposures in a pool of worker processes.
 """
+import argparse
 import os
 import sys
-import time
-import traceback
 
-import lsst.pex.config as pexConfig
 import lsst.afw.geom as afwGeom
-import lsst.afw.image as afwImage
-import lsst.afw.math as afwMath
-import lsst.coadd.chisquared as coaddChiSq
+from lsst.coadd.chisquared.exposureIndex import ExposureIndex
+from lsst.coadd.chisquared.warpAndCoadd import WarpAndCoaddConfig, warpAndCoadd, readExposurePathList
 from lsst.log import Log
 
 
-class WarpAndCoaddConfig(pexConfig.Config):
-    saveDebugImages = pexConfig.Field(
-        dtype=bool,
-        doc="Save intermediate images?",
-        default=False,
-    )
-    bboxMin = pexConfig.ListField(
-        dtype=int,
-        doc="Lower left corner of bounding box used to subframe to all input images",
-        default=(0, 0),
-        length=2,
-    )
-    bboxSize = pexConfig.ListField(
-        dtype=int,
-        doc="Size of bounding box used to subframe all input images; 0 0 for full input images",
-        default=(0, 0),
-        length=2,
-    )
-    coadd = pexConfig.ConfigField(dtype=coaddChiSq.Coadd.ConfigClass, doc="")
-    warp = pexConfig.ConfigField(dtype=afwMath.Warper.ConfigClass, doc="")
-
-
-def warpAndCoadd(coaddPath, exposureListPath, config):
+def main(coaddPath, exposureListPath, config, indexPath=None):
     """Create a coadd by warping and psf-matching
 
     Inputs:
@@ -66,114 +44,87 @@ def warpAndCoadd(coaddPath, exposureListPath, config):
     - exposureListPath: a file containing a list of paths to input exposures;
         blank lines and lines that start with # are ignored
     - config: an instance of WarpAndCoaddConfig
-
-    The first exposure in exposureListPath is used as the reference: all other
-    exposures are warped to match to it.
+    - indexPath: path to an index of exposure footprints, or None;
+        if specified, the index is updated with the exposures in exposureListPath
+        and queried for the exposures that overlap the coadd
     """
-    weightPath = os.path.splitext(coaddPath)[0] + "_weight.fits"
-
-    bbox = afwGeom.Box2I(
-        afwGeom.Point2I(config.bboxMin[0], config.bboxMin[1]),
-        afwGeom.Extent2I(config.bboxSize[0], config.bboxSize[1]),
-    )
-    print("SaveDebugImages =", config.saveDebugImages)
-    print("bbox =", bbox)
-
-    # process exposures
-    accumGoodTime = 0
-    coadd = None
-    expNum = 0
-    numExposuresInCoadd = 0
-    numExposuresFailed = 0
-    with open(exposureListPath, "rU") as infile:
-        for exposurePath in infile:
-            exposurePath = exposurePath.strip()
-            if not exposurePath or exposurePath.startswith("#"):
-                continue
-            expNum += 1
-
-            try:
-                print("Processing exposure: %s" % (exposurePath,), file=sys.stderr)
-                startTime = time.time()
-                exposure = afwImage.ExposureF(exposurePath, 0, bbox, afwImage.LOCAL)
-                if config.saveDebugImages:
-                    exposure.writeFits("exposure%s.fits" % (expNum,))
-
-                if not coadd:
-                    print("Create warper and coadd with size and WCS matching the first/reference exposure",
-                          file=sys.stderr)
-                    warper = afwMath.Warper.fromConfig(config.warp)
-                    coadd = coaddChiSq.Coadd.fromConfig(
-                        bbox=exposure.getBBox(),
-                        wcs=exposure.getWcs(),
-                        config=config.coadd)
-                    print("badPixelMask=", coadd.getBadPixelMask())
-
-                    print("Add reference exposure to coadd (without warping)", file=sys.stderr)
-                    coadd.addExposure(exposure)
-                else:
-                    print("Warp exposure", file=sys.stderr)
-                    warpedExposure = warper.warpExposure(
-                        destWcs=coadd.getWcs(),
-                        srcExposure=exposure,
-                        maxBBox=coadd.getBBox(),
-                    )
-                    if config.saveDebugImages:
-                        warpedExposure.writeFits("warped%s.fits" % (expNum,))
-
-                    print("Add warped exposure to coadd", file=sys.stderr)
-                    coadd.addExposure(warpedExposure)
-
-                    # ignore time for first exposure since nothing happens to it
-                    deltaTime = time.time() - startTime
-                    print("Elapsed time for processing exposure: %0.1f sec" % (deltaTime,), file=sys.stderr)
-                    accumGoodTime += deltaTime
-                numExposuresInCoadd += 1
-            except Exception as e:
-                print("Exposure %s failed: %s" % (exposurePath, e), file=sys.stderr)
-                traceback.print_exc(file=sys.stderr)
-                numExposuresFailed += 1
-                continue
-
-    coaddExposure = coadd.getCoadd()
-    coaddExposure.writeFits(coaddPath)
-    print("Wrote coadd: %s" % (coaddPath,), file=sys.stderr)
-    weightMap = coadd.getWeightMap()
-    weightMap.writeFits(weightPath)
-    print("Wrote weightMap: %s" % (weightPath,), file=sys.stderr)
-
-    print("Coadded %d exposures and failed %d" % (numExposuresInCoadd, numExposuresFailed), file=sys.stderr)
-    if numExposuresInCoadd > 1:
-        timePerGoodExposure = accumGoodTime / float(numExposuresInCoadd - 1)
-        print("Processing speed: %.1f seconds/exposure (ignoring first and failed)" % (timePerGoodExposure,),
-              file=sys.stderr)
+    exposurePathList = readExposurePathList(exposureListPath)
+    if indexPath is None:
+        result = warpAndCoadd(coaddPath, exposurePathList, config)
+    else:
+        subframeBBox = afwGeom.Box2I(afwGeom.Point2I(config.bboxMin[0], config.bboxMin[1]),
+                                     afwGeom.Extent2I(config.bboxSize[0], config.bboxSize[1]))
+        with ExposureIndex(indexPath, subframeBBox=subframeBBox) as exposureIndex:
+            numRead = exposureIndex.update(exposurePathList)
+            print("Read %d of %d exposure headers to update index %s" %
+                  (numRead, len(exposurePathList), indexPath), file=sys.stderr)
+            result = warpAndCoadd(coaddPath, exposurePathList, config, exposureIndex=exposureIndex)
+
+    print("Coadded %d exposures, failed %d and skipped %d that do not overlap the coadd" %
+          (result.numExposuresInCoadd, result.numExposuresFailed, result.numExposuresSkipped),
+          file=sys.stderr)
+    if result.numExposuresWarped > 0:
+        print("Processing speed: %.1f seconds/exposure (ignoring first; failures included in elapsed time)"
+              % (result.warpTime / float(result.numExposuresWarped),), file=sys.stderr)
+    if result.exposureStatistics:
+        numAccepted = sum(stats.numAccepted for stats in result.exposureStatistics.values())
+        numRejected = sum(stats.numRejected for stats in result.exposureStatistics.values())
+        numNonFinite = sum(stats.numNonFinite for stats in result.exposureStatistics.values())
+        print("Pixels: %d accepted, %d rejected by the bad pixel mask, %d non-finite" %
+              (numAccepted, numRejected, numNonFinite), file=sys.stderr)
+    print("I/O: workers spent %.1f seconds reading %.1f Mpixels" %
+          (result.readTime, result.numPixelsRead / 1.0e6), file=sys.stderr)
+    if config.numPrefetch > 0:
+        prefetchedReadTime = sum(workerTime for prefetchTime, workerTime in result.exposureReadTimes.values()
+                                 if prefetchTime is not None)
+        print("Prefetch: read %.1f MiB ahead of the workers in %.1f seconds, hiding %.1f seconds of I/O wait;"
+              " the pipeline waited %.1f seconds for it and the workers spent %.1f seconds re-reading"
+              " prefetched files" %
+              (result.prefetchBytes / 2.0**20, result.prefetchTime, result.prefetchHiddenTime,
+               result.prefetchWaitTime, prefetchedReadTime), file=sys.stderr)
+    if config.warpCacheDir is not None:
+        print("Warp cache: %d of %d warped exposures were read from %s" %
+              (result.numWarpCacheHits, result.numExposuresWarped, config.warpCacheDir), file=sys.stderr)
+    if result.tracer is not None:
+        print(result.tracer.formatSummary(), file=sys.stderr)
+        print("Wrote trace to %s" % (config.tracePath,), file=sys.stderr)
 
 
 if __name__ == "__main__":
     Log.getLogger('coadd').setLevel(Log.DEBUG)
-    helpStr = """Usage: warpAndCoadd.py coaddPath exposureListPath
-
-where:
-- coaddPath is the desired name or path of the output coadd
-- exposureListPath is a file containing a list of:
-    pathToExposure
-  where:
-  - pathToExposure is the path to an Exposure
-  - the first exposure listed is taken to be the reference exposure,
-    which determines the size and WCS of the coadd
-  - empty lines and lines that start with # are ignored.
-"""
-    if len(sys.argv) != 3:
-        print(helpStr)
-        sys.exit(0)
-
-    coaddPath = sys.argv[1]
-    if os.path.exists(coaddPath):
-        print("Coadd file %s already exists" % (coaddPath,), file=sys.stderr)
+    parser = argparse.ArgumentParser(description="Create a coadd by warping and adding exposures")
+    parser.add_argument("coaddPath", help="desired name or path of the output coadd")
+    parser.add_argument("exposureListPath",
+                        help="file containing a list of paths to exposures, one per line; the first "
+                             "exposure listed is taken to be the reference exposure, which determines "
+                             "the size and WCS of the coadd; empty lines and lines that start with # "
+                             "are ignored")
+    parser.add_argument("indexPath", nargs="?",
+                        help="optional index of exposure footprints, created if needed; it is updated "
+                             "with any new or changed exposures in exposureListPath, and only exposures "
+                             "that it finds overlap the coadd are warped")
+    parser.add_argument("--trace", metavar="TRACEPATH",
+                        help="write a Chrome trace-event JSON file of where the time was spent, "
+                             "and print a summary")
+    parser.add_argument("--warp-cache", metavar="CACHEDIR", dest="warpCacheDir",
+                        help="directory of a cache of warped exposures, so that re-running a coadd "
+                             "over the same exposures does not warp them again")
+    parser.add_argument("--prefetch", type=int, default=0, metavar="NUMFILES", dest="numPrefetch",
+                        help="read up to this many whole input files ahead of the workers on a "
+                             "background thread")
+    parser.add_argument("--shared-accumulator", action="store_true", dest="doSharedAccumulator",
+                        help="have the workers add warped exposures to a coadd in shared memory, "
+                             "instead of sending them back to the main process")
+    args = parser.parse_args()
+
+    if os.path.exists(args.coaddPath):
+        print("Coadd file %s already exists" % (args.coaddPath,), file=sys.stderr)
         sys.exit(1)
 
-    exposureListPath = sys.argv[2]
-
     config = WarpAndCoaddConfig()
+    config.tracePath = args.trace
+    config.warpCacheDir = args.warpCacheDir
+    config.doSharedAccumulator = args.doSharedAccumulator
+    config.numPrefetch = args.numPrefetch
 
-    warpAndCoadd(coaddPath, exposureListPath, config)
+    main(args.coaddPath, args.exposureListPath, config, indexPath=args.indexPath)
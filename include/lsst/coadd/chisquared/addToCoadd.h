@@ -28,6 +28,11 @@
  *
  * @author Russell Owen
  */
+#include <array>
+#include <cstdint>
+#include <memory>
+#include <vector>
+
 #include "lsst/afw/geom.h"
 #include "lsst/afw/image.h"
 
@@ -35,6 +40,95 @@ namespace lsst {
 namespace coadd {
 namespace chisquared {
 
+/**
+ * @brief statistics of the pixels seen by addToCoadd
+ *
+ * Counts are over the overlap of the coadd and the masked image.
+ * numAccepted + numRejected is the area of the overlap.
+ */
+struct AddToCoaddStatistics {
+    static int const NumMaskBits = 32;  ///< number of bits in a MaskPixel
+
+    AddToCoaddStatistics() : numAccepted(0), numRejected(0), numNonFinite(0), seconds(0) {
+        numRejectedByBit.fill(0);
+    }
+
+    /// add the statistics of another call
+    AddToCoaddStatistics &operator+=(AddToCoaddStatistics const &other);
+
+    /// subtract the counts of another call, e.g. of the pixels removed by subtractFromCoadd;
+    /// seconds is not altered, as removing pixels does not undo the time spent adding them
+    AddToCoaddStatistics &operator-=(AddToCoaddStatistics const &other);
+
+    std::int64_t numAccepted;  ///< number of pixels added to the coadd
+    std::int64_t numRejected;  ///< number of pixels skipped because mask & badPixelMask != 0
+    /// for each mask bit: number of skipped pixels with that bit of mask & badPixelMask set;
+    /// a pixel with several bad bits set is counted once for each
+    std::array<std::int64_t, NumMaskBits> numRejectedByBit;
+    std::int64_t numNonFinite;  ///< number of added pixels for which image**2 / variance is not finite
+    double seconds;             ///< wall time (sec)
+};
+
+/**
+ * @brief a low-resolution model of the variance plane of a masked image
+ *
+ * The variance is constant within each cell of a regular grid of cellWidth x cellHeight pixels,
+ * whose first cell starts at the xy0 of the masked image; the cells at the right and top edges may extend
+ * past the image. A constant variance is modelled as a single cell that covers any image.
+ *
+ * The inverse variance of each cell is computed once, when the model is constructed, so that addToCoadd
+ * can multiply by it instead of dividing by each pixel of the variance plane, which it then never reads.
+ */
+class VarianceModel {
+public:
+    /**
+     * @brief construct a model of a constant variance
+     */
+    explicit VarianceModel(double variance);
+
+    /**
+     * @brief construct a model of a variance that is constant within each cell of a grid
+     *
+     * @throw pexExcept::InvalidParameterError if cellVariance is empty or cellWidth or cellHeight < 1.
+     */
+    VarianceModel(lsst::afw::image::Image<lsst::afw::image::VariancePixel> const
+                          &cellVariance,  ///< variance of each cell; pixel (i, j) is cell (i, j)
+                  int cellWidth,          ///< width of each cell, in pixels of the masked image
+                  int cellHeight          ///< height of each cell, in pixels of the masked image
+    );
+
+    /// width of each cell (pixels)
+    int getCellWidth() const { return _cellWidth; }
+
+    /// height of each cell (pixels)
+    int getCellHeight() const { return _cellHeight; }
+
+    /// number of cells in x
+    int getNumCellsX() const { return _numCellsX; }
+
+    /// number of cells in y
+    int getNumCellsY() const { return _numCellsY; }
+
+    /// variance of a cell; cellX and cellY are not checked
+    double getVariance(int cellX, int cellY) const { return _variance[cellY * _numCellsX + cellX]; }
+
+    /// inverse of the variance of a cell; cellX and cellY are not checked
+    double getInverseVariance(int cellX, int cellY) const {
+        return _inverseVariance[cellY * _numCellsX + cellX];
+    }
+
+    /// return true if the cells cover a masked image of the given dimensions
+    bool covers(lsst::afw::geom::Extent2I const &dimensions) const;
+
+private:
+    int _cellWidth;
+    int _cellHeight;
+    int _numCellsX;
+    int _numCellsY;
+    std::vector<double> _variance;
+    std::vector<double> _inverseVariance;
+};
+
 /**
  * @brief add good pixels from a masked image to a coadd and associated weight map
  * using the chi squared algorithm
@@ -47,22 +141,178 @@ namespace chisquared {
  *
  * Note that coadd.variance is not altered.
  *
+ * The input pixel type may differ from the coadd pixel type (e.g. float input and double coadd);
+ * input pixels are converted to CoaddPixelT inside the loop, so no converted copy of the input is needed
+ * and the result is identical to adding such a copy.
+ *
+ * The overlap region may be split into numThreads bands of rows that are processed concurrently.
+ * The bands do not overlap and each pixel is computed exactly as in the serial case,
+ * so the result is identical for any value of numThreads.
+ *
+ * If varianceModel is not null then image.variance is taken from it instead of from the variance plane,
+ * which is not read: coadd.image += image.image**2 * (1 / model variance). The result may differ from
+ * dividing by a variance plane with the same values by floating point rounding.
+ *
  * @return overlapBBox: overlapping bounding box, relative to parent image (hence xy0 is taken into account)
  *
  * @throw pexExcept::InvalidParameterError if coadd and weightMap dimensions or xy0 do not match.
+ * @throw pexExcept::InvalidParameterError if numThreads < 1.
+ * @throw pexExcept::InvalidParameterError if varianceModel does not cover the masked image.
  */
-template <typename CoaddPixelT, typename WeightPixelT>
+template <typename CoaddPixelT, typename WeightPixelT, typename InputPixelT = CoaddPixelT>
 lsst::afw::geom::Box2I addToCoadd(
         lsst::afw::image::MaskedImage<CoaddPixelT, lsst::afw::image::MaskPixel,
                                       lsst::afw::image::VariancePixel>
                 &coadd,                                    ///< [in,out] coadd to be modified
         lsst::afw::image::Image<WeightPixelT> &weightMap,  ///< [in,out] weight map to be modified
+        lsst::afw::image::MaskedImage<InputPixelT, lsst::afw::image::MaskPixel,
+                                      lsst::afw::image::VariancePixel> const
+                &maskedImage,  ///< masked image to add to coadd
+        lsst::afw::image::MaskPixel const
+                badPixelMask,  ///< skip input pixel if input mask & badPixelMask !=0
+        WeightPixelT weight,   ///< relative weight of this image
+        int numThreads = 1,    ///< number of threads (bands of rows) used to process the overlap region
+        VarianceModel const *varianceModel = nullptr  ///< model of the variance of the masked image,
+                                                      ///< or null to use its variance plane
+);
+
+/**
+ * @brief add good pixels from a masked image to a coadd and associated weight map
+ * using the chi squared algorithm, and collect statistics
+ *
+ * The coadd and weight map are altered exactly as by the overload without statistics.
+ * The statistics are counted while the pixels are added, and are added to those in statistics,
+ * so one AddToCoaddStatistics may be used to total several calls.
+ *
+ * @return overlapBBox: overlapping bounding box, relative to parent image (hence xy0 is taken into account)
+ *
+ * @throw pexExcept::InvalidParameterError if coadd and weightMap dimensions or xy0 do not match.
+ * @throw pexExcept::InvalidParameterError if numThreads < 1.
+ * @throw pexExcept::InvalidParameterError if varianceModel does not cover the masked image.
+ */
+template <typename CoaddPixelT, typename WeightPixelT, typename InputPixelT = CoaddPixelT>
+lsst::afw::geom::Box2I addToCoadd(
         lsst::afw::image::MaskedImage<CoaddPixelT, lsst::afw::image::MaskPixel,
+                                      lsst::afw::image::VariancePixel>
+                &coadd,                                    ///< [in,out] coadd to be modified
+        lsst::afw::image::Image<WeightPixelT> &weightMap,  ///< [in,out] weight map to be modified
+        lsst::afw::image::MaskedImage<InputPixelT, lsst::afw::image::MaskPixel,
                                       lsst::afw::image::VariancePixel> const
                 &maskedImage,  ///< masked image to add to coadd
         lsst::afw::image::MaskPixel const
                 badPixelMask,  ///< skip input pixel if input mask & badPixelMask !=0
-        WeightPixelT weight    ///< relative weight of this image
+        WeightPixelT weight,   ///< relative weight of this image
+        AddToCoaddStatistics &statistics,  ///< [in,out] statistics to which to add those of this call
+        int numThreads = 1,  ///< number of threads (bands of rows) used to process the overlap region
+        VarianceModel const *varianceModel = nullptr  ///< model of the variance of the masked image,
+                                                      ///< or null to use its variance plane
+);
+
+/**
+ * @brief subtract good pixels of a masked image from a coadd and associated weight map;
+ * the inverse of addToCoadd
+ *
+ * For good pixels (image.mask & badPixelMask == 0), coadd and weightMap are altered as follows:
+ * coadd.image -= image.image**2 / image.variance
+ * weightMap -= weight
+ * For bad pixels, coadd and weightMap are not altered.
+ *
+ * Thus subtracting a masked image that was added with addToCoadd, with the same badPixelMask and weight,
+ * restores the coadd image and weight map, up to floating point rounding of the coadd image
+ * (use a double precision coadd image to make that negligible).
+ *
+ * coadd.mask is not altered: a bit ORed into it cannot be removed without knowing which other
+ * masked images set it; callers that need that must count the bits themselves.
+ *
+ * If the masked image was added with a varianceModel then the same varianceModel must be passed here;
+ * as in addToCoadd, the variance plane is then not read.
+ *
+ * @return overlapBBox: overlapping bounding box, relative to parent image (hence xy0 is taken into account)
+ *
+ * @throw pexExcept::InvalidParameterError if coadd and weightMap dimensions or xy0 do not match.
+ * @throw pexExcept::InvalidParameterError if numThreads < 1.
+ * @throw pexExcept::InvalidParameterError if varianceModel does not cover the masked image.
+ */
+template <typename CoaddPixelT, typename WeightPixelT, typename InputPixelT = CoaddPixelT>
+lsst::afw::geom::Box2I subtractFromCoadd(
+        lsst::afw::image::MaskedImage<CoaddPixelT, lsst::afw::image::MaskPixel,
+                                      lsst::afw::image::VariancePixel>
+                &coadd,                                    ///< [in,out] coadd to be modified
+        lsst::afw::image::Image<WeightPixelT> &weightMap,  ///< [in,out] weight map to be modified
+        lsst::afw::image::MaskedImage<InputPixelT, lsst::afw::image::MaskPixel,
+                                      lsst::afw::image::VariancePixel> const
+                &maskedImage,  ///< masked image to subtract from coadd
+        lsst::afw::image::MaskPixel const
+                badPixelMask,  ///< skip input pixel if input mask & badPixelMask !=0
+        WeightPixelT weight,   ///< relative weight with which the masked image was added
+        int numThreads = 1,    ///< number of threads (bands of rows) used to process the overlap region
+        VarianceModel const *varianceModel = nullptr  ///< model of the variance with which the masked image
+                                                      ///< was added, or null to use its variance plane
+);
+
+/**
+ * @brief subtract good pixels of a masked image from a coadd and associated weight map,
+ * and collect statistics
+ *
+ * The coadd and weight map are altered exactly as by the overload without statistics.
+ * The statistics of the subtracted pixels are added to those in statistics; the counts are those
+ * that addToCoadd collected when the masked image was added, so they may be removed from a total
+ * with AddToCoaddStatistics::operator-=.
+ *
+ * @return overlapBBox: overlapping bounding box, relative to parent image (hence xy0 is taken into account)
+ *
+ * @throw pexExcept::InvalidParameterError if coadd and weightMap dimensions or xy0 do not match.
+ * @throw pexExcept::InvalidParameterError if numThreads < 1.
+ * @throw pexExcept::InvalidParameterError if varianceModel does not cover the masked image.
+ */
+template <typename CoaddPixelT, typename WeightPixelT, typename InputPixelT = CoaddPixelT>
+lsst::afw::geom::Box2I subtractFromCoadd(
+        lsst::afw::image::MaskedImage<CoaddPixelT, lsst::afw::image::MaskPixel,
+                                      lsst::afw::image::VariancePixel>
+                &coadd,                                    ///< [in,out] coadd to be modified
+        lsst::afw::image::Image<WeightPixelT> &weightMap,  ///< [in,out] weight map to be modified
+        lsst::afw::image::MaskedImage<InputPixelT, lsst::afw::image::MaskPixel,
+                                      lsst::afw::image::VariancePixel> const
+                &maskedImage,  ///< masked image to subtract from coadd
+        lsst::afw::image::MaskPixel const
+                badPixelMask,  ///< skip input pixel if input mask & badPixelMask !=0
+        WeightPixelT weight,   ///< relative weight with which the masked image was added
+        AddToCoaddStatistics &statistics,  ///< [in,out] statistics to which to add those of this call
+        int numThreads = 1,  ///< number of threads (bands of rows) used to process the overlap region
+        VarianceModel const *varianceModel = nullptr  ///< model of the variance with which the masked image
+                                                      ///< was added, or null to use its variance plane
+);
+
+/**
+ * @brief add good pixels from a list of masked images to a coadd and associated weight map
+ * using the chi squared algorithm
+ *
+ * The result is identical to calling addToCoadd for each masked image in turn, but the coadd is
+ * visited once, one tileSize x tileSize tile at a time, and every masked image that overlaps a tile is
+ * added to it before moving on to the next tile. Thus each tile of the coadd and weight map stays in
+ * cache while it is updated, instead of the whole coadd being streamed through memory once per input.
+ * Bands of tile rows may be processed concurrently by numThreads threads.
+ *
+ * @return a list of overlapBBox, one per masked image, as returned by addToCoadd
+ *
+ * @throw pexExcept::InvalidParameterError if coadd and weightMap dimensions or xy0 do not match.
+ * @throw pexExcept::InvalidParameterError if maskedImageList and weightList have different lengths,
+ *        if maskedImageList contains a null pointer, or if tileSize < 1 or numThreads < 1.
+ */
+template <typename CoaddPixelT, typename WeightPixelT, typename InputPixelT = CoaddPixelT>
+std::vector<lsst::afw::geom::Box2I> addManyToCoadd(
+        lsst::afw::image::MaskedImage<CoaddPixelT, lsst::afw::image::MaskPixel,
+                                      lsst::afw::image::VariancePixel>
+                &coadd,                                    ///< [in,out] coadd to be modified
+        lsst::afw::image::Image<WeightPixelT> &weightMap,  ///< [in,out] weight map to be modified
+        std::vector<std::shared_ptr<lsst::afw::image::MaskedImage<
+                InputPixelT, lsst::afw::image::MaskPixel, lsst::afw::image::VariancePixel>>> const
+                &maskedImageList,  ///< masked images to add to coadd, in order
+        lsst::afw::image::MaskPixel const
+                badPixelMask,  ///< skip input pixel if input mask & badPixelMask !=0
+        std::vector<WeightPixelT> const &weightList,  ///< relative weight of each masked image
+        int tileSize = 128,  ///< width and height of a coadd tile, in pixels
+        int numThreads = 1   ///< number of threads (bands of tile rows) used to process the coadd
 );
 
 }  // namespace chisquared
@@ -20,5 +20,9 @@
 # see <https://www.lsstcorp.org/LegalNotices/>.
 #
 from .addToCoadd import *
+from .addToCoaddContinued import *
 from .coadd import *
+from .hashing import *
+from .incrementalCoadd import *
+from .memmapCoadd import *
 from .version import *
@@ -20,8 +20,11 @@
  * see <https://www.lsstcorp.org/LegalNotices/>.
  */
 #include "pybind11/pybind11.h"
+#include "pybind11/stl.h"
 
 #include <cstdint>
+#include <memory>
+#include <vector>
 
 #include "lsst/coadd/chisquared/addToCoadd.h"
 
@@ -35,16 +38,85 @@ namespace chisquared {
 namespace {
 
 /**
- * Wrap addToCoadd
+ * Wrap AddToCoaddStatistics
  *
- * @tparam CoaddPixelT  Pixel type of image plane of coadd and masked image
+ * @param mod  pybind11 module
+ */
+void declareAddToCoaddStatistics(py::module& mod) {
+    py::class_<AddToCoaddStatistics> cls(mod, "AddToCoaddStatistics");
+    cls.def(py::init<>());
+    cls.def_readwrite("numAccepted", &AddToCoaddStatistics::numAccepted);
+    cls.def_readwrite("numRejected", &AddToCoaddStatistics::numRejected);
+    cls.def_readwrite("numRejectedByBit", &AddToCoaddStatistics::numRejectedByBit);
+    cls.def_readwrite("numNonFinite", &AddToCoaddStatistics::numNonFinite);
+    cls.def_readwrite("seconds", &AddToCoaddStatistics::seconds);
+    cls.def("__iadd__", &AddToCoaddStatistics::operator+=, py::is_operator());
+    cls.def("__isub__", &AddToCoaddStatistics::operator-=, py::is_operator());
+}
+
+/**
+ * Wrap VarianceModel
+ *
+ * @param mod  pybind11 module
+ */
+void declareVarianceModel(py::module& mod) {
+    py::class_<VarianceModel, std::shared_ptr<VarianceModel>> cls(mod, "VarianceModel");
+    cls.def(py::init<double>(), "variance"_a);
+    cls.def(py::init<afw::image::Image<afw::image::VariancePixel> const&, int, int>(), "cellVariance"_a,
+            "cellWidth"_a, "cellHeight"_a);
+    cls.def("getCellWidth", &VarianceModel::getCellWidth);
+    cls.def("getCellHeight", &VarianceModel::getCellHeight);
+    cls.def("getNumCellsX", &VarianceModel::getNumCellsX);
+    cls.def("getNumCellsY", &VarianceModel::getNumCellsY);
+    cls.def("getVariance", &VarianceModel::getVariance, "cellX"_a, "cellY"_a);
+    cls.def("getInverseVariance", &VarianceModel::getInverseVariance, "cellX"_a, "cellY"_a);
+    cls.def("covers", &VarianceModel::covers, "dimensions"_a);
+}
+
+/**
+ * Wrap addToCoadd (both overloads), subtractFromCoadd and addManyToCoadd
+ *
+ * The GIL is released while the pixels are processed, so other Python threads
+ * (e.g. ones warping the next exposure) may run concurrently.
+ *
+ * @tparam CoaddPixelT  Pixel type of image plane of coadd
  * @tparam WeightPixelT  Pixel type of weight map and weight scalar
+ * @tparam InputPixelT  Pixel type of image plane of masked image(s) to add
  * @param mod  pybind11 module
  */
-template <typename CoaddPixelT, typename WeightPixelT>
+template <typename CoaddPixelT, typename WeightPixelT, typename InputPixelT>
 void declareAddToCoadd(py::module& mod) {
-    mod.def("addToCoadd", &addToCoadd<CoaddPixelT, WeightPixelT>, "coadd"_a, "weightMap"_a, "maskedImage"_a,
-            "badPixelMask"_a, "weight"_a);
+    typedef afw::image::MaskedImage<CoaddPixelT, afw::image::MaskPixel, afw::image::VariancePixel> Coadd;
+    typedef afw::image::MaskedImage<InputPixelT, afw::image::MaskPixel, afw::image::VariancePixel> Input;
+    typedef afw::image::Image<WeightPixelT> WeightMap;
+
+    mod.def("addToCoadd",
+            static_cast<afw::geom::Box2I (*)(Coadd&, WeightMap&, Input const&, afw::image::MaskPixel,
+                                             WeightPixelT, int, VarianceModel const*)>(
+                    &addToCoadd<CoaddPixelT, WeightPixelT, InputPixelT>),
+            "coadd"_a, "weightMap"_a, "maskedImage"_a, "badPixelMask"_a, "weight"_a, "numThreads"_a = 1,
+            "varianceModel"_a = nullptr, py::call_guard<py::gil_scoped_release>());
+    mod.def("addToCoadd",
+            static_cast<afw::geom::Box2I (*)(Coadd&, WeightMap&, Input const&, afw::image::MaskPixel,
+                                             WeightPixelT, AddToCoaddStatistics&, int, VarianceModel const*)>(
+                    &addToCoadd<CoaddPixelT, WeightPixelT, InputPixelT>),
+            "coadd"_a, "weightMap"_a, "maskedImage"_a, "badPixelMask"_a, "weight"_a, "statistics"_a,
+            "numThreads"_a = 1, "varianceModel"_a = nullptr, py::call_guard<py::gil_scoped_release>());
+    mod.def("subtractFromCoadd",
+            static_cast<afw::geom::Box2I (*)(Coadd&, WeightMap&, Input const&, afw::image::MaskPixel,
+                                             WeightPixelT, int, VarianceModel const*)>(
+                    &subtractFromCoadd<CoaddPixelT, WeightPixelT, InputPixelT>),
+            "coadd"_a, "weightMap"_a, "maskedImage"_a, "badPixelMask"_a, "weight"_a, "numThreads"_a = 1,
+            "varianceModel"_a = nullptr, py::call_guard<py::gil_scoped_release>());
+    mod.def("subtractFromCoadd",
+            static_cast<afw::geom::Box2I (*)(Coadd&, WeightMap&, Input const&, afw::image::MaskPixel,
+                                             WeightPixelT, AddToCoaddStatistics&, int, VarianceModel const*)>(
+                    &subtractFromCoadd<CoaddPixelT, WeightPixelT, InputPixelT>),
+            "coadd"_a, "weightMap"_a, "maskedImage"_a, "badPixelMask"_a, "weight"_a, "statistics"_a,
+            "numThreads"_a = 1, "varianceModel"_a = nullptr, py::call_guard<py::gil_scoped_release>());
+    mod.def("addManyToCoadd", &addManyToCoadd<CoaddPixelT, WeightPixelT, InputPixelT>, "coadd"_a,
+            "weightMap"_a, "maskedImageList"_a, "badPixelMask"_a, "weightList"_a, "tileSize"_a = 128,
+            "numThreads"_a = 1, py::call_guard<py::gil_scoped_release>());
 }
 
 }  // namespace
@@ -53,14 +125,21 @@ PYBIND11_MODULE(addToCoadd, mod) {
     py::module::import("lsst.afw.geom");
     py::module::import("lsst.afw.image");
 
-    declareAddToCoadd<double, double>(mod);
-    declareAddToCoadd<double, float>(mod);
-    declareAddToCoadd<double, int>(mod);
-    declareAddToCoadd<double, std::uint16_t>(mod);
-    declareAddToCoadd<float, double>(mod);
-    declareAddToCoadd<float, float>(mod);
-    declareAddToCoadd<float, int>(mod);
-    declareAddToCoadd<float, std::uint16_t>(mod);
+    declareAddToCoaddStatistics(mod);
+    declareVarianceModel(mod);
+    declareAddToCoadd<double, double, double>(mod);
+    declareAddToCoadd<double, float, double>(mod);
+    declareAddToCoadd<double, int, double>(mod);
+    declareAddToCoadd<double, std::uint16_t, double>(mod);
+    declareAddToCoadd<float, double, float>(mod);
+    declareAddToCoadd<float, float, float>(mod);
+    declareAddToCoadd<float, int, float>(mod);
+    declareAddToCoadd<float, std::uint16_t, float>(mod);
+    // float input, double accumulator
+    declareAddToCoadd<double, double, float>(mod);
+    declareAddToCoadd<double, float, float>(mod);
+    declareAddToCoadd<double, int, float>(mod);
+    declareAddToCoadd<double, std::uint16_t, float>(mod);
 }
 
 }  // namespace chisquared
@@ -0,0 +1,101 @@
+#
+# LSST Data Management System
+# Copyright 2008-2018 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+import lsst.afw.image as afwImage
+from lsst.utils import continueClass
+from . addToCoadd import AddToCoaddStatistics
+
+__all__ = []
+
+
+@continueClass  # noqa: F811
+class AddToCoaddStatistics:
+
+    def getNumRejectedByPlane(self):
+        """Return the number of rejected pixels for each mask plane
+
+        Returns
+        -------
+        numRejectedByPlane : `dict` of `str`: `int`
+            Number of rejected pixels that have each mask plane set, for
+            each mask plane that rejected at least one pixel.
+        """
+        numRejectedByBit = self.numRejectedByBit
+        return {name: numRejectedByBit[bit]
+                for name, bit in afwImage.Mask().getMaskPlaneDict().items() if numRejectedByBit[bit] > 0}
+
+    def toDict(self):
+        """Return the statistics as a `dict`, e.g. to export as metrics
+        """
+        return dict(
+            numAccepted=self.numAccepted,
+            numRejected=self.numRejected,
+            numRejectedByPlane=self.getNumRejectedByPlane(),
+            numNonFinite=self.numNonFinite,
+            seconds=self.seconds,
+        )
+
+    @staticmethod
+    def fromDict(statisticsDict):
+        """Return statistics from a `dict` returned by `toDict`, e.g. one
+        saved with a checkpoint
+
+        Parameters
+        ----------
+        statisticsDict : `dict`
+            Statistics, as returned by `toDict`; every mask plane in
+            ``numRejectedByPlane`` must be defined.
+
+        Returns
+        -------
+        statistics : `AddToCoaddStatistics`
+        """
+        statistics = AddToCoaddStatistics()
+        statistics.numAccepted = statisticsDict["numAccepted"]
+        statistics.numRejected = statisticsDict["numRejected"]
+        numRejectedByBit = list(statistics.numRejectedByBit)
+        for name, numRejected in statisticsDict["numRejectedByPlane"].items():
+            numRejectedByBit[afwImage.Mask.getMaskPlane(name)] = numRejected
+        statistics.numRejectedByBit = numRejectedByBit
+        statistics.numNonFinite = statisticsDict["numNonFinite"]
+        statistics.seconds = statisticsDict["seconds"]
+        return statistics
+
+    def __reduce__(self):
+        # support pickling, e.g. to return statistics from a worker process
+        return (_makeAddToCoaddStatistics, (self.numAccepted, self.numRejected, list(self.numRejectedByBit),
+                                            self.numNonFinite, self.seconds))
+
+    def __repr__(self):
+        return "AddToCoaddStatistics(numAccepted=%d, numRejected=%d, numNonFinite=%d, seconds=%.3g)" % \
+            (self.numAccepted, self.numRejected, self.numNonFinite, self.seconds)
+
+
+def _makeAddToCoaddStatistics(numAccepted, numRejected, numRejectedByBit, numNonFinite, seconds):
+    """Make statistics from the values of their fields, when unpickling
+    """
+    statistics = AddToCoaddStatistics()
+    statistics.numAccepted = numAccepted
+    statistics.numRejected = numRejected
+    statistics.numRejectedByBit = numRejectedByBit
+    statistics.numNonFinite = numNonFinite
+    statistics.seconds = seconds
+    return statistics
@@ -19,10 +19,48 @@
 # the GNU General Public License along with this program.  If not,
 # see <http://www.lsstcorp.org/LegalNotices/>.
 #
+import collections
+import concurrent.futures
+import itertools
+import json
+import os
+import re
+import time
+
+import numpy as np
+
+import lsst.pex.config as pexConfig
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.afw.math as afwMath
 import lsst.coadd.utils as coaddUtils
-from . addToCoadd import addToCoadd
+from . addToCoadd import AddToCoaddStatistics, VarianceModel, addToCoadd
+from . footprint import projectFootprint
+
+__all__ = ["Coadd", "CoaddConfig", "detectVarianceModel", "makeVarianceModel", "makeWarpingControl",
+           "mergeCoadds", "readCheckpointManifest"]
 
-__all__ = ["Coadd"]
+_CheckpointManifestName = "checkpoint.json"
+_CheckpointFileRegex = re.compile(r"^(coadd|weightMap|arrays|image|mask|wcs)-(\d+)\.(fits|npz|npy)$")
+# marks the end of exposureIds in Coadd.addExposures
+_MissingId = object()
+
+
+class CoaddConfig(coaddUtils.Coadd.ConfigClass):
+    """Config for a chi-squared Coadd
+    """
+    numThreads = pexConfig.Field(
+        dtype=int,
+        doc="Number of threads used by addToCoadd to add each exposure to the coadd",
+        default=1,
+        check=lambda n: n >= 1,
+    )
+    doubleAccumulator = pexConfig.Field(
+        dtype=bool,
+        doc="Accumulate the coadd image in double precision? Float input exposures are converted "
+            "pixel by pixel as they are added, without making a converted copy.",
+        default=False,
+    )
 
 
 class Coadd(coaddUtils.Coadd):
@@ -39,22 +77,212 @@ class Coadd(coaddUtils.Coadd):
         Mask planes to pay attention to when rejecting masked pixels.
         Specify as a collection of names.
         badMaskPlanes should always include "EDGE".
+    numThreads : `int`, optional
+        Number of threads used to add each exposure to the coadd;
+        the result does not depend on this value.
+    doubleAccumulator : `bool`, optional
+        If True, accumulate the coadd image in double precision.
+        `getCoadd` still returns an `lsst.afw.image.ExposureF`.
     logName : `str`, optional
         Name by which messages are logged.
     """
+    ConfigClass = CoaddConfig
 
-    def __init__(self, bbox, wcs, badMaskPlanes, logName="coadd.chisquared.Coadd"):
+    def __init__(self, bbox, wcs, badMaskPlanes, numThreads=1, doubleAccumulator=False,
+                 logName="coadd.chisquared.Coadd"):
         coaddUtils.Coadd.__init__(self,
                                   bbox=bbox,
                                   wcs=wcs,
                                   badMaskPlanes=badMaskPlanes,
                                   logName=logName,
                                   )
+        self._badMaskPlanes = list(badMaskPlanes)
+        self._numThreads = numThreads
+        self._doubleAccumulator = doubleAccumulator
+        if doubleAccumulator:
+            self._coadd = afwImage.ExposureD(bbox, wcs)
+        self._consumedIds = []
+        self._consumedIdSet = set()
+        self._lastStatistics = None
+        self._totalStatistics = AddToCoaddStatistics()
+        self._checkpointDir = None
+        self._checkpointExecutor = None
+        self._checkpointFuture = None
+
+    @classmethod
+    def fromConfig(cls, bbox, wcs, config, logName="coadd.chisquared.Coadd"):
+        """Create a chi-squared coadd from a config
+
+        Parameters
+        ----------
+        bbox : `lsst.afw.geom.Box2I`
+            Bounding box of coadd Exposure with respect to parent.
+        wcs : `lsst.afw.geom.SkyWcs`
+            WCS of coadd exposure
+        config : `CoaddConfig`
+            Coadd config.
+        logName : `str`, optional
+            Name by which messages are logged.
+        """
+        return cls(bbox=bbox,
+                   wcs=wcs,
+                   badMaskPlanes=config.badMaskPlanes,
+                   numThreads=config.numThreads,
+                   doubleAccumulator=config.doubleAccumulator,
+                   logName=logName,
+                   )
+
+    @classmethod
+    def fromCheckpoint(cls, checkpointDir, **kwargs):
+        """Create a chi-squared coadd from the latest checkpoint written by
+        `writeCheckpoint`
+
+        Parameters
+        ----------
+        checkpointDir : `str`
+            Directory containing the checkpoint.
+        **kwargs
+            Additional arguments for the constructor, e.g. ``numThreads``;
+            bbox, wcs, badMaskPlanes and doubleAccumulator are taken from
+            the checkpoint.
+
+        Returns
+        -------
+        coadd : `Coadd`
+            Coadd containing the checkpointed accumulator, weight map,
+            filters and list of consumed exposures. Checkpoints are not
+            enabled; call `enableCheckpoints` to continue writing them.
+
+        Raises
+        ------
+        RuntimeError
+            If ``checkpointDir`` contains no checkpoint.
+        """
+        manifest = readCheckpointManifest(checkpointDir)
+        if manifest is None:
+            raise RuntimeError("No checkpoint found in %r" % (checkpointDir,))
+        bbox, wcs = _readCheckpointGeometry(checkpointDir, manifest)
+
+        coadd = cls(bbox=bbox,
+                    wcs=wcs,
+                    badMaskPlanes=manifest["badMaskPlanes"],
+                    doubleAccumulator=manifest["doubleAccumulator"],
+                    **kwargs)
+        coadd._restoreCheckpointPixels(checkpointDir, manifest)
+        coadd._restoreCheckpointState(checkpointDir, manifest)
+        return coadd
+
+    def getNumThreads(self):
+        """Return the number of threads used to add each exposure
+        """
+        return self._numThreads
+
+    def getConsumedIds(self):
+        """Return the IDs of the exposures added so far, in order
+
+        Only exposures added with an ``exposureId`` are listed.
+        """
+        return list(self._consumedIds)
+
+    def isConsumed(self, exposureId):
+        """Return True if an exposure with this ID has been added
+        """
+        return exposureId in self._consumedIdSet
+
+    def getLastStatistics(self):
+        """Return the statistics of the pixels of the exposure most recently
+        added, or None if no exposure has been added
+
+        Returns
+        -------
+        statistics : `AddToCoaddStatistics` or `None`
+            Numbers of pixels added, rejected (in total and by mask plane)
+            and added with a non-finite value, and the time taken to add them.
+        """
+        return self._lastStatistics
+
+    def getTotalStatistics(self):
+        """Return the statistics of the pixels of all exposures added (or
+        merged) into this coadd since it was constructed, including those
+        saved with the checkpoint it was restored from, if any
 
-    def addExposure(self, exposure, weightFactor=1.0):
+        Returns
+        -------
+        statistics : `AddToCoaddStatistics`
+            A copy of the total statistics; see `getLastStatistics`.
+        """
+        statistics = AddToCoaddStatistics()
+        statistics += self._totalStatistics
+        return statistics
+
+    def getCoadd(self):
+        """Get the coadd exposure for all exposures you have coadded so far
+
+        If all exposures in this coadd have the same-named filter then that
+        filter is set in the coadd. Otherwise the coadd will have the default
+        unknown filter.
+
+        Returns
+        -------
+        coaddExposure : `lsst.afw.image.ExposureF`
+            Coadd, scaled by the weight map. If the coadd is accumulated in
+            double precision then it is converted to float before scaling.
+        """
+        if not self._doubleAccumulator:
+            return coaddUtils.Coadd.getCoadd(self)
+
+        accumulator = self._coadd.getMaskedImage()
+        scaledMaskedImage = afwImage.MaskedImageF(accumulator.getBBox())
+        scaledMaskedImage.getImage().getArray()[:] = accumulator.getImage().getArray()
+        scaledMaskedImage.getMask().getArray()[:] = accumulator.getMask().getArray()
+        scaledMaskedImage.getVariance().getArray()[:] = accumulator.getVariance().getArray()
+        return self._makeScaledExposure(scaledMaskedImage, self._weightMap)
+
+    def _makeScaledExposure(self, maskedImage, weightMap):
+        """Scale a float copy of the accumulator by the weight map, in place,
+        and make the coadd exposure from it
+
+        Parameters
+        ----------
+        maskedImage : `lsst.afw.image.MaskedImageF`
+            Copy of the accumulator; modified in place.
+        weightMap : `lsst.afw.image.Image`
+            Weight map.
+
+        Returns
+        -------
+        coaddExposure : `lsst.afw.image.ExposureF`
+            Coadd, scaled by the weight map.
+        """
+        coaddUtils.setCoaddEdgeBits(maskedImage.getMask(), weightMap)
+        maskedImage /= weightMap
+
+        scaledExposure = afwImage.makeExposure(maskedImage, self._wcs)
+        if len(self._filterDict) == 1:
+            scaledExposure.setFilter(list(self._filterDict.values())[0])
+        return scaledExposure
+
+    def addExposure(self, exposure, weightFactor=1.0, exposureId=None, varianceModel=None):
         """Add a an exposure to the coadd; it is assumed to have the same WCS
         as the coadd
 
+        Statistics of the pixels that were added and rejected are counted
+        as they are added; see `getLastStatistics`.
+
+        By default each pixel is divided by its variance. If the variance
+        of the exposure is known to be constant, or constant within each cell
+        of a regular grid (e.g. one per amplifier), pass it as
+        ``varianceModel``: each pixel is then multiplied by the precomputed
+        inverse variance of its cell and the variance plane is never read,
+        which saves a third of the input bandwidth for an `ExposureF`
+        (whose image, mask and variance planes are all 4 bytes per pixel)
+        and a division per pixel (see ``examples/benchmarkAddToCoadd.py``).
+        Results may differ by rounding from those of dividing by the
+        variance plane. A known variance may come from e.g. the exposure
+        metadata;
+        `detectVarianceModel` finds one from the variance plane, but reads
+        the plane to do so, so it only pays if the model is reused.
+
         Parameters
         ----------
         exposure : `lsst.afw.image.Exposure`
@@ -65,6 +293,13 @@ class Coadd(coaddUtils.Coadd):
             - warped to match the coadd
         weightFactor : `float`
             weight with which to add exposure to coadd
+        exposureId : `str` or `int`, optional
+            Identifier of the exposure, recorded in the list of consumed
+            exposures (see `getConsumedIds`) and saved with checkpoints.
+        varianceModel : `VarianceModel` or `float`, optional
+            Model of the variance of ``exposure``, or a constant variance,
+            used instead of its variance plane; if None then the variance
+            plane is used.
 
         Returns
         -------
@@ -81,7 +316,857 @@ class Coadd(coaddUtils.Coadd):
         filter = exposure.getFilter()
         self._filterDict.setdefault(filter.getName(), filter)
 
-        overlapBBox = addToCoadd(self._coadd.getMaskedImage(), self._weightMap,
-                                 exposure.getMaskedImage(), self._badPixelMask, weightFactor)
+        statistics = AddToCoaddStatistics()
+        overlapBBox = self._addMaskedImage(exposure.getMaskedImage(), weightFactor, statistics,
+                                           varianceModel=makeVarianceModel(varianceModel))
+
+        self._recordExposure(exposureId, statistics)
+        return overlapBBox, weightFactor
+
+    def warpAndAddExposure(self, exposure, warpingControl, weightFactor=1.0, exposureId=None,
+                           tileSize=256, varianceModel=None):
+        """Warp an exposure to the coadd and add it, one tile at a time
+
+        This gives the same result as warping ``exposure`` with
+        `lsst.afw.math.Warper` and calling `addExposure`, but the warped
+        exposure is never held in memory as a whole: each tile of the part
+        of the coadd that the exposure may overlap is warped into the same
+        small buffer and added to the coadd before the next is warped.
+        If the warping control interpolates the transform, it is
+        interpolated over each tile separately, so pixel values may differ
+        slightly from those of a single warp.
+
+        As in `addExposure`, each warped pixel is divided by its warped
+        variance unless ``varianceModel`` is given. Warping changes the
+        variance, so the model must be that of the warped exposure, which
+        only a constant variance can describe: a grid of cells is aligned
+        with the input pixels, not with the tiles of the coadd.
+
+        Parameters
+        ----------
+        exposure : `lsst.afw.image.Exposure`
+            Exposure to warp and add to coadd; this must be:
+            - background-subtracted or background-matched to the other images
+              being coadded
+            - psf-matched to the desired PSF model (optional)
+        warpingControl : `lsst.afw.math.WarpingControl`
+            Warping control, e.g. from `makeWarpingControl`.
+        weightFactor : `float`
+            weight with which to add exposure to coadd
+        exposureId : `str` or `int`, optional
+            Identifier of the exposure, recorded in the list of consumed
+            exposures (see `getConsumedIds`) and saved with checkpoints.
+        tileSize : `int`, optional
+            Width and height of the tiles (coadd pixels).
+        varianceModel : `VarianceModel` or `float`, optional
+            Constant variance of the warped exposure, or a `VarianceModel`
+            of one cell, used instead of the warped variance plane; if None
+            then the warped variance plane is used.
+
+        Returns
+        -------
+        overlapBBox : `lsst.afw.geom.Box2I`
+            Region of the coadd that was warped in parent coordinates; pixels
+            outside it are not overlapped by ``exposure``.
+        weight : `float`
+            Weight with which ``exposure`` was added to coadd;
+            weight = weightFactor for this kind of coadd.
+
+        Raises
+        ------
+        ValueError
+            If ``tileSize`` < 1, or if ``varianceModel`` has more than one
+            cell.
+        """
+        if tileSize < 1:
+            raise ValueError("tileSize = %s < 1" % (tileSize,))
+        varianceModel = makeVarianceModel(varianceModel)
+        if varianceModel is not None:
+            numCells = (varianceModel.getNumCellsX(), varianceModel.getNumCellsY())
+            if numCells != (1, 1):
+                raise ValueError("varianceModel of %d x %d cells cannot model a warped exposure; "
+                                 "only a constant variance can" % numCells)
+            # a cell of finite size may not cover every tile
+            varianceModel = VarianceModel(varianceModel.getVariance(0, 0))
+        self._log.info("warp and add exposure to coadd")
+
+        filter = exposure.getFilter()
+        self._filterDict.setdefault(filter.getName(), filter)
+
+        statistics = AddToCoaddStatistics()
+        overlapBBox = afwGeom.Box2I(self._bbox)
+        coaddBox = projectFootprint(exposure.getWcs(), exposure.getBBox(), self._wcs)
+        if coaddBox is not None:
+            kernel = warpingControl.getWarpingKernel()
+            coaddBox.grow(max(kernel.getWidth(), kernel.getHeight()) + 1)
+            overlapBBox.clip(afwGeom.Box2I(coaddBox, afwGeom.Box2I.EXPAND))
+        if not overlapBBox.isEmpty():
+            tile = afwImage.MaskedImageF(min(tileSize, overlapBBox.getWidth()),
+                                         min(tileSize, overlapBBox.getHeight()))
+            for y in range(overlapBBox.getMinY(), overlapBBox.getMaxY() + 1, tileSize):
+                for x in range(overlapBBox.getMinX(), overlapBBox.getMaxX() + 1, tileSize):
+                    tileBBox = afwGeom.Box2I(afwGeom.Point2I(x, y), afwGeom.Extent2I(tileSize, tileSize))
+                    tileBBox.clip(overlapBBox)
+                    tileView = afwImage.MaskedImageF(tile, afwGeom.Box2I(afwGeom.Point2I(0, 0),
+                                                                         tileBBox.getDimensions()),
+                                                     afwImage.LOCAL, False)
+                    tileView.setXY0(tileBBox.getMin())
+                    afwMath.warpImage(tileView, self._wcs, exposure.getMaskedImage(), exposure.getWcs(),
+                                      warpingControl)
+                    self._addMaskedImage(tileView, weightFactor, statistics, varianceModel=varianceModel)
 
+        self._recordExposure(exposureId, statistics)
         return overlapBBox, weightFactor
+
+    def _recordExposure(self, exposureId, statistics):
+        """Record that an exposure has been added and checkpoint if it is time
+        """
+        self._lastStatistics = statistics
+        self._totalStatistics += statistics
+        if exposureId is not None:
+            self._consumedIds.append(exposureId)
+            self._consumedIdSet.add(exposureId)
+        if self._checkpointDir is not None:
+            self._numSinceCheckpoint += 1
+            self._maybeWriteCheckpoint()
+
+    def _addMaskedImage(self, maskedImage, weight, statistics, varianceModel=None):
+        """Add a masked image to the accumulator planes
+
+        Subclasses that store the accumulator differently override this.
+
+        Parameters
+        ----------
+        maskedImage : `lsst.afw.image.MaskedImage`
+            Masked image to add, warped to match the coadd.
+        weight : `float`
+            Weight with which to add ``maskedImage``.
+        statistics : `AddToCoaddStatistics`
+            Statistics to which to add those of ``maskedImage``.
+        varianceModel : `VarianceModel`, optional
+            Model of the variance of ``maskedImage``, used instead of its
+            variance plane.
+
+        Returns
+        -------
+        overlapBBox : `lsst.afw.geom.Box2I`
+            Region of overlap between ``maskedImage`` and coadd in parent
+            coordinates.
+        """
+        return addToCoadd(self._coadd.getMaskedImage(), self._weightMap,
+                          maskedImage, self._badPixelMask, weight, statistics,
+                          numThreads=self._numThreads, varianceModel=varianceModel)
+
+    def addExposures(self, inputs, prepare=None, weightFactor=1.0, maxWorkers=1, exposureIds=None):
+        """Add a sequence of exposures to the coadd, preparing them in
+        parallel
+
+        ``prepare`` (e.g. read and warp an exposure) is run on a pool of
+        ``maxWorkers`` threads, while the prepared exposures are added to the
+        coadd one at a time, in the order of ``inputs``, by the calling thread.
+        Thus the result is identical to calling `addExposure` in a loop.
+
+        `addToCoadd` releases the GIL, so adding one exposure overlaps with
+        preparing the next one. Reading and warping with afw do not release
+        the GIL, however, so calls to such a ``prepare`` do not overlap with
+        each other: the time saved is at most the time spent in `addToCoadd`,
+        and ``maxWorkers`` > 1 only helps if ``prepare`` spends much of its
+        time with the GIL released (e.g. waiting for I/O). To read and warp
+        exposures in parallel use `lsst.coadd.chisquared.warpAndCoadd`, which
+        uses a process pool. ``examples/benchmarkAddToCoadd.py`` times this
+        method against a serial loop.
+
+        Parameters
+        ----------
+        inputs : iterable
+            Exposures to add or, if ``prepare`` is specified, items to pass
+            to ``prepare``.
+        prepare : callable, optional
+            Function that takes one item of ``inputs`` and returns the
+            `lsst.afw.image.Exposure` to add (warped to match the coadd),
+            or `None` to skip that item. It is called from worker threads,
+            so it must be thread safe. If `None` then each item of
+            ``inputs`` is added as is.
+        weightFactor : `float`
+            weight with which to add each exposure to coadd
+        maxWorkers : `int`
+            Maximum number of threads used to call ``prepare``. At most
+            ``2 * maxWorkers`` prepared exposures are held in memory.
+        exposureIds : iterable, optional
+            Identifier of each item of ``inputs``, passed to `addExposure`;
+            there must be one per item.
+
+        Returns
+        -------
+        results : `list`
+            For each item of ``inputs``: the ``(overlapBBox, weight)`` tuple
+            returned by `addExposure`, or `None` if ``prepare`` returned
+            `None`.
+
+        Raises
+        ------
+        ValueError
+            If ``maxWorkers`` < 1, or if ``exposureIds`` does not have one
+            item per item of ``inputs``. If ``inputs`` has no length then a
+            mismatch is found, and raised, only when the unmatched item is
+            reached; the exposures before it have been added.
+        """
+        if maxWorkers < 1:
+            raise ValueError("maxWorkers = %s < 1" % (maxWorkers,))
+        if exposureIds is not None:
+            exposureIds = list(exposureIds)
+            if hasattr(inputs, "__len__") and len(inputs) != len(exposureIds):
+                raise ValueError("len(exposureIds) = %s != len(inputs) = %s" %
+                                 (len(exposureIds), len(inputs)))
+        if prepare is None:
+            def prepare(exposure):
+                return exposure
+
+        results = []
+        inputIter = iter(inputs)
+        exposureIdIter = itertools.repeat(None) if exposureIds is None else iter(exposureIds)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+            pending = collections.deque(executor.submit(prepare, item)
+                                        for item in itertools.islice(inputIter, 2 * maxWorkers))
+            try:
+                while pending:
+                    exposure = pending.popleft().result()
+                    exposureId = next(exposureIdIter, _MissingId)
+                    if exposureId is _MissingId:
+                        raise ValueError("exposureIds has fewer items (%s) than inputs" %
+                                         (len(exposureIds),))
+                    for item in itertools.islice(inputIter, 1):
+                        pending.append(executor.submit(prepare, item))
+                    if exposure is None:
+                        results.append(None)
+                    else:
+                        results.append(self.addExposure(exposure, weightFactor, exposureId=exposureId))
+                    del exposure
+            except Exception:
+                for future in pending:
+                    future.cancel()
+                raise
+        if next(exposureIdIter, _MissingId) is not _MissingId:
+            raise ValueError("exposureIds has more items (%s) than inputs (%s)" %
+                             (len(exposureIds), len(results)))
+        return results
+
+    def merge(self, other):
+        """Add the accumulated sums of another chi-squared coadd to this one
+
+        Within the overlap of the two bounding boxes the coadd images and
+        weight maps are added and the coadd masks are ORed, so the result is
+        the same as if the exposures added to ``other`` had been added to
+        this coadd, except for floating point rounding from the different
+        order of summation. Data in ``other`` outside this coadd's bounding
+        box is ignored; use `mergeCoadds` to combine coadds with different
+        bounding boxes. The filters and consumed exposure IDs of ``other``
+        are added to those of this coadd.
+
+        Parameters
+        ----------
+        other : `Coadd`
+            Coadd to merge into this one; it is not modified.
+
+        Returns
+        -------
+        overlapBBox : `lsst.afw.geom.Box2I`
+            Region of overlap between ``other`` and this coadd in parent
+            coordinates.
+
+        Raises
+        ------
+        ValueError
+            If ``other`` has a different WCS or bad pixel mask.
+        """
+        if other.getWcs() != self._wcs:
+            raise ValueError("Cannot merge coadds with different WCS")
+        if other.getBadPixelMask() != self._badPixelMask:
+            raise ValueError("Cannot merge coadds with different bad pixel masks: %s != %s" %
+                             (other.getBadPixelMask(), self._badPixelMask))
+
+        overlapBBox = afwGeom.Box2I(self._bbox)
+        overlapBBox.clip(other.getBBox())
+        if not overlapBBox.isEmpty():
+            self._addPlanes(overlapBBox, *other._getPlanes(overlapBBox))
+
+        for name, filter in other._filterDict.items():
+            self._filterDict.setdefault(name, filter)
+        for exposureId in other.getConsumedIds():
+            self._consumedIds.append(exposureId)
+            self._consumedIdSet.add(exposureId)
+        self._totalStatistics += other._totalStatistics
+        return overlapBBox
+
+    def _getSlices(self, bbox):
+        """Return the array slices of a region of this coadd
+
+        Parameters
+        ----------
+        bbox : `lsst.afw.geom.Box2I`
+            Region in parent coordinates; must be contained in this coadd.
+        """
+        beginX = bbox.getMinX() - self._bbox.getMinX()
+        beginY = bbox.getMinY() - self._bbox.getMinY()
+        return (slice(beginY, beginY + bbox.getHeight()), slice(beginX, beginX + bbox.getWidth()))
+
+    def _getPlanes(self, bbox):
+        """Return arrays of a region of the accumulator planes, for reading
+
+        Parameters
+        ----------
+        bbox : `lsst.afw.geom.Box2I`
+            Region in parent coordinates; must be contained in this coadd.
+
+        Returns
+        -------
+        image, mask, weightMap : `numpy.ndarray`
+            Coadd image, coadd mask and weight map of ``bbox``.
+        """
+        slices = self._getSlices(bbox)
+        accumulator = self._coadd.getMaskedImage()
+        return (accumulator.getImage().getArray()[slices], accumulator.getMask().getArray()[slices],
+                self._weightMap.getArray()[slices])
+
+    def _addPlanes(self, bbox, image, mask, weightMap):
+        """Add accumulator planes of another coadd to a region of this one
+
+        Parameters
+        ----------
+        bbox : `lsst.afw.geom.Box2I`
+            Region in parent coordinates; must be contained in this coadd.
+        image, mask, weightMap : `numpy.ndarray`
+            Coadd image, coadd mask and weight map to add to ``bbox``.
+        """
+        slices = self._getSlices(bbox)
+        accumulator = self._coadd.getMaskedImage()
+        accumulator.getImage().getArray()[slices] += image
+        accumulator.getMask().getArray()[slices] |= mask
+        self._weightMap.getArray()[slices] += weightMap
+
+    def enableCheckpoints(self, checkpointDir, everyN=None, everySeconds=None):
+        """Periodically save the state of the coadd so that an interrupted
+        run can be resumed with `fromCheckpoint`
+
+        A checkpoint is started by `addExposure` once ``everyN`` exposures
+        have been added, or ``everySeconds`` seconds have passed, since the
+        previous checkpoint. The accumulator and weight map are copied in
+        memory (a `MemmapCoadd` copies its accumulator files instead, one
+        band of rows at a time) and written by a background thread, so
+        accumulation continues while the checkpoint is written; if the
+        previous checkpoint is still being written the new one is
+        postponed. Each checkpoint replaces the
+        previous one atomically, so a checkpoint directory always holds one
+        complete checkpoint.
+
+        Parameters
+        ----------
+        checkpointDir : `str`
+            Directory in which to write checkpoints; created if necessary.
+            If it already holds a checkpoint, that is replaced.
+        everyN : `int`, optional
+            Checkpoint after this many exposures.
+        everySeconds : `float`, optional
+            Checkpoint after this many seconds.
+
+        Raises
+        ------
+        ValueError
+            If neither ``everyN`` nor ``everySeconds`` is specified,
+            or if either is not positive.
+        """
+        if everyN is None and everySeconds is None:
+            raise ValueError("Must specify everyN and/or everySeconds")
+        if everyN is not None and everyN < 1:
+            raise ValueError("everyN = %s < 1" % (everyN,))
+        if everySeconds is not None and everySeconds <= 0:
+            raise ValueError("everySeconds = %s <= 0" % (everySeconds,))
+        self._setCheckpointDir(checkpointDir, everyN=everyN, everySeconds=everySeconds)
+
+    def _setCheckpointDir(self, checkpointDir, everyN, everySeconds):
+        """Set the checkpoint directory and schedule, without checking them
+
+        With ``everyN`` and ``everySeconds`` both None, checkpoints are only
+        written by explicit calls to `writeCheckpoint`.
+        """
+        os.makedirs(checkpointDir, exist_ok=True)
+        manifest = readCheckpointManifest(checkpointDir)
+
+        self.waitForCheckpoint()
+        self._checkpointDir = checkpointDir
+        self._checkpointEveryN = everyN
+        self._checkpointEverySeconds = everySeconds
+        self._checkpointGeneration = 0 if manifest is None else manifest["generation"]
+        self._numSinceCheckpoint = 0
+        self._lastCheckpointTime = time.time()
+        if self._checkpointExecutor is None:
+            self._checkpointExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    def writeCheckpoint(self, wait=False):
+        """Start writing a checkpoint now
+
+        Waits for the previous checkpoint, if it is still being written.
+
+        Parameters
+        ----------
+        wait : `bool`
+            Wait for the checkpoint to be written before returning?
+
+        Raises
+        ------
+        RuntimeError
+            If checkpoints are not enabled.
+        """
+        if self._checkpointDir is None:
+            raise RuntimeError("Checkpoints are not enabled; call enableCheckpoints first")
+        self.waitForCheckpoint()
+
+        self._checkpointGeneration += 1
+        writePixels = self._copyCheckpointPixels(self._checkpointDir, self._checkpointGeneration)
+        self._checkpointFuture = self._checkpointExecutor.submit(
+            _writeCheckpoint, self._checkpointDir, self._checkpointGeneration, writePixels,
+            self._getCheckpointState(), self._getCheckpointArrays())
+        self._numSinceCheckpoint = 0
+        self._lastCheckpointTime = time.time()
+        if wait:
+            self.waitForCheckpoint()
+
+    def _getCheckpointState(self):
+        """Return the state, other than pixels, saved with a checkpoint
+
+        Subclasses that have more state extend this and
+        `_restoreCheckpointState`.
+
+        Returns
+        -------
+        state : `dict`
+            JSON-serializable state, saved in the checkpoint manifest.
+        """
+        return dict(
+            badMaskPlanes=self._badMaskPlanes,
+            doubleAccumulator=self._doubleAccumulator,
+            filterNames=sorted(self._filterDict),
+            consumedIds=list(self._consumedIds),
+            totalStatistics=self._totalStatistics.toDict(),
+        )
+
+    def _copyCheckpointPixels(self, checkpointDir, generation):
+        """Copy the accumulator and weight map for a checkpoint
+
+        Called when a checkpoint is started; the copy must not change as
+        more exposures are added. This copies them in memory and returns a
+        function that writes them as FITS files.
+
+        Parameters
+        ----------
+        checkpointDir : `str`
+            Directory containing the checkpoint.
+        generation : `int`
+            Generation of the checkpoint, part of the name of each file.
+
+        Returns
+        -------
+        writePixels : callable
+            Function with no arguments, called by the thread that writes the
+            checkpoint, that writes what has not been written yet and returns
+            a `dict` of the manifest entries that describe the pixel files.
+        """
+        maskedImage, weightMap = self._copyAccumulator()
+        exposure = afwImage.makeExposure(maskedImage, self._wcs)
+
+        def writePixels():
+            pixelFiles = dict(coadd="coadd-%d.fits" % (generation,),
+                              weightMap="weightMap-%d.fits" % (generation,))
+            exposure.writeFits(os.path.join(checkpointDir, pixelFiles["coadd"]))
+            weightMap.writeFits(os.path.join(checkpointDir, pixelFiles["weightMap"]))
+            return pixelFiles
+
+        return writePixels
+
+    def _restoreCheckpointPixels(self, checkpointDir, manifest):
+        """Restore the accumulator and weight map saved with a checkpoint;
+        called by `fromCheckpoint`
+
+        Parameters
+        ----------
+        checkpointDir : `str`
+            Directory containing the checkpoint.
+        manifest : `dict`
+            Checkpoint manifest.
+        """
+        for beginY, endY, maskedImage, weightMap in self._readCheckpointBands(
+                checkpointDir, manifest, self._bbox.getHeight()):
+            self._restoreAccumulator(maskedImage, weightMap)
+
+    def _readCheckpointBands(self, checkpointDir, manifest, bandRows):
+        """Read the accumulator and weight map saved with a checkpoint, one band
+        of full-width rows at a time
+
+        The checkpoint is either FITS files of the coadd and weight map, written
+        by `Coadd`, or ``.npy`` files of the image, mask and weight map planes,
+        written by `MemmapCoadd`.
+
+        Parameters
+        ----------
+        checkpointDir : `str`
+            Directory containing the checkpoint.
+        manifest : `dict`
+            Checkpoint manifest.
+        bandRows : `int`
+            Maximum number of rows in a band.
+
+        Yields
+        ------
+        beginY, endY : `int`
+            Rows [beginY, endY) of the band, relative to the coadd bbox.
+        maskedImage : `lsst.afw.image.MaskedImage`
+            Accumulator rows of the band; the variance plane is not set.
+        weightMap : `lsst.afw.image.ImageF`
+            Weight map rows of the band.
+        """
+        bbox = self._bbox
+        MaskedImageClass = afwImage.MaskedImageD if manifest["doubleAccumulator"] else afwImage.MaskedImageF
+        for beginY in range(0, bbox.getHeight(), bandRows):
+            endY = min(beginY + bandRows, bbox.getHeight())
+            bandBBox = afwGeom.Box2I(afwGeom.Point2I(bbox.getMinX(), bbox.getMinY() + beginY),
+                                     afwGeom.Extent2I(bbox.getWidth(), endY - beginY))
+            if "planes" in manifest:
+                maskedImage = MaskedImageClass(bandBBox)
+                weightMap = afwImage.ImageF(bandBBox)
+                for name, array in (("image", maskedImage.getImage().getArray()),
+                                    ("mask", maskedImage.getMask().getArray()),
+                                    ("weightMap", weightMap.getArray())):
+                    plane = np.load(os.path.join(checkpointDir, manifest["planes"][name]), mmap_mode="r")
+                    array[:] = plane[beginY:endY]
+                    del plane
+            else:
+                ExposureClass = afwImage.ExposureD if manifest["doubleAccumulator"] else afwImage.ExposureF
+                maskedImage = ExposureClass(os.path.join(checkpointDir, manifest["coadd"]), bbox=bandBBox,
+                                            origin=afwImage.PARENT).getMaskedImage()
+                weightMap = afwImage.ImageF(os.path.join(checkpointDir, manifest["weightMap"]), bbox=bandBBox,
+                                            origin=afwImage.PARENT)
+            yield beginY, endY, maskedImage, weightMap
+
+    def _getCheckpointArrays(self):
+        """Return copies of additional arrays to save with a checkpoint
+
+        Returns
+        -------
+        arrays : `dict` of `str`: `numpy.ndarray`
+            Arrays by name, saved in a ``.npz`` file if there are any.
+        """
+        return {}
+
+    def _restoreCheckpointState(self, checkpointDir, manifest):
+        """Restore the state saved by `_getCheckpointState` and
+        `_getCheckpointArrays`; called by `fromCheckpoint`
+
+        Parameters
+        ----------
+        checkpointDir : `str`
+            Directory containing the checkpoint.
+        manifest : `dict`
+            Checkpoint manifest.
+        """
+        self._filterDict = {name: afwImage.Filter(name, True) for name in manifest["filterNames"]}
+        self._consumedIds = list(manifest["consumedIds"])
+        self._consumedIdSet = set(self._consumedIds)
+        if "totalStatistics" in manifest:
+            self._totalStatistics = AddToCoaddStatistics.fromDict(manifest["totalStatistics"])
+
+    def waitForCheckpoint(self):
+        """Wait until the checkpoint being written, if any, is finished
+
+        Raises
+        ------
+        Exception
+            Any exception raised while writing the checkpoint.
+        """
+        future, self._checkpointFuture = self._checkpointFuture, None
+        if future is not None:
+            future.result()
+
+    def _maybeWriteCheckpoint(self):
+        """Start a checkpoint if one is due and the previous one is written
+        """
+        if self._checkpointFuture is not None and not self._checkpointFuture.done():
+            return
+        isDue = (self._checkpointEveryN is not None and
+                 self._numSinceCheckpoint >= self._checkpointEveryN) or \
+            (self._checkpointEverySeconds is not None and
+             time.time() - self._lastCheckpointTime >= self._checkpointEverySeconds)
+        if isDue:
+            self._log.info("write checkpoint to %s" % (self._checkpointDir,))
+            self.writeCheckpoint()
+
+    def _copyAccumulator(self):
+        """Return deep copies of the accumulator and weight map
+
+        Returns
+        -------
+        maskedImage : `lsst.afw.image.MaskedImage`
+            Copy of the accumulator.
+        weightMap : `lsst.afw.image.Image`
+            Copy of the weight map.
+        """
+        accumulator = self._coadd.getMaskedImage()
+        return type(accumulator)(accumulator, True), type(self._weightMap)(self._weightMap, True)
+
+    def _restoreAccumulator(self, maskedImage, weightMap):
+        """Set the accumulator and weight map from saved copies
+
+        Parameters
+        ----------
+        maskedImage : `lsst.afw.image.MaskedImage`
+            Accumulator, with the same bbox and pixel type as this coadd's.
+        weightMap : `lsst.afw.image.Image`
+            Weight map, with the same bbox as this coadd's.
+        """
+        accumulator = self._coadd.getMaskedImage()
+        accumulator.getImage().getArray()[:] = maskedImage.getImage().getArray()
+        accumulator.getMask().getArray()[:] = maskedImage.getMask().getArray()
+        self._weightMap.getArray()[:] = weightMap.getArray()
+
+
+def mergeCoadds(coaddList, maxWorkers=1):
+    """Merge chi-squared coadds with the same WCS in a tree reduction
+
+    Coadds are merged in pairs, then the results in pairs, and so on, so N
+    coadds are combined in log2(N) rounds; the merges of each round are run
+    on up to ``maxWorkers`` threads. A pair is merged into whichever coadd
+    contains the other's bounding box, else into a new `Coadd` whose
+    bounding box is the union of the two, so no data is lost.
+
+    Parameters
+    ----------
+    coaddList : `list` of `Coadd`
+        Coadds to merge. They may be modified, so do not use them after.
+    maxWorkers : `int`
+        Maximum number of threads used to merge pairs of coadds.
+
+    Returns
+    -------
+    coadd : `Coadd`
+        The merged coadd.
+
+    Raises
+    ------
+    ValueError
+        If ``coaddList`` is empty, the coadds have different WCSs or bad
+        pixel masks, or ``maxWorkers`` < 1.
+    """
+    if not coaddList:
+        raise ValueError("No coadds to merge")
+    if maxWorkers < 1:
+        raise ValueError("maxWorkers = %s < 1" % (maxWorkers,))
+
+    def mergePair(coadd1, coadd2):
+        if coadd2.getBBox().contains(coadd1.getBBox()):
+            coadd1, coadd2 = coadd2, coadd1
+        if not coadd1.getBBox().contains(coadd2.getBBox()):
+            bbox = afwGeom.Box2I(coadd1.getBBox())
+            bbox.include(coadd2.getBBox())
+            merged = Coadd(bbox=bbox,
+                           wcs=coadd1.getWcs(),
+                           badMaskPlanes=coadd1._badMaskPlanes,
+                           numThreads=coadd1.getNumThreads(),
+                           doubleAccumulator=coadd1._doubleAccumulator,
+                           )
+            merged.merge(coadd1)
+            coadd1 = merged
+        coadd1.merge(coadd2)
+        return coadd1
+
+    coaddList = list(coaddList)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+        while len(coaddList) > 1:
+            mergedList = list(executor.map(mergePair, coaddList[0::2], coaddList[1::2]))
+            if len(coaddList) % 2 == 1:
+                mergedList.append(coaddList[-1])
+            coaddList = mergedList
+    return coaddList[0]
+
+
+def makeVarianceModel(varianceModel):
+    """Return a `VarianceModel` for a model or a constant variance
+
+    Parameters
+    ----------
+    varianceModel : `VarianceModel`, `float` or `None`
+        Model of a variance plane, or a constant variance.
+
+    Returns
+    -------
+    varianceModel : `VarianceModel` or `None`
+        ``varianceModel`` if it is a model or None, else a model of the
+        constant variance.
+    """
+    if varianceModel is None or isinstance(varianceModel, VarianceModel):
+        return varianceModel
+    return VarianceModel(varianceModel)
+
+
+def detectVarianceModel(variance, minCellSize=16, chunkRows=256):
+    """Return a model of a variance plane that is constant, or constant
+    within each cell of a regular grid, if it is one
+
+    The cell size is taken from where the variance changes along the first
+    row and column, then every pixel of each cell is checked, so the whole
+    plane is read once if it can be modelled. A plane that cannot be
+    modelled is usually rejected after reading its first row and column.
+    This costs more than the division by the variance plane that the model
+    saves, so detect a model only if it is reused, e.g. for an exposure
+    that is added to several coadds, or for exposures known to share it.
+
+    Parameters
+    ----------
+    variance : `lsst.afw.image.Image`
+        Variance plane.
+    minCellSize : `int`, optional
+        Minimum width and height of a cell (pixels) for a grid that has
+        more than one cell in that direction; finer grids are not modelled.
+    chunkRows : `int`, optional
+        Number of rows of a cell compared at a time, which bounds the
+        temporary memory used.
+
+    Returns
+    -------
+    varianceModel : `VarianceModel` or `None`
+        Model of the variance plane, or None if the plane is not constant
+        within the cells of any grid with cells of at least
+        ``minCellSize`` pixels.
+    """
+    array = variance.getArray()
+    height, width = array.shape
+    if array.size == 0:
+        return None
+
+    def getCellSize(line):
+        """Return the cell size along a line of pixels, or None
+        """
+        breaks = np.flatnonzero(line[1:] != line[:-1]) + 1
+        if len(breaks) == 0:
+            return len(line)
+        cellSize = breaks[0]
+        if cellSize < minCellSize or np.any(breaks % cellSize != 0):
+            return None
+        return int(cellSize)
+
+    cellWidth = getCellSize(array[0])
+    cellHeight = None if cellWidth is None else getCellSize(array[:, 0])
+    if cellHeight is None:
+        return None
+
+    numCellsX = (width + cellWidth - 1) // cellWidth
+    numCellsY = (height + cellHeight - 1) // cellHeight
+    cellVariance = np.empty((numCellsY, numCellsX), dtype=np.float32)
+    for cellY in range(numCellsY):
+        cellYSlice = slice(cellY * cellHeight, min(height, (cellY + 1) * cellHeight))
+        for cellX in range(numCellsX):
+            cellXSlice = slice(cellX * cellWidth, min(width, (cellX + 1) * cellWidth))
+            value = array[cellYSlice.start, cellXSlice.start]
+            for beginY in range(cellYSlice.start, cellYSlice.stop, chunkRows):
+                endY = min(cellYSlice.stop, beginY + chunkRows)
+                # NaN is not equal to itself, so a NaN variance is never modelled
+                if not np.all(array[beginY:endY, cellXSlice] == value):
+                    return None
+            cellVariance[cellY, cellX] = value
+
+    if numCellsX == 1 and numCellsY == 1:
+        return VarianceModel(float(cellVariance[0, 0]))
+    return VarianceModel(afwImage.makeImageFromArray(cellVariance), cellWidth, cellHeight)
+
+
+def makeWarpingControl(warpConfig):
+    """Make the warping control for `Coadd.warpAndAddExposure` from a
+    warper config
+
+    Parameters
+    ----------
+    warpConfig : `lsst.afw.math.Warper.ConfigClass`
+        Warper config.
+
+    Returns
+    -------
+    warpingControl : `lsst.afw.math.WarpingControl`
+        Warping control that warps as `lsst.afw.math.Warper` does.
+    """
+    return afwMath.WarpingControl(
+        warpConfig.warpingKernelName,
+        warpConfig.maskWarpingKernelName,
+        warpConfig.cacheSize,
+        warpConfig.interpLength,
+        warpConfig.growFullMask,
+    )
+
+
+def readCheckpointManifest(checkpointDir):
+    """Read the manifest of the checkpoint in a directory
+
+    Parameters
+    ----------
+    checkpointDir : `str`
+        Directory that may contain a checkpoint written by
+        `Coadd.writeCheckpoint`.
+
+    Returns
+    -------
+    manifest : `dict` or `None`
+        The manifest, or `None` if there is no checkpoint. It includes the
+        list of consumed exposure IDs as ``manifest["consumedIds"]``.
+    """
+    try:
+        with open(os.path.join(checkpointDir, _CheckpointManifestName)) as infile:
+            return json.load(infile)
+    except FileNotFoundError:
+        return None
+
+
+def _readCheckpointGeometry(checkpointDir, manifest):
+    """Return the bounding box and WCS of the coadd saved with a checkpoint,
+    without reading its pixels
+
+    Returns
+    -------
+    bbox : `lsst.afw.geom.Box2I`
+        Bounding box of the coadd in parent coordinates.
+    wcs : `lsst.afw.geom.SkyWcs` or `None`
+        WCS of the coadd.
+    """
+    if "planes" in manifest:
+        minX, minY, width, height = manifest["bbox"]
+        bbox = afwGeom.Box2I(afwGeom.Point2I(minX, minY), afwGeom.Extent2I(width, height))
+        wcsPath = os.path.join(checkpointDir, manifest["wcs"])
+        ExposureClass = afwImage.ExposureF
+    else:
+        wcsPath = os.path.join(checkpointDir, manifest["coadd"])
+        bbox = afwImage.bboxFromMetadata(afwImage.readMetadata(wcsPath))
+        ExposureClass = afwImage.ExposureD if manifest["doubleAccumulator"] else afwImage.ExposureF
+    # read a single pixel for the WCS, which may be None
+    wcs = ExposureClass(wcsPath, bbox=afwGeom.Box2I(bbox.getMin(), afwGeom.Extent2I(1, 1)),
+                        origin=afwImage.PARENT).getWcs()
+    return bbox, wcs
+
+
+def _writeCheckpoint(checkpointDir, generation, writePixels, state, arrays):
+    """Write a checkpoint; called by a background thread
+
+    The files of each checkpoint have distinct names; the manifest that
+    names them is replaced atomically once they are written, then the files
+    of older checkpoints are removed.
+    """
+    manifest = dict(state, generation=generation)
+    manifest.update(writePixels())
+    if arrays:
+        manifest["arrays"] = "arrays-%d.npz" % (generation,)
+        np.savez(os.path.join(checkpointDir, manifest["arrays"]), **arrays)
+
+    manifestPath = os.path.join(checkpointDir, _CheckpointManifestName)
+    with open(manifestPath + ".tmp", "w") as outfile:
+        json.dump(manifest, outfile)
+    os.replace(manifestPath + ".tmp", manifestPath)
+
+    for name in os.listdir(checkpointDir):
+        match = _CheckpointFileRegex.match(name)
+        if match and int(match.group(2)) != generation:
+            os.remove(os.path.join(checkpointDir, name))
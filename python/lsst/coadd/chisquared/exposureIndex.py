@@ -0,0 +1,250 @@
+#
+# LSST Data Management System
+# Copyright 2008-2018 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Persistent spatial index of the sky footprints of input exposures
+
+The index is an SQLite database. For each exposure it records the path,
+modification time and size of the file and points sampled along its outline
+on the sky. An R-tree holds, for each exposure, a box in 3-d unit vector
+space that contains its footprint. So a query only examines exposures whose
+box intersects that of the coadd, then applies the same test as
+`lsst.coadd.chisquared.footprint.filterOverlapping` to those.
+"""
+import json
+import math
+import os
+import sqlite3
+
+import lsst.afw.geom as afwGeom
+from . footprint import getSkyOutline, readExposureFootprint, skyOutlineOverlapsCoadd
+
+__all__ = ["ExposureIndex"]
+
+
+class ExposureIndex:
+    """On-disk spatial index of the sky footprints of exposures
+
+    Parameters
+    ----------
+    indexPath : `str`
+        Path to the index database; created if it does not exist.
+    subframeBBox : `lsst.afw.geom.Box2I`, optional
+        Bounding box, in LOCAL coordinates, to which exposures will be
+        subframed when they are read; None or empty for whole exposures.
+        It must match the value used to create the index.
+    numSamples : `int`, optional
+        Number of intervals into which each edge of an exposure is sampled.
+
+    Raises
+    ------
+    ValueError
+        If ``subframeBBox`` does not match the one the index was created with.
+    """
+
+    def __init__(self, indexPath, subframeBBox=None, numSamples=8):
+        if subframeBBox is not None and subframeBBox.isEmpty():
+            subframeBBox = None
+        self._subframeBBox = subframeBBox
+        self._numSamples = numSamples
+        self._connection = sqlite3.connect(indexPath)
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS exposures (id INTEGER PRIMARY KEY, path TEXT UNIQUE NOT NULL, "
+                "mtime REAL NOT NULL, size INTEGER NOT NULL, outline TEXT)")
+            self._connection.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS footprints USING rtree(id, minX, maxX, minY, maxY, "
+                "minZ, maxZ)")
+            subframe = json.dumps(None if subframeBBox is None else
+                                  [subframeBBox.getMinX(), subframeBBox.getMinY(),
+                                   subframeBBox.getWidth(), subframeBBox.getHeight()])
+            row = self._connection.execute("SELECT value FROM metadata WHERE key = 'subframe'").fetchone()
+            if row is None:
+                self._connection.execute("INSERT INTO metadata (key, value) VALUES ('subframe', ?)",
+                                         (subframe,))
+            elif row[0] != subframe:
+                raise ValueError("Index %r was made with subframe %s, not %s" % (indexPath, row[0], subframe))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self._connection.execute("SELECT COUNT(*) FROM exposures").fetchone()[0]
+
+    def close(self):
+        """Close the index database
+        """
+        self._connection.close()
+
+    def update(self, exposurePathList):
+        """Add exposures to the index, or update them if their files changed
+
+        Only exposures whose file is new, or whose modification time or size
+        changed, have their header read. Exposures whose file no longer
+        exists are removed. Exposures whose header cannot be read are
+        recorded without a footprint and are returned by every query, so
+        that reading the exposure reports the failure.
+
+        Parameters
+        ----------
+        exposurePathList : `list` of `str`
+            Paths to exposures; they are recorded as absolute paths.
+
+        Returns
+        -------
+        numRead : `int`
+            Number of exposure headers read.
+        """
+        numRead = 0
+        with self._connection:
+            for exposurePath in exposurePathList:
+                exposurePath = os.path.abspath(exposurePath)
+                row = self._connection.execute("SELECT id, mtime, size FROM exposures WHERE path = ?",
+                                               (exposurePath,)).fetchone()
+                try:
+                    stat = os.stat(exposurePath)
+                except FileNotFoundError:
+                    if row is not None:
+                        self._remove(row[0])
+                    continue
+                if row is not None and row[1] == stat.st_mtime and row[2] == stat.st_size:
+                    continue
+
+                try:
+                    wcs, bbox = readExposureFootprint(exposurePath, subframeBBox=self._subframeBBox)
+                    skyOutline = getSkyOutline(wcs, bbox, numSamples=self._numSamples)
+                    outline = [(point.getLongitude().asDegrees(), point.getLatitude().asDegrees())
+                               for point in skyOutline]
+                except Exception:
+                    outline = None
+                numRead += 1
+
+                outlineStr = None if outline is None else json.dumps(outline)
+                if row is None:
+                    exposureId = self._connection.execute(
+                        "INSERT INTO exposures (path, mtime, size, outline) VALUES (?, ?, ?, ?)",
+                        (exposurePath, stat.st_mtime, stat.st_size, outlineStr)).lastrowid
+                else:
+                    exposureId = row[0]
+                    self._connection.execute(
+                        "UPDATE exposures SET mtime = ?, size = ?, outline = ? WHERE id = ?",
+                        (stat.st_mtime, stat.st_size, outlineStr, exposureId))
+                    self._connection.execute("DELETE FROM footprints WHERE id = ?", (exposureId,))
+                if outline is not None:
+                    self._connection.execute(
+                        "INSERT INTO footprints (id, minX, maxX, minY, maxY, minZ, maxZ) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (exposureId,) + _getCapBox(outline, padding=0.0, numSamples=self._numSamples))
+        return numRead
+
+    def query(self, coaddWcs, coaddBBox, padding=0):
+        """Return the exposures that may overlap a coadd
+
+        Parameters
+        ----------
+        coaddWcs : `lsst.afw.geom.SkyWcs`
+            WCS of the coadd.
+        coaddBBox : `lsst.afw.geom.Box2I`
+            Bounding box of the coadd in parent coordinates.
+        padding : `int`, optional
+            Number of coadd pixels by which to grow each exposure footprint,
+            e.g. to allow for the size of the warping kernel.
+
+        Returns
+        -------
+        exposurePathList : `list` of `str`
+            Absolute paths of the exposures that may overlap the coadd,
+            in the order in which they were added to the index.
+        """
+        coaddCenter = afwGeom.Box2D(coaddBBox).getCenter()
+        pixelScale = coaddWcs.getPixelScale(coaddCenter).asDegrees()
+        coaddOutline = [(point.getLongitude().asDegrees(), point.getLatitude().asDegrees())
+                        for point in getSkyOutline(coaddWcs, coaddBBox, numSamples=self._numSamples)]
+        box = _getCapBox(coaddOutline, padding=(padding + 1) * pixelScale, numSamples=self._numSamples)
+
+        rows = self._connection.execute(
+            "SELECT exposures.id, path, outline FROM exposures "
+            "JOIN footprints ON exposures.id = footprints.id "
+            "WHERE maxX >= ? AND minX <= ? AND maxY >= ? AND minY <= ? AND maxZ >= ? AND minZ <= ? "
+            "UNION ALL SELECT id, path, outline FROM exposures WHERE outline IS NULL ORDER BY 1",
+            (box[0], box[1], box[2], box[3], box[4], box[5])).fetchall()
+
+        exposurePathList = []
+        for exposureId, exposurePath, outline in rows:
+            if outline is not None:
+                skyOutline = [afwGeom.SpherePoint(ra, dec, afwGeom.degrees)
+                              for ra, dec in json.loads(outline)]
+                if not skyOutlineOverlapsCoadd(skyOutline, coaddWcs, coaddBBox, padding=padding):
+                    continue
+            exposurePathList.append(exposurePath)
+        return exposurePathList
+
+    def _remove(self, exposureId):
+        """Remove an exposure from the index
+        """
+        self._connection.execute("DELETE FROM footprints WHERE id = ?", (exposureId,))
+        self._connection.execute("DELETE FROM exposures WHERE id = ?", (exposureId,))
+
+
+def _getCapBox(outline, padding, numSamples):
+    """Return a box in unit vector space that contains a region of the sky
+
+    The region is assumed to be smaller than a hemisphere. It is contained
+    in the cap centred on the mean direction of its outline whose radius is
+    the largest distance to a point of the outline; the radius is enlarged
+    by 1/numSamples to allow for the outline bulging between points, plus
+    ``padding``. The returned box is that of the cap.
+
+    Parameters
+    ----------
+    outline : `list` of `tuple` of `float`
+        (RA, Dec) in degrees of points along the outline of the region.
+    padding : `float`
+        Angle by which to enlarge the cap (degrees).
+    numSamples : `int`
+        Number of intervals into which each edge was sampled.
+
+    Returns
+    -------
+    box : `tuple` of `float`
+        minX, maxX, minY, maxY, minZ, maxZ
+    """
+    vectors = []
+    for ra, dec in outline:
+        ra, dec = math.radians(ra), math.radians(dec)
+        vectors.append((math.cos(dec) * math.cos(ra), math.cos(dec) * math.sin(ra), math.sin(dec)))
+    center = [sum(vector[k] for vector in vectors) for k in range(3)]
+    norm = math.sqrt(sum(value**2 for value in center))
+    center = [value / norm for value in center]
+    radius = max(math.acos(max(-1.0, min(1.0, sum(c * v for c, v in zip(center, vector)))))
+                 for vector in vectors)
+    radius = min(math.pi, radius * (1.0 + 1.0 / numSamples) + math.radians(padding))
+
+    box = []
+    for k in range(3):
+        # angle between the cap centre and axis k, and the range of angles within the cap
+        angle = math.acos(max(-1.0, min(1.0, center[k])))
+        box += [math.cos(min(math.pi, angle + radius)), math.cos(max(0.0, angle - radius))]
+    return tuple(box)
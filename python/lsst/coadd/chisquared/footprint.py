@@ -0,0 +1,295 @@
+#
+# LSST Data Management System
+# Copyright 2008-2018 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Footprints of input exposures, computed from their FITS headers
+
+These let coadd drivers decide which exposures overlap a coadd before
+reading any pixels.
+"""
+import math
+
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.afw.math as afwMath
+
+__all__ = ["readExposureFootprint", "getSkyOutline", "projectSkyOutline", "projectFootprint",
+           "skyOutlineOverlapsCoadd", "footprintOverlapsCoadd", "filterOverlapping", "getInputBBox",
+           "getWarpingPadding"]
+
+
+def readExposureFootprint(exposurePath, subframeBBox=None):
+    """Read the WCS and parent bounding box of an exposure from its header
+
+    Parameters
+    ----------
+    exposurePath : `str`
+        Path to the exposure.
+    subframeBBox : `lsst.afw.geom.Box2I`, optional
+        Bounding box, in LOCAL coordinates, to which the exposure will be
+        subframed when it is read; None or empty for the whole exposure.
+
+    Returns
+    -------
+    wcs : `lsst.afw.geom.SkyWcs`
+        WCS of the exposure.
+    bbox : `lsst.afw.geom.Box2I`
+        Bounding box of the (subframed) exposure in parent coordinates.
+    """
+    metadata = afwImage.readMetadata(exposurePath)
+    bbox = afwImage.bboxFromMetadata(metadata)
+    wcs = afwGeom.makeSkyWcs(metadata, strip=False)
+    if subframeBBox is not None and not subframeBBox.isEmpty():
+        bbox = afwGeom.Box2I(bbox.getMin() + afwGeom.Extent2I(subframeBBox.getMin()),
+                             subframeBBox.getDimensions())
+    return wcs, bbox
+
+
+def getSkyOutline(wcs, bbox, numSamples=8):
+    """Return points sampled along the outline of an exposure, on the sky
+
+    Parameters
+    ----------
+    wcs : `lsst.afw.geom.SkyWcs`
+        WCS of the exposure.
+    bbox : `lsst.afw.geom.Box2I`
+        Bounding box of the exposure in parent coordinates.
+    numSamples : `int`, optional
+        Number of intervals into which each edge is divided.
+
+    Returns
+    -------
+    skyOutline : `list` of `lsst.afw.geom.SpherePoint`
+        Sky positions of 4 * numSamples points along the edges of ``bbox``.
+    """
+    box = afwGeom.Box2D(bbox)
+    xList = [box.getMinX() + (box.getMaxX() - box.getMinX()) * i / float(numSamples)
+             for i in range(numSamples + 1)]
+    yList = [box.getMinY() + (box.getMaxY() - box.getMinY()) * i / float(numSamples)
+             for i in range(numSamples + 1)]
+    pointList = [afwGeom.Point2D(x, y) for x in xList for y in (box.getMinY(), box.getMaxY())] + \
+        [afwGeom.Point2D(x, y) for x in (box.getMinX(), box.getMaxX()) for y in yList[1:-1]]
+    return [wcs.pixelToSky(point) for point in pointList]
+
+
+def projectSkyOutline(skyOutline, coaddWcs):
+    """Return the bounding box of a sky outline on the pixel grid of a coadd
+
+    Parameters
+    ----------
+    skyOutline : `list` of `lsst.afw.geom.SpherePoint`
+        Points along the outline of an exposure; see `getSkyOutline`.
+    coaddWcs : `lsst.afw.geom.SkyWcs`
+        WCS of the coadd.
+
+    Returns
+    -------
+    coaddBox : `lsst.afw.geom.Box2D` or `None`
+        Bounding box of the projected outline in coadd pixels, or `None` if
+        some point does not project to a finite position (e.g. it is on the
+        far side of the coadd projection).
+    """
+    coaddBox = afwGeom.Box2D()
+    for skyPoint in skyOutline:
+        coaddPoint = coaddWcs.skyToPixel(skyPoint)
+        if not (math.isfinite(coaddPoint.getX()) and math.isfinite(coaddPoint.getY())):
+            return None
+        coaddBox.include(coaddPoint)
+    return coaddBox
+
+
+def projectFootprint(wcs, bbox, coaddWcs, numSamples=8):
+    """Project the outline of an exposure onto the pixel grid of a coadd
+
+    Points are sampled along the edges of ``bbox``, so the result follows
+    distortion of the outline, and the bounding box of the projected points
+    is returned.
+
+    Parameters
+    ----------
+    wcs : `lsst.afw.geom.SkyWcs`
+        WCS of the exposure.
+    bbox : `lsst.afw.geom.Box2I`
+        Bounding box of the exposure in parent coordinates.
+    coaddWcs : `lsst.afw.geom.SkyWcs`
+        WCS of the coadd.
+    numSamples : `int`, optional
+        Number of intervals into which each edge is divided.
+
+    Returns
+    -------
+    coaddBox : `lsst.afw.geom.Box2D` or `None`
+        Bounding box of the projected outline in coadd pixels, or `None` if
+        some point does not project to a finite position.
+    """
+    return projectSkyOutline(getSkyOutline(wcs, bbox, numSamples=numSamples), coaddWcs)
+
+
+def skyOutlineOverlapsCoadd(skyOutline, coaddWcs, coaddBBox, padding=0):
+    """Return True if an exposure, given by its sky outline, may overlap
+    a coadd
+
+    Parameters
+    ----------
+    skyOutline : `list` of `lsst.afw.geom.SpherePoint`
+        Points along the outline of the exposure; see `getSkyOutline`.
+    coaddWcs : `lsst.afw.geom.SkyWcs`
+        WCS of the coadd.
+    coaddBBox : `lsst.afw.geom.Box2I`
+        Bounding box of the coadd in parent coordinates.
+    padding : `int`, optional
+        Number of coadd pixels by which to grow the projected footprint.
+
+    Returns
+    -------
+    overlaps : `bool`
+        False if the exposure certainly does not overlap the coadd; True if
+        it does, or if its footprint cannot be projected.
+    """
+    coaddBox = projectSkyOutline(skyOutline, coaddWcs)
+    if coaddBox is None:
+        return True
+    coaddBox.grow(padding + 1)
+    return coaddBox.overlaps(afwGeom.Box2D(coaddBBox))
+
+
+def footprintOverlapsCoadd(wcs, bbox, coaddWcs, coaddBBox, padding=0, numSamples=8):
+    """Return True if an exposure may overlap a coadd
+
+    Parameters
+    ----------
+    wcs : `lsst.afw.geom.SkyWcs`
+        WCS of the exposure.
+    bbox : `lsst.afw.geom.Box2I`
+        Bounding box of the exposure in parent coordinates.
+    coaddWcs : `lsst.afw.geom.SkyWcs`
+        WCS of the coadd.
+    coaddBBox : `lsst.afw.geom.Box2I`
+        Bounding box of the coadd in parent coordinates.
+    padding : `int`, optional
+        Number of coadd pixels by which to grow the projected footprint,
+        e.g. to allow for the size of the warping kernel.
+    numSamples : `int`, optional
+        Number of intervals into which each edge is sampled.
+
+    Returns
+    -------
+    overlaps : `bool`
+        False if the exposure certainly does not overlap the coadd; True if
+        it does, or if its footprint cannot be projected.
+    """
+    return skyOutlineOverlapsCoadd(getSkyOutline(wcs, bbox, numSamples=numSamples), coaddWcs, coaddBBox,
+                                   padding=padding)
+
+
+def filterOverlapping(exposurePathList, coaddWcs, coaddBBox, subframeBBox=None, padding=0):
+    """Split a list of exposures into those that may overlap a coadd and
+    those that do not, reading only FITS headers
+
+    Parameters
+    ----------
+    exposurePathList : `list` of `str`
+        Paths to exposures.
+    coaddWcs : `lsst.afw.geom.SkyWcs`
+        WCS of the coadd.
+    coaddBBox : `lsst.afw.geom.Box2I`
+        Bounding box of the coadd in parent coordinates.
+    subframeBBox : `lsst.afw.geom.Box2I`, optional
+        Bounding box, in LOCAL coordinates, to which exposures will be
+        subframed when they are read; None or empty for whole exposures.
+    padding : `int`, optional
+        Number of coadd pixels by which to grow each projected footprint.
+
+    Returns
+    -------
+    overlapping : `list` of `str`
+        Paths of exposures that may overlap the coadd, including any whose
+        header cannot be read (reading the pixels will report the failure).
+    skipped : `list` of `str`
+        Paths of exposures that do not overlap the coadd.
+    """
+    overlapping = []
+    skipped = []
+    for exposurePath in exposurePathList:
+        try:
+            wcs, bbox = readExposureFootprint(exposurePath, subframeBBox=subframeBBox)
+        except Exception:
+            overlapping.append(exposurePath)
+            continue
+        if footprintOverlapsCoadd(wcs, bbox, coaddWcs, coaddBBox, padding=padding):
+            overlapping.append(exposurePath)
+        else:
+            skipped.append(exposurePath)
+    return overlapping, skipped
+
+
+def getInputBBox(wcs, bbox, coaddWcs, coaddBBox, padding=0, numSamples=8):
+    """Return the part of an exposure that can contribute to a coadd
+
+    Points are sampled along the edges of the coadd and projected onto the
+    pixel grid of the exposure; the bounding box of those points, grown by
+    ``padding`` and clipped to the exposure, contains every input pixel
+    that warping can map into the coadd.
+
+    Parameters
+    ----------
+    wcs : `lsst.afw.geom.SkyWcs`
+        WCS of the exposure.
+    bbox : `lsst.afw.geom.Box2I`
+        Bounding box of the exposure in parent coordinates.
+    coaddWcs : `lsst.afw.geom.SkyWcs`
+        WCS of the coadd.
+    coaddBBox : `lsst.afw.geom.Box2I`
+        Bounding box of the coadd in parent coordinates.
+    padding : `int`, optional
+        Number of exposure pixels by which to grow the projected coadd,
+        e.g. to allow for the size of the warping kernel.
+    numSamples : `int`, optional
+        Number of intervals into which each edge of the coadd is sampled.
+
+    Returns
+    -------
+    inputBBox : `lsst.afw.geom.Box2I`
+        Bounding box of the needed pixels in parent coordinates; empty if
+        the exposure does not overlap the coadd, and ``bbox`` if the coadd
+        cannot be projected onto the exposure.
+    """
+    coaddOutline = getSkyOutline(coaddWcs, coaddBBox, numSamples=numSamples)
+    inputBox = projectSkyOutline(coaddOutline, wcs)
+    if inputBox is None:
+        return afwGeom.Box2I(bbox)
+    # allow for the outline bulging between the sampled points
+    inputBox.grow(padding + 1)
+    inputBBox = afwGeom.Box2I(inputBox, afwGeom.Box2I.EXPAND)
+    inputBBox.clip(bbox)
+    return inputBBox
+
+
+def getWarpingPadding(warpConfig):
+    """Return the number of pixels by which the warping kernel reaches
+    beyond a pixel
+
+    Parameters
+    ----------
+    warpConfig : `lsst.afw.math.Warper.ConfigClass`
+        Warper config.
+    """
+    kernel = afwMath.Warper.fromConfig(warpConfig).getWarpingKernel()
+    return max(kernel.getWidth(), kernel.getHeight())
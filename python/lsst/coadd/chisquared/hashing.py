@@ -0,0 +1,52 @@
+#
+# LSST Data Management System
+# Copyright 2008-2018 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Hashes of image contents, used to identify exposures by their pixels
+"""
+import hashlib
+
+import numpy as np
+
+__all__ = ["hashMaskedImage"]
+
+
+def hashMaskedImage(maskedImage):
+    """Return a hash of the contents of a masked image
+
+    Parameters
+    ----------
+    maskedImage : `lsst.afw.image.MaskedImage`
+        Masked image.
+
+    Returns
+    -------
+    hash : `str`
+        SHA-256 hex digest of the bounding box and the image, mask and
+        variance pixels.
+    """
+    bbox = maskedImage.getBBox()
+    hasher = hashlib.sha256(("%d,%d,%d,%d" % (bbox.getMinX(), bbox.getMinY(),
+                                              bbox.getWidth(), bbox.getHeight())).encode())
+    for array in (maskedImage.getImage().getArray(), maskedImage.getMask().getArray(),
+                  maskedImage.getVariance().getArray()):
+        hasher.update(array.dtype.str.encode())
+        hasher.update(np.ascontiguousarray(array).data)
+    return hasher.hexdigest()
@@ -0,0 +1,544 @@
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Streaming histogram of a chi-squared coadd, for quality assessment
+
+A chi-squared coadd of N exposures of pure noise, multiplied by N (the
+weight map value when every exposure has weight 1), follows a chi-squared
+distribution with N degrees of freedom. `ChiSquaredHistogram` accumulates
+the histogram of those values, and counts of the pixels that cannot be
+compared with the distribution, one chunk of rows at a time, so memory use
+does not depend on the size of the coadd.
+
+Where coverage varies, `OrderHistograms` keeps a histogram for every order
+(weight map value) and `fitDegreesOfFreedom` fits the effective number of
+degrees of freedom of each, to check that the noise model holds at every
+depth.
+"""
+import math
+
+import numpy as np
+from astropy.io import fits
+
+__all__ = ["ChiSquaredHistogram", "OrderHistograms", "fitDegreesOfFreedom"]
+
+
+class ChiSquaredHistogram:
+    """Histogram of the pixels of a chi-squared coadd of a given order
+
+    Pixels whose weight map value is the order of the coadd are
+    un-normalized (multiplied by the order) and histogrammed in ``numBins``
+    equal bins from 0 to ``maxValue``. Other pixels are counted as having the
+    wrong order; in-order pixels that are not finite, or are at least
+    ``maxValue`` (clearly not noise), are counted separately.
+
+    Parameters
+    ----------
+    numBins : `int`, optional
+        Number of bins.
+    maxValue : `float`, optional
+        Upper limit of the histogram.
+    order : `int`, optional
+        Order of the coadd (the weight map value of fully covered pixels).
+        If None, the maximum of the weight map is used; pixels counted before
+        a larger maximum is seen are then recounted as having the wrong order.
+
+    Raises
+    ------
+    ValueError
+        If ``numBins`` < 1 or ``maxValue`` <= 0.
+    """
+
+    def __init__(self, numBins=500, maxValue=50.0, order=None):
+        if numBins < 1:
+            raise ValueError("numBins = %s < 1" % (numBins,))
+        if maxValue <= 0:
+            raise ValueError("maxValue = %s <= 0" % (maxValue,))
+        self._numBins = numBins
+        self._maxValue = float(maxValue)
+        self._fixedOrder = order is not None
+        self._order = order
+        self._numPixels = 0
+        self._resetCounts()
+
+    @classmethod
+    def fromFits(cls, coaddPath, weightMapPath, numBins=500, maxValue=50.0, order=None, chunkRows=256):
+        """Compute the histogram of a coadd and weight map in FITS files
+
+        The files are memory mapped and read ``chunkRows`` rows at a time.
+
+        Parameters
+        ----------
+        coaddPath : `str`
+            Path to the coadd; the image is the primary HDU or, if that is
+            empty (as for an LSST exposure), the first extension.
+        weightMapPath : `str`
+            Path to the weight map.
+        numBins, maxValue, order
+            See `ChiSquaredHistogram`.
+        chunkRows : `int`, optional
+            Number of rows read at a time.
+
+        Returns
+        -------
+        histogram : `ChiSquaredHistogram`
+
+        Raises
+        ------
+        RuntimeError
+            If the coadd and weight map have different shapes.
+        ValueError
+            If ``chunkRows`` < 1.
+        """
+        histogram = cls(numBins=numBins, maxValue=maxValue, order=order)
+        for coaddChunk, weightMapChunk in _readChunks(coaddPath, weightMapPath, chunkRows):
+            histogram.update(coaddChunk, weightMapChunk)
+        return histogram
+
+    def update(self, coaddArray, weightMapArray):
+        """Add a chunk of a coadd to the histogram
+
+        Parameters
+        ----------
+        coaddArray : `numpy.ndarray`
+            Pixels of the coadd (normalized by the weight map).
+        weightMapArray : `numpy.ndarray`
+            Corresponding pixels of the weight map.
+        """
+        self._numPixels += coaddArray.size
+        if coaddArray.size == 0:
+            return
+        if not self._fixedOrder:
+            chunkOrder = weightMapArray.max()
+            if self._order is None or chunkOrder > self._order:
+                self._order = chunkOrder
+                self._resetCounts()
+        isInOrder = weightMapArray == self._order
+        values = coaddArray[isInOrder].astype(np.float64)
+        self._numInOrder += values.size
+        isFinite = np.isfinite(values)
+        values = values[isFinite]
+        self._numNonFinite += isFinite.size - values.size
+        values *= float(self._order)
+        isSmall = values < self._maxValue
+        self._numLarge += values.size - np.count_nonzero(isSmall)
+        binIndices = (values[isSmall] * (self._numBins / self._maxValue)).astype(np.intp)
+        np.clip(binIndices, 0, self._numBins - 1, out=binIndices)
+        self._counts += np.bincount(binIndices, minlength=self._numBins)
+
+    def getOrder(self):
+        """Return the order of the coadd, or None if not yet known
+        """
+        return self._order
+
+    def getBinEdges(self):
+        """Return the numBins + 1 bin edges
+        """
+        return np.linspace(0.0, self._maxValue, self._numBins + 1)
+
+    def getCounts(self):
+        """Return a copy of the number of pixels in each bin
+        """
+        return self._counts.copy()
+
+    def getNumPixels(self):
+        """Return the number of pixels seen
+        """
+        return self._numPixels
+
+    def getNumGood(self):
+        """Return the number of pixels in the histogram
+        """
+        return int(self._counts.sum())
+
+    def getNumWrongOrder(self):
+        """Return the number of pixels whose weight is not the order
+        """
+        return self._numPixels - self._numInOrder
+
+    def getNumNonFinite(self):
+        """Return the number of pixels of the right order that are not finite
+        """
+        return self._numNonFinite
+
+    def getNumLarge(self):
+        """Return the number of finite pixels of the right order that are
+        too large for the histogram
+        """
+        return self._numLarge
+
+    def getExpected(self, orderOffset=0.0):
+        """Return the chi-squared distribution, scaled to match the histogram
+
+        The chi-squared probability density is evaluated at the bin centres
+        and scaled to match the histogram between half the peak and the peak
+        of the density, where the data is least affected by non-noise pixels.
+
+        Parameters
+        ----------
+        orderOffset : `float`, optional
+            Amount to add to the order for the number of degrees of freedom.
+
+        Returns
+        -------
+        expected : `numpy.ndarray`
+            Expected counts in each bin.
+
+        Raises
+        ------
+        RuntimeError
+            If no pixel of the right order has been seen.
+        """
+        if self._order is None or self.getNumGood() == 0:
+            raise RuntimeError("No pixels in the histogram")
+        dof = float(self._order) + orderOffset
+        binEdges = self.getBinEdges()
+        x = 0.5 * (binEdges[:-1] + binEdges[1:])
+        logDensity = (dof / 2.0 - 1.0) * np.log(x) - x / 2.0
+        expected = np.exp(logDensity - logDensity.max())
+
+        endInd = max(1, int(expected.argmax()))
+        startInd = endInd // 2
+        dataSum = self._counts[startInd:endInd].sum()
+        expectedSum = expected[startInd:endInd].sum()
+        if dataSum == 0 or expectedSum == 0:
+            return expected * (self.getNumGood() / expected.sum())
+        return expected * (dataSum / expectedSum)
+
+    def formatSummary(self):
+        """Return a one-line summary of the pixel counts
+        """
+        numPixels = max(self._numPixels, 1)
+        return ("ChiSquared order = %s; %d good pixels; %0.1f%% had wrong order; "
+                "%0.1f%% were not finite; %0.1f%% >= %g" %
+                (self._order, self.getNumGood(), self.getNumWrongOrder() * 100.0 / numPixels,
+                 self._numNonFinite * 100.0 / numPixels, self._numLarge * 100.0 / numPixels,
+                 self._maxValue))
+
+    def _resetCounts(self):
+        """Reset the counts of pixels of the right order
+        """
+        self._counts = np.zeros(self._numBins, dtype=np.int64)
+        self._numInOrder = 0
+        self._numNonFinite = 0
+        self._numLarge = 0
+
+
+class OrderHistograms:
+    """Histograms of the pixels of a chi-squared coadd, one for each order
+
+    The order of a pixel is its weight map value, which must be a positive
+    integer (as it is when every exposure is added with weight 1); other
+    pixels, including uncovered ones, are only counted. Each chunk is
+    histogrammed for all orders at once, with a single `numpy.bincount`
+    over combined order and bin indices.
+
+    Parameters
+    ----------
+    numBins : `int`, optional
+        Number of bins.
+    maxValue : `float`, optional
+        Upper limit of the histograms; un-normalized values at or above it
+        are counted as large.
+
+    Raises
+    ------
+    ValueError
+        If ``numBins`` < 1 or ``maxValue`` <= 0.
+    """
+
+    def __init__(self, numBins=500, maxValue=50.0):
+        if numBins < 1:
+            raise ValueError("numBins = %s < 1" % (numBins,))
+        if maxValue <= 0:
+            raise ValueError("maxValue = %s <= 0" % (maxValue,))
+        self._numBins = numBins
+        self._maxValue = float(maxValue)
+        self._numPixels = 0
+        self._numOtherWeight = 0
+        # row i is for order i; row 0 is never used
+        self._counts = np.zeros((1, numBins), dtype=np.int64)
+        self._numNonFinite = np.zeros(1, dtype=np.int64)
+        self._numLarge = np.zeros(1, dtype=np.int64)
+
+    @classmethod
+    def fromFits(cls, coaddPath, weightMapPath, numBins=500, maxValue=50.0, chunkRows=256):
+        """Compute the per-order histograms of a coadd and weight map in
+        FITS files, reading ``chunkRows`` rows at a time
+
+        See `ChiSquaredHistogram.fromFits` for the parameters.
+
+        Returns
+        -------
+        histograms : `OrderHistograms`
+        """
+        histograms = cls(numBins=numBins, maxValue=maxValue)
+        for coaddChunk, weightMapChunk in _readChunks(coaddPath, weightMapPath, chunkRows):
+            histograms.update(coaddChunk, weightMapChunk)
+        return histograms
+
+    def update(self, coaddArray, weightMapArray):
+        """Add a chunk of a coadd to the histograms
+
+        Parameters
+        ----------
+        coaddArray : `numpy.ndarray`
+            Pixels of the coadd (normalized by the weight map).
+        weightMapArray : `numpy.ndarray`
+            Corresponding pixels of the weight map.
+        """
+        weights = np.ravel(weightMapArray)
+        self._numPixels += weights.size
+        isOrder = (weights >= 1) & (weights == np.floor(weights))
+        orders = weights[isOrder].astype(np.intp)
+        self._numOtherWeight += weights.size - orders.size
+        if orders.size == 0:
+            return
+        self._reserve(int(orders.max()))
+        numOrders = len(self._numNonFinite)
+
+        values = np.ravel(coaddArray)[isOrder].astype(np.float64)
+        values *= orders
+        isFinite = np.isfinite(values)
+        self._numNonFinite += np.bincount(orders[~isFinite], minlength=numOrders)
+        values = values[isFinite]
+        orders = orders[isFinite]
+        isSmall = values < self._maxValue
+        self._numLarge += np.bincount(orders[~isSmall], minlength=numOrders)
+
+        indices = (values[isSmall] * (self._numBins / self._maxValue)).astype(np.intp)
+        np.clip(indices, 0, self._numBins - 1, out=indices)
+        indices += orders[isSmall] * self._numBins
+        self._counts += np.bincount(indices, minlength=self._counts.size).reshape(self._counts.shape)
+
+    def getOrders(self):
+        """Return the orders that have at least one pixel, in increasing
+        order
+        """
+        numPixels = self._counts.sum(axis=1) + self._numNonFinite + self._numLarge
+        return [int(order) for order in np.flatnonzero(numPixels) if order > 0]
+
+    def getBinEdges(self):
+        """Return the numBins + 1 bin edges
+        """
+        return np.linspace(0.0, self._maxValue, self._numBins + 1)
+
+    def getCounts(self, order):
+        """Return a copy of the number of pixels of an order in each bin
+        """
+        if order < 1 or order >= len(self._counts):
+            return np.zeros(self._numBins, dtype=np.int64)
+        return self._counts[order].copy()
+
+    def getNumPixels(self):
+        """Return the number of pixels seen
+        """
+        return self._numPixels
+
+    def getNumOtherWeight(self):
+        """Return the number of pixels whose weight is not a positive integer
+        """
+        return self._numOtherWeight
+
+    def getNumNonFinite(self, order):
+        """Return the number of pixels of an order that are not finite
+        """
+        return int(self._numNonFinite[order]) if 0 < order < len(self._numNonFinite) else 0
+
+    def getNumLarge(self, order):
+        """Return the number of finite pixels of an order that are too large
+        for the histogram
+        """
+        return int(self._numLarge[order]) if 0 < order < len(self._numLarge) else 0
+
+    def fitDegreesOfFreedom(self, minCount=100):
+        """Fit the effective number of degrees of freedom of every order
+
+        Parameters
+        ----------
+        minCount : `int`, optional
+            Minimum number of pixels in the histogram of an order for it to
+            be fit.
+
+        Returns
+        -------
+        dofDict : `dict` of `int`: `float`
+            Fitted degrees of freedom by order, NaN for orders with fewer
+            than ``minCount`` pixels in the histogram; see
+            `fitDegreesOfFreedom`.
+        """
+        orders = self.getOrders()
+        counts = self._counts[orders]
+        dofArray = fitDegreesOfFreedom(counts, self.getBinEdges())
+        dofArray[counts.sum(axis=1) < minCount] = np.nan
+        return dict(zip(orders, dofArray.tolist()))
+
+    def formatSummary(self, minCount=100):
+        """Return a table of pixel counts and fitted degrees of freedom,
+        one line per order
+        """
+        dofDict = self.fitDegreesOfFreedom(minCount=minCount)
+        lines = ["%6s %12s %10s %10s %10s" % ("order", "numGood", "nonFinite", "large", "fitDof")]
+        for order in self.getOrders():
+            lines.append("%6d %12d %10d %10d %10.3f" %
+                         (order, self._counts[order].sum(), self._numNonFinite[order],
+                          self._numLarge[order], dofDict[order]))
+        lines.append("%d of %d pixels have a weight that is not a positive integer" %
+                     (self._numOtherWeight, self._numPixels))
+        return "\n".join(lines)
+
+    def _reserve(self, maxOrder):
+        """Grow the per-order arrays to hold orders up to maxOrder
+        """
+        numOrders = len(self._numNonFinite)
+        if maxOrder < numOrders:
+            return
+        numNew = maxOrder + 1 - numOrders
+        self._counts = np.concatenate([self._counts, np.zeros((numNew, self._numBins), dtype=np.int64)])
+        self._numNonFinite = np.concatenate([self._numNonFinite, np.zeros(numNew, dtype=np.int64)])
+        self._numLarge = np.concatenate([self._numLarge, np.zeros(numNew, dtype=np.int64)])
+
+
+def fitDegreesOfFreedom(counts, binEdges, minDof=0.5, maxDof=None, tolerance=1e-4):
+    """Fit chi-squared distributions to histograms by binned maximum
+    likelihood
+
+    The model probability of each bin is the chi-squared probability of the
+    bin, normalized over the whole histogram (so values beyond the last
+    edge, which are not in the histogram, do not bias the fit). Bin
+    probabilities are integrated with Gauss-Legendre quadrature in
+    u = sqrt(x), which removes the singularity of the density at 0 for
+    fewer than 2 degrees of freedom; a narrow bin that starts at 0 is
+    integrated with a power series, which is also exact for fewer than 1.
+    All histograms are fit together, by a golden section search on the log
+    likelihood.
+
+    Parameters
+    ----------
+    counts : `numpy.ndarray`
+        Histograms, one per row (or a single 1-d histogram).
+    binEdges : `numpy.ndarray`
+        Bin edges shared by all histograms; must be >= 0.
+    minDof, maxDof : `float`, optional
+        Range of degrees of freedom searched. ``maxDof`` defaults to twice
+        the last bin edge.
+    tolerance : `float`, optional
+        Accuracy of the fitted degrees of freedom.
+
+    Returns
+    -------
+    dof : `numpy.ndarray` or `float`
+        Fitted degrees of freedom of each histogram; NaN for empty ones.
+    """
+    counts = np.asarray(counts, dtype=np.float64)
+    isScalar = counts.ndim == 1
+    counts = np.atleast_2d(counts)
+    binEdges = np.asarray(binEdges, dtype=np.float64)
+    if maxDof is None:
+        maxDof = 2.0 * binEdges[-1]
+
+    # quadrature nodes and weights for each bin, in u = sqrt(x)
+    nodes, nodeWeights = np.polynomial.legendre.leggauss(4)
+    uEdges = np.sqrt(binEdges)
+    halfWidths = 0.5 * (uEdges[1:] - uEdges[:-1])
+    u = 0.5 * (uEdges[1:] + uEdges[:-1])[:, np.newaxis] + halfWidths[:, np.newaxis] * nodes
+    logU = np.log(u)
+    logBase = np.log(halfWidths[:, np.newaxis] * nodeWeights) - 0.5 * u**2
+
+    # integral of u**(dof - 1) * exp(-u**2 / 2) from 0 to b
+    # = b**dof * sum_n (-b**2 / 2)**n / (n! (dof + 2 n)), which converges quickly for b**2 <= 10
+    useSeries = binEdges[0] == 0 and binEdges[1] <= 10
+    seriesTerms = np.array([(-0.5 * binEdges[1])**n / math.factorial(n) for n in range(40)])
+
+    def logLikelihood(dof):
+        # the chi-squared density in u is proportional to u**(dof - 1) * exp(-u**2 / 2)
+        logTerms = logBase + (dof[:, np.newaxis, np.newaxis] - 1.0) * logU
+        logProb = _logSumExp(logTerms, axis=2)
+        if useSeries:
+            seriesSum = (seriesTerms / (dof[:, np.newaxis] + 2.0 * np.arange(len(seriesTerms)))).sum(axis=1)
+            logProb[:, 0] = dof * np.log(uEdges[1]) + np.log(seriesSum)
+        logProb -= _logSumExp(logProb, axis=1)[:, np.newaxis]
+        return (counts * logProb).sum(axis=1)
+
+    ratio = (math.sqrt(5.0) - 1.0) / 2.0
+    low = np.full(len(counts), float(minDof))
+    high = np.full(len(counts), float(maxDof))
+    mid1 = high - ratio * (high - low)
+    mid2 = low + ratio * (high - low)
+    value1 = logLikelihood(mid1)
+    value2 = logLikelihood(mid2)
+    numIter = max(1, int(math.ceil(math.log(tolerance / (maxDof - minDof)) / math.log(ratio))))
+    for i in range(numIter):
+        isLeft = value1 > value2
+        # maximum is in [low, mid2] where isLeft, else in [mid1, high]
+        high = np.where(isLeft, mid2, high)
+        low = np.where(isLeft, low, mid1)
+        newMid1 = np.where(isLeft, high - ratio * (high - low), mid2)
+        newMid2 = np.where(isLeft, mid1, low + ratio * (high - low))
+        newValues = logLikelihood(np.where(isLeft, newMid1, newMid2))
+        value1, value2 = np.where(isLeft, newValues, value2), np.where(isLeft, value1, newValues)
+        mid1, mid2 = newMid1, newMid2
+    dof = 0.5 * (low + high)
+    dof[counts.sum(axis=1) == 0] = np.nan
+    return dof[0] if isScalar else dof
+
+
+def _logSumExp(array, axis):
+    """Return log(sum(exp(array))) along an axis, avoiding overflow
+    """
+    maxValue = array.max(axis=axis, keepdims=True)
+    maxValue[~np.isfinite(maxValue)] = 0.0
+    return np.log(np.exp(array - maxValue).sum(axis=axis)) + np.squeeze(maxValue, axis=axis)
+
+
+def _readChunks(coaddPath, weightMapPath, chunkRows):
+    """Memory map a coadd and weight map in FITS files and yield them
+    ``chunkRows`` rows at a time
+
+    Raises
+    ------
+    RuntimeError
+        If the coadd and weight map have different shapes.
+    ValueError
+        If ``chunkRows`` < 1.
+    """
+    if chunkRows < 1:
+        raise ValueError("chunkRows = %s < 1" % (chunkRows,))
+    with fits.open(coaddPath, memmap=True) as coaddFile, \
+            fits.open(weightMapPath, memmap=True) as weightMapFile:
+        coaddData = _getImageData(coaddFile)
+        weightMapData = _getImageData(weightMapFile)
+        if coaddData.shape != weightMapData.shape:
+            raise RuntimeError("Image shape = %s != %s = weight map shape" %
+                               (coaddData.shape, weightMapData.shape))
+        for beginY in range(0, coaddData.shape[0], chunkRows):
+            endY = beginY + chunkRows
+            yield coaddData[beginY:endY], weightMapData[beginY:endY]
+
+
+def _getImageData(hduList):
+    """Return the image data of a FITS file: the primary HDU, or the first
+    extension if the primary HDU is empty
+    """
+    data = hduList[0].data
+    if data is None:
+        data = hduList[1].data
+    return data
@@ -0,0 +1,416 @@
+#
+# LSST Data Management System
+# Copyright 2008-2018 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Chi-squared coadd that can be saved, extended and have exposures removed
+"""
+import collections
+import os
+
+import numpy as np
+
+import lsst.afw.image as afwImage
+from . addToCoadd import AddToCoaddStatistics, VarianceModel, subtractFromCoadd
+from . coadd import Coadd, makeVarianceModel
+from . hashing import hashMaskedImage
+
+__all__ = ["IncrementalCoadd", "ExposureRecord"]
+
+ExposureRecord = collections.namedtuple("ExposureRecord",
+                                        ["exposureId", "hash", "weight", "filterName", "varianceModel"])
+"""Record of an exposure added to an `IncrementalCoadd`: its ID, the hash
+of its masked image (see `hashMaskedImage`), the weight with which it was
+added, the name of its filter and the variance model with which it was
+added: None if its variance plane was used, a `float` for a constant
+variance, else a `dict` with keys ``cellWidth``, ``cellHeight`` and
+``cellVariance`` (a nested list indexed by [cellY][cellX]); see
+`VarianceModel`.
+"""
+ExposureRecord.__new__.__defaults__ = (None,)  # records saved without a variance model used the plane
+
+
+def _getVarianceModelState(varianceModel):
+    """Return a JSON-serializable description of a variance model, for an
+    `ExposureRecord`
+
+    A model of a single cell is described by its variance, which is
+    equivalent for any masked image it covers.
+    """
+    if varianceModel is None:
+        return None
+    numCellsX = varianceModel.getNumCellsX()
+    numCellsY = varianceModel.getNumCellsY()
+    if numCellsX == 1 and numCellsY == 1:
+        return varianceModel.getVariance(0, 0)
+    return dict(cellWidth=varianceModel.getCellWidth(),
+                cellHeight=varianceModel.getCellHeight(),
+                cellVariance=[[varianceModel.getVariance(cellX, cellY) for cellX in range(numCellsX)]
+                              for cellY in range(numCellsY)])
+
+
+def _makeVarianceModelFromState(state):
+    """Return the variance model described by `_getVarianceModelState`
+    """
+    if not isinstance(state, dict):
+        return makeVarianceModel(state)
+    cellVariance = afwImage.makeImageFromArray(np.array(state["cellVariance"], dtype=np.float32))
+    return VarianceModel(cellVariance, state["cellWidth"], state["cellHeight"])
+
+
+class IncrementalCoadd(Coadd):
+    """Create a chi-squared coadd that is kept on disk, extended as new
+    exposures arrive and from which exposures can be removed
+
+    Each exposure is added with an ID, and a record of its content hash and
+    weight is kept (see `getExposureRecords`), so `removeExposure` can
+    retract an exposure that turns out to be bad without rebuilding the
+    coadd. The coadd mask is the OR of the masks of the good input pixels,
+    which cannot be undone from the mask alone, so for each mask bit that
+    occurs in good input pixels the number of inputs that set it is counted
+    per pixel, as is the number of good inputs. Removing an exposure
+    decrements the counts and rebuilds the mask from them, and resets
+    pixels that no longer have any inputs to exactly zero.
+
+    `save` writes the accumulator, counts and records to a directory, and
+    `open` reads them back so that more exposures can be added (or removed)
+    later. The files are those of a checkpoint (see
+    `Coadd.enableCheckpoints`), so periodic checkpoints may be used as well.
+
+    Parameters
+    ----------
+    bbox : `lsst.afw.geom.Box2I`
+        Bounding box of coadd Exposure with respect to parent:
+        coadd dimensions = bbox.getDimensions(); xy0 = bbox.getMin()
+    wcs : `lsst.afw.geom.SkyWcs`
+        WCS of coadd exposure
+    badMaskPlanes : `list` of `str`
+        Mask planes to pay attention to when rejecting masked pixels.
+        Specify as a collection of names.
+        badMaskPlanes should always include "EDGE".
+    numThreads : `int`, optional
+        Number of threads used to add or remove each exposure.
+    doubleAccumulator : `bool`, optional
+        If True, accumulate the coadd image in double precision. Removing
+        an exposure restores the accumulator only up to rounding, which is
+        negligible in double precision, hence the default.
+    logName : `str`, optional
+        Name by which messages are logged.
+    """
+
+    def __init__(self, bbox, wcs, badMaskPlanes, numThreads=1, doubleAccumulator=True,
+                 logName="coadd.chisquared.IncrementalCoadd"):
+        Coadd.__init__(self,
+                       bbox=bbox,
+                       wcs=wcs,
+                       badMaskPlanes=badMaskPlanes,
+                       numThreads=numThreads,
+                       doubleAccumulator=doubleAccumulator,
+                       logName=logName,
+                       )
+        self._records = collections.OrderedDict()
+        self._inputCounts = np.zeros((bbox.getHeight(), bbox.getWidth()), dtype=np.uint32)
+        self._maskBitCounts = {}
+
+    @classmethod
+    def open(cls, directory, **kwargs):
+        """Open an incremental coadd saved by `save`
+
+        Parameters
+        ----------
+        directory : `str`
+            Directory containing the saved coadd.
+        **kwargs
+            Additional arguments for the constructor, e.g. ``numThreads``.
+
+        Returns
+        -------
+        coadd : `IncrementalCoadd`
+            The saved coadd; `save` with no arguments saves it back to
+            ``directory``.
+
+        Raises
+        ------
+        RuntimeError
+            If ``directory`` contains no saved coadd.
+        """
+        coadd = cls.fromCheckpoint(directory, **kwargs)
+        coadd._setCheckpointDir(directory, everyN=None, everySeconds=None)
+        return coadd
+
+    def save(self, directory=None):
+        """Write the coadd to a directory, replacing what was saved there
+
+        Parameters
+        ----------
+        directory : `str`, optional
+            Directory in which to save the coadd; created if necessary.
+            Defaults to the directory most recently saved to or opened.
+
+        Raises
+        ------
+        RuntimeError
+            If ``directory`` is None and the coadd has never been saved.
+        """
+        if directory is not None and directory != self._checkpointDir:
+            self.waitForCheckpoint()
+            self._setCheckpointDir(directory, everyN=None, everySeconds=None)
+        if self._checkpointDir is None:
+            raise RuntimeError("No directory to save to; specify one")
+        self.writeCheckpoint(wait=True)
+
+    def getExposureRecords(self):
+        """Return the records of the exposures in the coadd, in the order
+        they were added
+
+        Returns
+        -------
+        records : `list` of `ExposureRecord`
+        """
+        return list(self._records.values())
+
+    def addExposure(self, exposure, weightFactor=1.0, exposureId=None, varianceModel=None):
+        """Add an exposure to the coadd; it is assumed to have the same WCS
+        as the coadd
+
+        Parameters
+        ----------
+        exposure : `lsst.afw.image.Exposure`
+            Exposure to add to coadd; see `Coadd.addExposure`.
+        weightFactor : `float`
+            weight with which to add exposure to coadd
+        exposureId : `str` or `int`
+            Identifier of the exposure; required. It must be JSON-serializable
+            for the coadd to be saved.
+        varianceModel : `lsst.coadd.chisquared.VarianceModel` or `float`, optional
+            Model of the variance of ``exposure``; see `Coadd.addExposure`.
+            It is recorded, and saved with the coadd, so that
+            `removeExposure` subtracts the exposure with the same model.
+
+        Returns
+        -------
+        overlapBBox : `lsst.afw.geom.Box2I`
+            Region of overlap between ``exposure`` and coadd in parent
+            coordinates.
+        weight : `float`
+            Weight with which ``exposure`` was added to coadd.
+
+        Raises
+        ------
+        ValueError
+            If ``exposureId`` is None or is already in the coadd.
+        """
+        if exposureId is None:
+            raise ValueError("An IncrementalCoadd requires an exposureId for every exposure")
+        if exposureId in self._records:
+            raise ValueError("Exposure %r is already in the coadd" % (exposureId,))
+        varianceModel = makeVarianceModel(varianceModel)
+        self._records[exposureId] = ExposureRecord(exposureId=exposureId,
+                                                   hash=hashMaskedImage(exposure.getMaskedImage()),
+                                                   weight=weightFactor,
+                                                   filterName=exposure.getFilter().getName(),
+                                                   varianceModel=_getVarianceModelState(varianceModel))
+        # the record must exist when the exposure is recorded, as that may write a checkpoint,
+        # but not if the exposure never reached the coadd
+        try:
+            return Coadd.addExposure(self, exposure, weightFactor=weightFactor, exposureId=exposureId,
+                                     varianceModel=varianceModel)
+        except Exception:
+            if exposureId not in self._consumedIdSet:
+                del self._records[exposureId]
+            raise
+
+    def warpAndAddExposure(self, exposure, warpingControl, weightFactor=1.0, exposureId=None,
+                           tileSize=256, varianceModel=None):
+        """Not supported: an exposure must be removed exactly as it was
+        added, so warp it first and call `addExposure`
+
+        Raises
+        ------
+        RuntimeError
+            Always.
+        """
+        raise RuntimeError("IncrementalCoadd does not support warpAndAddExposure; "
+                           "warp the exposure and call addExposure")
+
+    def removeExposure(self, exposure, exposureId):
+        """Remove an exposure from the coadd
+
+        The image and weight map are restored, up to rounding of the image,
+        to what they would be had the exposure never been added; the mask is
+        restored exactly. Pixels to which no other exposure contributes are
+        reset to zero. The exposure is subtracted with the variance model
+        with which it was added, if any. The counts of the removed pixels
+        are subtracted from the total statistics (see `getTotalStatistics`);
+        the time spent adding them is not.
+
+        Parameters
+        ----------
+        exposure : `lsst.afw.image.Exposure`
+            The exposure, exactly as it was added.
+        exposureId : `str` or `int`
+            Identifier with which the exposure was added.
+
+        Returns
+        -------
+        overlapBBox : `lsst.afw.geom.Box2I`
+            Region of overlap between ``exposure`` and coadd in parent
+            coordinates.
+
+        Raises
+        ------
+        ValueError
+            If no exposure with ID ``exposureId`` is in the coadd, or if the
+            content of ``exposure`` does not match the one that was added.
+        """
+        record = self._records.get(exposureId)
+        if record is None:
+            raise ValueError("Exposure %r is not in the coadd" % (exposureId,))
+        maskedImage = exposure.getMaskedImage()
+        if hashMaskedImage(maskedImage) != record.hash:
+            raise ValueError("Exposure %r does not match the one that was added" % (exposureId,))
+        self._log.info("remove exposure %s from coadd" % (exposureId,))
+
+        accumulator = self._coadd.getMaskedImage()
+        statistics = AddToCoaddStatistics()
+        overlapBBox = subtractFromCoadd(accumulator, self._weightMap, maskedImage, self._badPixelMask,
+                                        record.weight, statistics, numThreads=self._numThreads,
+                                        varianceModel=_makeVarianceModelFromState(record.varianceModel))
+        self._totalStatistics -= statistics
+        if not overlapBBox.isEmpty():
+            self._countInputs(maskedImage, overlapBBox, -1)
+            slices = self._getSlices(overlapBBox)
+            coaddMask = accumulator.getMask().getArray()[slices]
+            coaddMask[:] = 0
+            for bit, counts in self._maskBitCounts.items():
+                coaddMask |= (counts[slices] > 0).astype(coaddMask.dtype) << bit
+            isEmpty = self._inputCounts[slices] == 0
+            accumulator.getImage().getArray()[slices][isEmpty] = 0
+            self._weightMap.getArray()[slices][isEmpty] = 0
+
+        del self._records[exposureId]
+        self._consumedIds.remove(exposureId)
+        self._consumedIdSet.discard(exposureId)
+        filterNames = set(record.filterName for record in self._records.values())
+        self._filterDict = {name: filter for name, filter in self._filterDict.items() if name in filterNames}
+        return overlapBBox
+
+    def merge(self, other):
+        """Add the accumulated sums, counts and exposure records of another
+        incremental coadd to this one; see `Coadd.merge`
+
+        Exposures of ``other`` that only partly overlap this coadd are
+        recorded in full; removing one removes the overlapping part.
+
+        Raises
+        ------
+        ValueError
+            If ``other`` is not an `IncrementalCoadd`, has a different WCS
+            or bad pixel mask, or shares an exposure ID with this coadd.
+        """
+        if not isinstance(other, IncrementalCoadd):
+            raise ValueError("Can only merge another IncrementalCoadd into an IncrementalCoadd")
+        duplicateIds = set(self._records) & set(other._records)
+        if duplicateIds:
+            raise ValueError("Exposures %s are in both coadds" % (sorted(duplicateIds, key=str),))
+        overlapBBox = Coadd.merge(self, other)
+        if not overlapBBox.isEmpty():
+            slices = self._getSlices(overlapBBox)
+            otherSlices = other._getSlices(overlapBBox)
+            self._inputCounts[slices] += other._inputCounts[otherSlices]
+            for bit, counts in other._maskBitCounts.items():
+                self._getMaskBitCounts(bit)[slices] += counts[otherSlices]
+        self._records.update(other._records)
+        return overlapBBox
+
+    def _addMaskedImage(self, maskedImage, weight, statistics, varianceModel=None):
+        """Add a masked image to the accumulator and count its good pixels
+        and their mask bits
+        """
+        overlapBBox = Coadd._addMaskedImage(self, maskedImage, weight, statistics,
+                                            varianceModel=varianceModel)
+        if not overlapBBox.isEmpty():
+            self._countInputs(maskedImage, overlapBBox, 1)
+        return overlapBBox
+
+    def _countInputs(self, maskedImage, overlapBBox, sign):
+        """Add (sign=1) or subtract (sign=-1) the good pixels of a masked
+        image, and the mask bits they have, to or from the counts
+        """
+        slices = self._getSlices(overlapBBox)
+        inputSlices = (slice(overlapBBox.getMinY() - maskedImage.getY0(),
+                             overlapBBox.getMaxY() + 1 - maskedImage.getY0()),
+                       slice(overlapBBox.getMinX() - maskedImage.getX0(),
+                             overlapBBox.getMaxX() + 1 - maskedImage.getX0()))
+        mask = maskedImage.getMask().getArray()[inputSlices]
+        isGood = (mask & self._badPixelMask) == 0
+        if not isGood.any():
+            return
+        countsList = [(self._inputCounts[slices], isGood)]
+        bits = int(np.bitwise_or.reduce(mask[isGood])) & 0xffffffff
+        for bit in range(32):
+            if bits & (1 << bit):
+                countsList.append((self._getMaskBitCounts(bit)[slices], isGood & ((mask >> bit) & 1 == 1)))
+        for counts, isCounted in countsList:
+            if sign > 0:
+                counts += isCounted
+            else:
+                counts -= isCounted
+
+    def _getMaskBitCounts(self, bit):
+        """Return the per-pixel counts of a mask bit, creating them if
+        necessary
+        """
+        counts = self._maskBitCounts.get(bit)
+        if counts is None:
+            counts = np.zeros(self._inputCounts.shape, dtype=np.uint32)
+            self._maskBitCounts[bit] = counts
+        return counts
+
+    def _getCheckpointState(self):
+        """Return the state saved with a checkpoint, including the exposure
+        records
+        """
+        state = Coadd._getCheckpointState(self)
+        state["exposureRecords"] = [record._asdict() for record in self._records.values()]
+        return state
+
+    def _getCheckpointArrays(self):
+        """Return copies of the input and mask bit counts
+        """
+        arrays = {"inputCounts": self._inputCounts.copy()}
+        for bit, counts in self._maskBitCounts.items():
+            arrays["maskBit%d" % (bit,)] = counts.copy()
+        return arrays
+
+    def _restoreCheckpointState(self, checkpointDir, manifest):
+        """Restore the exposure records and counts saved with a checkpoint
+        """
+        Coadd._restoreCheckpointState(self, checkpointDir, manifest)
+        self._records = collections.OrderedDict()
+        for recordDict in manifest.get("exposureRecords", []):
+            record = ExposureRecord(**recordDict)
+            self._records[record.exposureId] = record
+        if "arrays" in manifest:
+            with np.load(os.path.join(checkpointDir, manifest["arrays"])) as arrays:
+                self._inputCounts[:] = arrays["inputCounts"]
+                self._maskBitCounts = {}
+                for name in arrays.files:
+                    if name.startswith("maskBit"):
+                        self._getMaskBitCounts(int(name[len("maskBit"):]))[:] = arrays[name]
@@ -0,0 +1,328 @@
+#
+# LSST Data Management System
+# Copyright 2008-2018 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+import os
+
+import numpy as np
+
+import lsst.pex.config as pexConfig
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+from . addToCoadd import addToCoadd
+from . coadd import Coadd, CoaddConfig
+
+__all__ = ["MemmapCoadd", "MemmapCoaddConfig"]
+
+
+class MemmapCoaddConfig(CoaddConfig):
+    """Config for a memory-mapped chi-squared Coadd
+    """
+    tileBudget = pexConfig.Field(
+        dtype=int,
+        doc="Maximum number of bytes of the accumulator (coadd image, coadd mask and weight map) "
+            "that are mapped into memory while adding an exposure or writing or restoring a checkpoint",
+        default=64 * 1024**2,
+        check=lambda n: n >= 1,
+    )
+
+
+class MemmapCoadd(Coadd):
+    """Create a chi-squared coadd whose accumulator lives in files on disk
+
+    The coadd image, coadd mask and weight map are stored as ``.npy`` files
+    in ``directory`` and are never held in memory as a whole. Each exposure
+    is added one band of rows at a time: the band is memory mapped, passed to
+    `addToCoadd` and unmapped again, so the resident size of the accumulator
+    stays below ``tileBudget`` bytes however large the coadd region is.
+    Bands span the full width of the coadd, so the budget includes the
+    (never altered) variance plane that `addToCoadd` needs for each band.
+    Merging, writing a checkpoint and restoring one also work one band at a
+    time; a checkpoint of a memory-mapped coadd is a copy of its ``.npy``
+    files.
+
+    Parameters
+    ----------
+    bbox : `lsst.afw.geom.Box2I`
+        Bounding box of coadd Exposure with respect to parent:
+        coadd dimensions = bbox.getDimensions(); xy0 = bbox.getMin()
+    wcs : `lsst.afw.geom.SkyWcs`
+        WCS of coadd exposure
+    badMaskPlanes : `list` of `str`
+        Mask planes to pay attention to when rejecting masked pixels.
+        Specify as a collection of names.
+        badMaskPlanes should always include "EDGE".
+    directory : `str`
+        Directory in which to create the accumulator files; it is created
+        if necessary and must not already contain them.
+    tileBudget : `int`, optional
+        Maximum number of bytes of the accumulator mapped at one time.
+        At least one full-width row of the coadd is always mapped.
+    numThreads : `int`, optional
+        Number of threads used to add each band of rows to the coadd.
+    doubleAccumulator : `bool`, optional
+        If True, accumulate the coadd image in double precision.
+    logName : `str`, optional
+        Name by which messages are logged.
+
+    Raises
+    ------
+    ValueError
+        If ``tileBudget`` < 1.
+    RuntimeError
+        If an accumulator file already exists in ``directory``.
+    """
+    ConfigClass = MemmapCoaddConfig
+
+    def __init__(self, bbox, wcs, badMaskPlanes, directory, tileBudget=64 * 1024**2, numThreads=1,
+                 doubleAccumulator=False, logName="coadd.chisquared.MemmapCoadd"):
+        if tileBudget < 1:
+            raise ValueError("tileBudget = %s < 1" % (tileBudget,))
+        # the base class allocates the accumulator in memory; give it a single pixel
+        # to allocate, then replace it with files
+        Coadd.__init__(self,
+                       bbox=afwGeom.Box2I(bbox.getMin(), afwGeom.Extent2I(1, 1)),
+                       wcs=wcs,
+                       badMaskPlanes=badMaskPlanes,
+                       numThreads=numThreads,
+                       doubleAccumulator=doubleAccumulator,
+                       logName=logName,
+                       )
+        self._bbox = afwGeom.Box2I(bbox)
+        self._coadd = None
+        self._weightMap = None
+        self._directory = directory
+        self._tileBudget = tileBudget
+        self._dtypes = dict(
+            image=np.dtype(np.float64 if doubleAccumulator else np.float32),
+            mask=np.dtype(np.int32),
+            weightMap=np.dtype(np.float32),
+        )
+
+        os.makedirs(directory, exist_ok=True)
+        shape = (bbox.getHeight(), bbox.getWidth())
+        self._offsets = {}
+        for name, dtype in self._dtypes.items():
+            path = self.getPath(name)
+            if os.path.exists(path):
+                raise RuntimeError("Accumulator file %r already exists" % (path,))
+            # new .npy files are sparse, so this does not write the whole plane
+            array = np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=shape)
+            self._offsets[name] = array.offset
+            del array
+
+    @classmethod
+    def fromConfig(cls, bbox, wcs, config, directory, logName="coadd.chisquared.MemmapCoadd"):
+        """Create a memory-mapped chi-squared coadd from a config
+
+        Parameters
+        ----------
+        bbox : `lsst.afw.geom.Box2I`
+            Bounding box of coadd Exposure with respect to parent.
+        wcs : `lsst.afw.geom.SkyWcs`
+            WCS of coadd exposure
+        config : `MemmapCoaddConfig`
+            Coadd config.
+        directory : `str`
+            Directory in which to create the accumulator files.
+        logName : `str`, optional
+            Name by which messages are logged.
+        """
+        return cls(bbox=bbox,
+                   wcs=wcs,
+                   badMaskPlanes=config.badMaskPlanes,
+                   directory=directory,
+                   tileBudget=config.tileBudget,
+                   numThreads=config.numThreads,
+                   doubleAccumulator=config.doubleAccumulator,
+                   logName=logName,
+                   )
+
+    def getPath(self, name):
+        """Return the path of an accumulator file
+
+        Parameters
+        ----------
+        name : `str`
+            One of "image", "mask" or "weightMap".
+        """
+        return os.path.join(self._directory, "%s.npy" % (name,))
+
+    def getTileBudget(self):
+        """Return the maximum number of accumulator bytes mapped at one time
+        """
+        return self._tileBudget
+
+    def getCoadd(self):
+        """Get the coadd exposure for all exposures you have coadded so far
+
+        This reads the whole accumulator into memory.
+
+        Returns
+        -------
+        coaddExposure : `lsst.afw.image.ExposureF`
+            Coadd, scaled by the weight map.
+        """
+        maskedImage = afwImage.MaskedImageF(self._bbox)
+        maskedImage.getImage().getArray()[:] = self._readPlane("image")
+        maskedImage.getMask().getArray()[:] = self._readPlane("mask")
+        return self._makeScaledExposure(maskedImage, self.getWeightMap())
+
+    def getWeightMap(self):
+        """Return a copy of the weight map, read into memory
+        """
+        weightMap = afwImage.ImageF(self._bbox)
+        weightMap.getArray()[:] = self._readPlane("weightMap")
+        return weightMap
+
+    def _addMaskedImage(self, maskedImage, weight, statistics, varianceModel=None):
+        """Add a masked image to the accumulator files, one band of rows at
+        a time
+        """
+        overlapBBox = afwGeom.Box2I(self._bbox)
+        overlapBBox.clip(maskedImage.getBBox())
+        if overlapBBox.isEmpty():
+            return overlapBBox
+
+        tileRows = self._getTileRows(withVariance=True)
+        beginY = overlapBBox.getMinY() - self._bbox.getMinY()
+        endY = overlapBBox.getMaxY() + 1 - self._bbox.getMinY()
+        for tileBeginY in range(beginY, endY, tileRows):
+            self._addToTile(tileBeginY, min(tileBeginY + tileRows, endY), maskedImage, weight, statistics,
+                            varianceModel)
+        return overlapBBox
+
+    def _getTileRows(self, withVariance=False):
+        """Return the number of full-width rows of the accumulator that fit
+        in the tile budget
+
+        Whole rows are mapped, whatever part of them is used. If
+        ``withVariance`` then a variance plane is allocated for each band
+        as well.
+        """
+        bytesPerPixel = sum(dtype.itemsize for dtype in self._dtypes.values())
+        if withVariance:
+            bytesPerPixel += np.dtype(np.float32).itemsize
+        return max(1, self._tileBudget // (bytesPerPixel * self._bbox.getWidth()))
+
+    def _addToTile(self, beginY, endY, maskedImage, weight, statistics, varianceModel=None):
+        """Map rows [beginY, endY) of the accumulator, relative to the coadd
+        bbox, add maskedImage to them and unmap them again
+        """
+        planes = {name: self._mapRows(name, beginY, endY) for name in self._dtypes}
+        # the coadd variance plane is never altered; untouched zero pages take no memory
+        variance = np.zeros(planes["image"].shape, dtype=np.float32)
+        xy0 = afwGeom.Point2I(self._bbox.getMinX(), self._bbox.getMinY() + beginY)
+        coadd = afwImage.makeMaskedImageFromArrays(planes["image"], planes["mask"], variance)
+        coadd.setXY0(xy0)
+        weightMap = afwImage.makeImageFromArray(planes["weightMap"])
+        weightMap.setXY0(xy0)
+        addToCoadd(coadd, weightMap, maskedImage, self._badPixelMask, weight, statistics,
+                   numThreads=self._numThreads, varianceModel=varianceModel)
+
+    def _getPlanes(self, bbox):
+        """Return read-only memory maps of a region of the accumulator planes
+        """
+        slices = self._getSlices(bbox)
+        return tuple(self._readPlane(name)[slices] for name in ("image", "mask", "weightMap"))
+
+    def _addPlanes(self, bbox, image, mask, weightMap):
+        """Add accumulator planes of another coadd to a region of this one,
+        one band of rows at a time
+        """
+        tileRows = self._getTileRows()
+        rowSlice, colSlice = self._getSlices(bbox)
+        for beginY in range(0, bbox.getHeight(), tileRows):
+            endY = min(beginY + tileRows, bbox.getHeight())
+            planes = {name: self._mapRows(name, rowSlice.start + beginY, rowSlice.start + endY)
+                      for name in self._dtypes}
+            planes["image"][:, colSlice] += image[beginY:endY]
+            planes["mask"][:, colSlice] |= mask[beginY:endY]
+            planes["weightMap"][:, colSlice] += weightMap[beginY:endY]
+            del planes
+
+    def _copyCheckpointPixels(self, checkpointDir, generation):
+        """Copy the accumulator files to ``.npy`` files in the checkpoint
+        directory, one band of rows at a time
+
+        At most ``tileBudget`` bytes of the accumulator are mapped at once,
+        as when adding an exposure. Only a one-pixel exposure holding the
+        WCS is left to the thread that writes the checkpoint.
+        """
+        tileRows = self._getTileRows()
+        height = self._bbox.getHeight()
+        width = self._bbox.getWidth()
+        planes = {}
+        for name, dtype in self._dtypes.items():
+            planes[name] = "%s-%d.npy" % (name, generation)
+            path = os.path.join(checkpointDir, planes[name])
+            array = np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=(height, width))
+            offset = array.offset
+            del array
+            for beginY in range(0, height, tileRows):
+                endY = min(beginY + tileRows, height)
+                copy = _mapNpyRows(path, offset, dtype, width, beginY, endY)
+                copy[:] = self._mapRows(name, beginY, endY)
+                del copy
+
+        bbox = afwGeom.Box2I(self._bbox)
+        wcs = self._wcs
+
+        def writePixels():
+            pixelFiles = dict(planes=planes,
+                              bbox=[bbox.getMinX(), bbox.getMinY(), bbox.getWidth(), bbox.getHeight()],
+                              wcs="wcs-%d.fits" % (generation,))
+            wcsExposure = afwImage.ExposureF(afwGeom.Box2I(bbox.getMin(), afwGeom.Extent2I(1, 1)), wcs)
+            wcsExposure.writeFits(os.path.join(checkpointDir, pixelFiles["wcs"]))
+            return pixelFiles
+
+        return writePixels
+
+    def _restoreCheckpointPixels(self, checkpointDir, manifest):
+        """Write the accumulator and weight map saved with a checkpoint to
+        the accumulator files, reading and writing one band of rows at a time
+        """
+        for beginY, endY, maskedImage, weightMap in self._readCheckpointBands(checkpointDir, manifest,
+                                                                             self._getTileRows()):
+            for name, array in (("image", maskedImage.getImage().getArray()),
+                                ("mask", maskedImage.getMask().getArray()),
+                                ("weightMap", weightMap.getArray())):
+                plane = self._mapRows(name, beginY, endY)
+                plane[:] = array
+                del plane
+
+    def _mapRows(self, name, beginY, endY):
+        """Memory map rows [beginY, endY) of an accumulator file
+        """
+        return _mapNpyRows(self.getPath(name), self._offsets[name], self._dtypes[name],
+                           self._bbox.getWidth(), beginY, endY)
+
+    def _readPlane(self, name):
+        """Return an accumulator plane as a read-only memory map
+        """
+        return np.load(self.getPath(name), mmap_mode="r")
+
+
+def _mapNpyRows(path, offset, dtype, width, beginY, endY):
+    """Memory map rows [beginY, endY) of a 2-d ``.npy`` file whose data
+    start at byte ``offset``
+    """
+    return np.memmap(path, dtype=dtype, mode="r+", offset=offset + beginY * width * dtype.itemsize,
+                     shape=(endY - beginY, width))
@@ -0,0 +1,401 @@
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Create chi-squared coadds of several patches of sky in one pass over the
+input exposures
+
+An exposure usually overlaps several patches, and coadding each patch
+separately reads and decodes it once per patch. `multiPatchCoadd` reads each
+exposure once, on a pool of threads, while the main thread warps it into
+every patch it overlaps and adds it, with `Coadd.warpAndAddExposure`. The
+coadd accumulators of the patches are kept in an `AccumulatorPool`, which
+holds a bounded number in memory and spills the least recently used ones to
+disk.
+
+afw holds the GIL while it reads and warps, so the read threads do not run
+in parallel with each other or with warping: reading overlaps only with
+`addToCoadd`, which releases the GIL, and with the file I/O of the optional
+`Prefetcher` thread. The saving comes from reading each exposure once, not
+from parallelism; `lsst.coadd.chisquared.warpAndCoadd` warps in a pool of
+processes, but coadds a single patch.
+"""
+import collections
+import concurrent.futures
+import itertools
+import os
+import time
+import traceback
+
+import lsst.pex.config as pexConfig
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.afw.math as afwMath
+from lsst.log import Log
+from . coadd import Coadd, makeWarpingControl
+from . footprint import footprintOverlapsCoadd, getInputBBox, getWarpingPadding, readExposureFootprint
+from . prefetcher import Prefetcher
+
+__all__ = ["Patch", "AccumulatorPool", "MultiPatchCoaddConfig", "MultiPatchCoaddResult", "multiPatchCoadd",
+           "makePatchGrid"]
+
+_log = Log.getLogger("coadd.chisquared.multiPatchCoadd")
+
+Patch = collections.namedtuple("Patch", ["name", "wcs", "bbox"])
+"""A patch of sky to coadd: a name, unique among the patches (it is used in
+file names), and the WCS and parent bounding box of its coadd.
+"""
+
+MultiPatchCoaddResult = collections.namedtuple(
+    "MultiPatchCoaddResult", ["coaddPaths", "numExposuresRead", "numExposuresFailed", "numExposuresSkipped",
+                              "numPatchExposures", "numSpills", "numReloads", "elapsedTime"])
+"""Result of `multiPatchCoadd`: a `dict` of patch name: path of its coadd,
+the number of exposures read (each once), the number that could not be read,
+the number skipped because they overlap no patch, the number of
+(exposure, patch) pairs added, the number of times an accumulator was
+spilled to disk and read back, and the wall time (sec).
+"""
+
+
+class AccumulatorPool:
+    """A bounded pool of the coadd accumulators of a set of patches
+
+    At most ``maxOpen`` accumulators are held in memory. When another is
+    needed, the least recently used one is spilled: it is written to its own
+    directory under ``spillDir`` as a checkpoint and dropped, and it is read
+    back with `Coadd.fromCheckpoint` the next time it is needed.
+
+    Parameters
+    ----------
+    patches : `list` of `Patch`
+        Patches to coadd.
+    coaddConfig : `lsst.coadd.chisquared.CoaddConfig`
+        Config of the coadd of each patch.
+    spillDir : `str`
+        Directory under which to spill accumulators; created if necessary.
+    maxOpen : `int`, optional
+        Maximum number of accumulators in memory.
+
+    Raises
+    ------
+    ValueError
+        If ``maxOpen`` < 1 or patch names are not unique.
+    """
+
+    def __init__(self, patches, coaddConfig, spillDir, maxOpen=4):
+        if maxOpen < 1:
+            raise ValueError("maxOpen = %s < 1" % (maxOpen,))
+        self._patches = collections.OrderedDict((patch.name, patch) for patch in patches)
+        if len(self._patches) != len(patches):
+            raise ValueError("Patch names are not unique")
+        self._coaddConfig = coaddConfig
+        self._spillDir = spillDir
+        self._maxOpen = maxOpen
+        self._open = collections.OrderedDict()
+        self._spilled = set()
+        self.numSpills = 0
+        self.numReloads = 0
+        os.makedirs(spillDir, exist_ok=True)
+
+    def getPatches(self):
+        """Return the patches, in the order they were given
+        """
+        return list(self._patches.values())
+
+    def isOpen(self, name):
+        """Return True if the accumulator of a patch is in memory
+        """
+        return name in self._open
+
+    def get(self, name):
+        """Return the accumulator of a patch, reading it back or creating it
+        if necessary, and mark it most recently used
+
+        Parameters
+        ----------
+        name : `str`
+            Patch name.
+
+        Returns
+        -------
+        coadd : `lsst.coadd.chisquared.Coadd`
+            Accumulator of the patch; do not keep it after getting another.
+        """
+        coadd = self._open.get(name)
+        if coadd is not None:
+            self._open.move_to_end(name)
+            return coadd
+
+        while len(self._open) >= self._maxOpen:
+            self._spill(*self._open.popitem(last=False))
+        if name in self._spilled:
+            _log.debug("Read back accumulator of patch %s" % (name,))
+            coadd = Coadd.fromCheckpoint(self._getSpillDir(name), numThreads=self._coaddConfig.numThreads)
+            self._spilled.discard(name)
+            self.numReloads += 1
+        else:
+            patch = self._patches[name]
+            coadd = Coadd.fromConfig(bbox=patch.bbox, wcs=patch.wcs, config=self._coaddConfig)
+        self._open[name] = coadd
+        return coadd
+
+    def items(self):
+        """Iterate over (name, accumulator) for every patch, open ones
+        first, so that each spilled accumulator is read back at most once
+
+        Each accumulator yielded may be spilled again by the next, so use
+        it before advancing the iterator.
+        """
+        for name in list(self._open) + [name for name in self._patches if name not in self._open]:
+            yield name, self.get(name)
+
+    def _spill(self, name, coadd):
+        """Write an accumulator to disk
+        """
+        _log.debug("Spill accumulator of patch %s" % (name,))
+        spillDir = self._getSpillDir(name)
+        coadd._setCheckpointDir(spillDir, everyN=None, everySeconds=None)
+        coadd.writeCheckpoint(wait=True)
+        self._spilled.add(name)
+        self.numSpills += 1
+
+    def _getSpillDir(self, name):
+        return os.path.join(self._spillDir, name)
+
+
+class MultiPatchCoaddConfig(pexConfig.Config):
+    numReadThreads = pexConfig.Field(
+        dtype=int,
+        doc="Number of threads that read exposures while others are warped and added; afw holds the GIL "
+            "while reading, so reads overlap only with adding, not with each other or with warping",
+        default=2,
+        check=lambda n: n >= 1,
+    )
+    maxInFlight = pexConfig.Field(
+        dtype=int,
+        doc="Maximum number of exposures being read or waiting to be added; "
+            "this bounds the memory used by exposures that have been read. 0 for 2 * numReadThreads.",
+        default=0,
+        check=lambda n: n >= 0,
+    )
+    numPrefetch = pexConfig.Field(
+        dtype=int,
+        doc="Number of input files to read ahead of the read threads, so that they read them from "
+            "the OS page cache; 0 to disable. Whole files are read, so with doMinimalRead this may read "
+            "much more than the read threads do.",
+        default=0,
+        check=lambda n: n >= 0,
+    )
+    maxOpenAccumulators = pexConfig.Field(
+        dtype=int,
+        doc="Maximum number of patch accumulators held in memory; others are spilled to disk",
+        default=4,
+        check=lambda n: n >= 1,
+    )
+    doMinimalRead = pexConfig.Field(
+        dtype=bool,
+        doc="Read only the bounding box of input pixels that can be warped into the patches each "
+            "exposure overlaps?",
+        default=True,
+    )
+    tileSize = pexConfig.Field(
+        dtype=int,
+        doc="Size of the square tiles in which exposures are warped and added (pixels)",
+        default=256,
+        check=lambda n: n >= 1,
+    )
+    coadd = pexConfig.ConfigField(dtype=Coadd.ConfigClass, doc="")
+    warp = pexConfig.ConfigField(dtype=afwMath.Warper.ConfigClass, doc="")
+
+
+def multiPatchCoadd(patches, exposurePathList, config, outputDir, spillDir=None):
+    """Coadd exposures into several patches, reading each exposure once
+
+    Parameters
+    ----------
+    patches : `list` of `Patch`
+        Patches to coadd.
+    exposurePathList : `list` of `str`
+        Paths to input exposures; each is warped into every patch that its
+        footprint, computed from its header, overlaps.
+    config : `MultiPatchCoaddConfig`
+        Configuration.
+    outputDir : `str`
+        Directory in which to write the coadd of each patch as
+        ``<name>.fits`` and its weight map as ``<name>_weight.fits``;
+        created if necessary.
+    spillDir : `str`, optional
+        Directory under which to spill accumulators; defaults to
+        ``<outputDir>/spill``. It is not removed.
+
+    Returns
+    -------
+    result : `MultiPatchCoaddResult`
+
+    Raises
+    ------
+    RuntimeError
+        If an exposure that was read fails to be warped or added to a
+        patch. It is added tile by tile, so the patch coadd may hold part
+        of it; an exposure that cannot be read is skipped instead.
+    """
+    startTime = time.time()
+    os.makedirs(outputDir, exist_ok=True)
+    pool = AccumulatorPool(patches, config.coadd,
+                           spillDir=os.path.join(outputDir, "spill") if spillDir is None else spillDir,
+                           maxOpen=config.maxOpenAccumulators)
+    padding = getWarpingPadding(config.warp)
+    warpingControl = makeWarpingControl(config.warp)
+
+    # find the patches each exposure overlaps from its header
+    items = []
+    numExposuresFailed = 0
+    numExposuresSkipped = 0
+    for exposurePath in exposurePathList:
+        try:
+            wcs, bbox = readExposureFootprint(exposurePath)
+        except Exception as e:
+            _log.warn("Cannot read header of exposure %s: %s" % (exposurePath, e))
+            numExposuresFailed += 1
+            continue
+        patchList = [patch for patch in patches
+                     if footprintOverlapsCoadd(wcs, bbox, patch.wcs, patch.bbox, padding=padding)]
+        if patchList:
+            items.append((exposurePath, wcs, bbox, patchList))
+        else:
+            numExposuresSkipped += 1
+    _log.info("%d exposures overlap at least one of %d patches; %d overlap none" %
+              (len(items), len(patches), numExposuresSkipped))
+
+    numExposuresRead = 0
+    numPatchExposures = 0
+    maxInFlight = config.maxInFlight or 2 * config.numReadThreads
+    prefetcher = None
+    if config.numPrefetch > 0:
+        prefetcher = Prefetcher([item[0] for item in items], numAhead=config.numPrefetch)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=config.numReadThreads) as executor:
+        itemIter = iter(items) if prefetcher is None else \
+            (item for item, _ in zip(items, prefetcher))
+
+        def submit(item):
+            return item, executor.submit(_readExposure, item, padding, config.doMinimalRead)
+
+        pending = collections.deque(submit(item) for item in itertools.islice(itemIter, maxInFlight))
+        try:
+            while pending:
+                (exposurePath, wcs, bbox, patchList), future = pending.popleft()
+                try:
+                    exposure = future.result()
+                    if exposure is None:
+                        numExposuresSkipped += 1
+                except Exception as e:
+                    _log.warn("Exposure %s failed: %s\n%s" % (exposurePath, e, traceback.format_exc()))
+                    numExposuresFailed += 1
+                    exposure = None
+                for item in itertools.islice(itemIter, 1):
+                    pending.append(submit(item))
+                if exposure is None:
+                    continue
+                numExposuresRead += 1
+
+                # add to the patches in memory first, to spill as few as possible
+                patchList = sorted(patchList, key=lambda patch: not pool.isOpen(patch.name))
+                for patch in patchList:
+                    coadd = pool.get(patch.name)
+                    # the exposure is added tile by tile, so a failure leaves part of it in the patch
+                    try:
+                        coadd.warpAndAddExposure(exposure, warpingControl, exposureId=exposurePath,
+                                                 tileSize=config.tileSize)
+                    except Exception as e:
+                        raise RuntimeError("Exposure %s failed in patch %s, which may hold part of it: %s" %
+                                           (exposurePath, patch.name, e)) from e
+                    numPatchExposures += 1
+                del exposure
+        finally:
+            for item, future in pending:
+                future.cancel()
+            if prefetcher is not None:
+                prefetcher.close()
+
+    coaddPaths = collections.OrderedDict()
+    for name, coadd in pool.items():
+        coaddPath = os.path.join(outputDir, "%s.fits" % (name,))
+        coadd.getCoadd().writeFits(coaddPath)
+        coadd.getWeightMap().writeFits(os.path.join(outputDir, "%s_weight.fits" % (name,)))
+        _log.info("Wrote coadd of patch %s with %d exposures: %s" %
+                  (name, len(coadd.getConsumedIds()), coaddPath))
+        coaddPaths[name] = coaddPath
+    coaddPaths = collections.OrderedDict((patch.name, coaddPaths[patch.name]) for patch in patches)
+
+    return MultiPatchCoaddResult(
+        coaddPaths=coaddPaths,
+        numExposuresRead=numExposuresRead,
+        numExposuresFailed=numExposuresFailed,
+        numExposuresSkipped=numExposuresSkipped,
+        numPatchExposures=numPatchExposures,
+        numSpills=pool.numSpills,
+        numReloads=pool.numReloads,
+        elapsedTime=time.time() - startTime,
+    )
+
+
+def makePatchGrid(wcs, bbox, numX, numY):
+    """Divide a region into a grid of patches with a common WCS
+
+    Parameters
+    ----------
+    wcs : `lsst.afw.geom.SkyWcs`
+        WCS of the region, shared by all patches.
+    bbox : `lsst.afw.geom.Box2I`
+        Bounding box of the region in parent coordinates.
+    numX, numY : `int`
+        Number of patches in x and y; patches differ in size by at most one
+        pixel.
+
+    Returns
+    -------
+    patches : `list` of `Patch`
+        Patches named "x,y" by grid index, in order of increasing y then x.
+    """
+    xEdges = [bbox.getMinX() + (bbox.getWidth() * i) // numX for i in range(numX + 1)]
+    yEdges = [bbox.getMinY() + (bbox.getHeight() * j) // numY for j in range(numY + 1)]
+    return [Patch(name="%d,%d" % (i, j), wcs=wcs,
+                  bbox=afwGeom.Box2I(afwGeom.Point2I(xEdges[i], yEdges[j]),
+                                     afwGeom.Point2I(xEdges[i + 1] - 1, yEdges[j + 1] - 1)))
+            for j in range(numY) for i in range(numX)]
+
+
+def _readExposure(item, padding, doMinimalRead):
+    """Read the part of an exposure that can be warped into the patches it
+    overlaps, or return None if there is no such part; called on a read
+    thread
+    """
+    exposurePath, wcs, bbox, patchList = item
+    if not doMinimalRead:
+        return afwImage.ExposureF(exposurePath)
+    inputBBox = afwGeom.Box2I()
+    for patch in patchList:
+        patchInputBBox = getInputBBox(wcs, bbox, patch.wcs, patch.bbox, padding=padding)
+        if not patchInputBBox.isEmpty():
+            inputBBox.include(patchInputBBox)
+    if inputBBox.isEmpty():
+        # the footprint test is conservative; no pixel of this exposure reaches a patch
+        return None
+    return afwImage.ExposureF(exposurePath, 0, inputBBox, afwImage.PARENT)
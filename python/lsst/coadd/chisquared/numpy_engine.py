@@ -0,0 +1,118 @@
+#
+# LSST Data Management System
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+# See the COPYRIGHT file
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+"""Chi-squared accumulation on plain NumPy arrays
+
+This performs the same update as the C++ `lsst.coadd.chisquared.addToCoadd`,
+but on NumPy arrays (or views of them) instead of afw images, so callers that
+already hold arrays do not need to build `lsst.afw.image.MaskedImage` wrappers.
+"""
+import numpy as np
+
+__all__ = ["addToCoadd"]
+
+
+def addToCoadd(coadd, coaddMask, weightMap, image, mask, variance, badPixelMask, weight,
+               chunkSize=1 << 16):
+    """Add good pixels from image arrays to coadd arrays, in place, using
+    the chi squared algorithm
+
+    For good pixels (mask & badPixelMask == 0) the coadd arrays are altered
+    as follows:
+    coadd += image**2 / variance
+    coaddMask |= mask
+    weightMap += weight
+    For bad pixels the coadd arrays are not altered.
+
+    All arrays must have the same shape; to add a region of overlap pass
+    slices (views) of the arrays. The image is converted to the coadd dtype
+    before it is squared, exactly as in the C++ kernel, so the results are
+    identical to `lsst.coadd.chisquared.addToCoadd`.
+
+    Parameters
+    ----------
+    coadd : `numpy.ndarray`
+        Coadd image plane (float32 or float64); modified in place.
+    coaddMask : `numpy.ndarray`
+        Coadd mask plane (integer); modified in place.
+    weightMap : `numpy.ndarray`
+        Weight map; modified in place.
+    image : `numpy.ndarray`
+        Image plane of the data to add.
+    mask : `numpy.ndarray`
+        Mask plane of the data to add.
+    variance : `numpy.ndarray`
+        Variance plane of the data to add.
+    badPixelMask : `int`
+        Skip input pixel if mask & badPixelMask != 0.
+    weight : scalar
+        Relative weight of this image; converted to the dtype of weightMap.
+    chunkSize : `int`, optional
+        Approximate number of pixels processed at a time; this bounds the
+        size of the temporary arrays.
+
+    Returns
+    -------
+    numGood : `int`
+        Number of pixels added.
+
+    Raises
+    ------
+    ValueError
+        If the arrays are not two-dimensional with the same shape,
+        or if chunkSize < 1.
+    """
+    arrays = (coadd, coaddMask, weightMap, image, mask, variance)
+    shape = coadd.shape
+    if len(shape) != 2 or any(arr.shape != shape for arr in arrays):
+        raise ValueError("All arrays must be 2-dimensional with the same shape; shapes = %s" %
+                         ([arr.shape for arr in arrays],))
+    if chunkSize < 1:
+        raise ValueError("chunkSize = %s < 1" % (chunkSize,))
+
+    height, width = shape
+    chunkRows = max(1, chunkSize // max(1, width))
+    bufferRows = min(chunkRows, height)
+    valueBuffer = np.empty((bufferRows, width), dtype=coadd.dtype)
+    maskBuffer = np.empty((bufferRows, width), dtype=mask.dtype)
+    isGoodBuffer = np.empty((bufferRows, width), dtype=bool)
+    badPixelMask = np.array(badPixelMask).astype(mask.dtype)
+    weight = weightMap.dtype.type(weight)
+
+    numGood = 0
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        for beginY in range(0, height, chunkRows):
+            rows = slice(beginY, min(beginY + chunkRows, height))
+            numRows = rows.stop - rows.start
+            value = valueBuffer[:numRows]
+            maskedBits = maskBuffer[:numRows]
+            isGood = isGoodBuffer[:numRows]
+
+            np.bitwise_and(mask[rows], badPixelMask, out=maskedBits)
+            np.equal(maskedBits, 0, out=isGood)
+            np.multiply(image[rows], image[rows], out=value, dtype=value.dtype)
+            np.divide(value, variance[rows], out=value, dtype=value.dtype)
+
+            np.add(coadd[rows], value, out=coadd[rows], where=isGood)
+            np.bitwise_or(coaddMask[rows], mask[rows], out=coaddMask[rows], where=isGood)
+            np.add(weightMap[rows], weight, out=weightMap[rows], where=isGood)
+            numGood += int(np.count_nonzero(isGood))
+    return numGood
@@ -0,0 +1,142 @@
+#
+# LSST Data Management System
+# Copyright 2008-2018 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Read files ahead of their use on a background thread
+
+Reading a file into a buffer releases the GIL, so a `Prefetcher` thread
+overlaps file I/O with whatever the other threads are doing, and the later
+read of each file (e.g. by afw, in this or another process) is served from
+the OS page cache. Whole files are read, so prefetching only pays off if
+most of each file will be read anyway, or if the storage has a high latency
+per read.
+"""
+import queue
+import threading
+import time
+
+__all__ = ["Prefetcher"]
+
+
+class Prefetcher:
+    """Read files on a background thread, ahead of their use, so that later
+    reads of them are served from the OS page cache
+
+    Iterating over a Prefetcher yields the paths in order, each once it has
+    been read; at most ``numAhead`` paths are read ahead of the iteration.
+    Files that cannot be read are yielded anyway, so the reader reports the
+    failure.
+
+    Parameters
+    ----------
+    pathList : `list` of `str`
+        Paths of the files to read.
+    numAhead : `int`
+        Maximum number of files read but not yet yielded; at least 1.
+    bufferSize : `int`, optional
+        Size of the buffer into which files are read (bytes).
+
+    Attributes
+    ----------
+    readTime : `float`
+        Time the background thread spent reading (sec).
+    readBytes : `int`
+        Number of bytes read by the background thread.
+    readTimes : `dict` of `str`: `float`
+        Time the background thread spent reading each file (sec), summed
+        if a path is listed more than once.
+    waitTime : `float`
+        Time spent waiting for the next file to be read (sec).
+    hiddenTime : `float`
+        Time the background thread spent reading files that was not
+        waited for (sec): the sum over the yielded files of the time spent
+        reading each, less the time spent waiting for it. This is the I/O
+        wait that prefetching took off the iterating thread, if the reader
+        of each file would have read all of it.
+
+    Raises
+    ------
+    ValueError
+        If ``numAhead`` < 1.
+    """
+    _End = object()
+
+    def __init__(self, pathList, numAhead, bufferSize=1 << 22):
+        if numAhead < 1:
+            # a queue of maxsize 0 is unbounded, so the thread would read every file at once
+            raise ValueError("numAhead = %s < 1" % (numAhead,))
+        self.readTime = 0.0
+        self.readBytes = 0
+        self.readTimes = {}
+        self.waitTime = 0.0
+        self.hiddenTime = 0.0
+        self._queue = queue.Queue(maxsize=numAhead)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(list(pathList), bufferSize), daemon=True)
+        self._thread.start()
+
+    def __iter__(self):
+        while True:
+            startTime = time.time()
+            item = self._queue.get()
+            waitTime = time.time() - startTime
+            self.waitTime += waitTime
+            if item is self._End:
+                return
+            path, readTime = item
+            self.hiddenTime += max(0.0, readTime - waitTime)
+            yield path
+
+    def close(self):
+        """Stop reading and wait for the background thread to exit
+        """
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self, pathList, bufferSize):
+        buffer = bytearray(bufferSize)
+        for path in pathList:
+            startTime = time.time()
+            try:
+                with open(path, "rb", buffering=0) as infile:
+                    while not self._stop.is_set():
+                        numBytes = infile.readinto(buffer)
+                        if not numBytes:
+                            break
+                        self.readBytes += numBytes
+            except OSError:
+                pass
+            readTime = time.time() - startTime
+            self.readTimes[path] = self.readTimes.get(path, 0.0) + readTime
+            self.readTime += readTime
+            if not self._put((path, readTime)):
+                return
+        self._put(self._End)
+
+    def _put(self, item):
+        """Put an item on the queue, giving up if close is called
+        """
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
@@ -0,0 +1,426 @@
+#
+# LSST Data Management System
+# Copyright 2008-2018 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+import collections
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import lsst.pex.config as pexConfig
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+from . addToCoadd import AddToCoaddStatistics, addToCoadd
+from . coadd import Coadd, CoaddConfig, makeVarianceModel
+
+__all__ = ["SharedMemoryCoadd", "SharedMemoryCoaddConfig", "SharedMemoryCoaddHandle",
+           "SharedMemoryCoaddWriter"]
+
+SharedMemoryCoaddHandle = collections.namedtuple(
+    "SharedMemoryCoaddHandle", ["shmNames", "minX", "minY", "width", "height", "doubleAccumulator",
+                                "badPixelMask", "stripeRows", "locks"])
+"""Description of the accumulator of a `SharedMemoryCoadd`, from which
+another process can attach a `SharedMemoryCoaddWriter`: the names of the
+shared memory blocks of the coadd image, coadd mask and weight map, the
+bounding box of the coadd, whether the image is double precision, the bad
+pixel mask, the number of rows in each stripe and the lock of each stripe.
+
+The locks can only be passed to a process as it is started, e.g. in
+``initargs`` of `concurrent.futures.ProcessPoolExecutor`, not with a task.
+"""
+
+
+class SharedMemoryCoaddConfig(CoaddConfig):
+    """Config for a chi-squared Coadd in shared memory
+    """
+    stripeRows = pexConfig.Field(
+        dtype=int,
+        doc="Number of accumulator rows guarded by each lock; writers only wait for each other "
+            "while adding to the same stripe",
+        default=64,
+        check=lambda n: n >= 1,
+    )
+
+
+class SharedMemoryCoadd(Coadd):
+    """Create a chi-squared coadd whose accumulator lives in shared memory,
+    so that several processes can add exposures to it at once
+
+    The coadd image, coadd mask and weight map are stored in
+    `multiprocessing.shared_memory` blocks. Other processes attach to them
+    with `SharedMemoryCoaddWriter` and add exposures directly, so warped
+    exposures never have to be sent back to this process. The accumulator
+    is divided into stripes of ``stripeRows`` rows, each with its own lock;
+    a writer holds one lock at a time while it adds the rows of a stripe,
+    so writers adding to different stripes never wait for each other.
+
+    Exposures added by writers are only recorded in this coadd (consumed
+    IDs, filters and statistics) when `recordExposure` is called with the
+    statistics the writer returned. The sum of each pixel does not depend
+    on which process added which exposure, but the order of summation
+    does, so the result may differ from a serial coadd by rounding.
+
+    Call `close` when done with the coadd to free the shared memory;
+    the coadd can also be used as a context manager.
+
+    Parameters
+    ----------
+    bbox : `lsst.afw.geom.Box2I`
+        Bounding box of coadd Exposure with respect to parent:
+        coadd dimensions = bbox.getDimensions(); xy0 = bbox.getMin()
+    wcs : `lsst.afw.geom.SkyWcs`
+        WCS of coadd exposure
+    badMaskPlanes : `list` of `str`
+        Mask planes to pay attention to when rejecting masked pixels.
+        Specify as a collection of names.
+        badMaskPlanes should always include "EDGE".
+    stripeRows : `int`, optional
+        Number of accumulator rows guarded by each lock.
+    numThreads : `int`, optional
+        Number of threads used to add each stripe of an exposure added
+        by this process.
+    doubleAccumulator : `bool`, optional
+        If True, accumulate the coadd image in double precision.
+    logName : `str`, optional
+        Name by which messages are logged.
+
+    Raises
+    ------
+    ValueError
+        If ``stripeRows`` < 1.
+    """
+    ConfigClass = SharedMemoryCoaddConfig
+
+    def __init__(self, bbox, wcs, badMaskPlanes, stripeRows=64, numThreads=1, doubleAccumulator=False,
+                 logName="coadd.chisquared.SharedMemoryCoadd"):
+        if stripeRows < 1:
+            raise ValueError("stripeRows = %s < 1" % (stripeRows,))
+        # the base class allocates the accumulator in memory; give it a single pixel
+        # to allocate, then replace it with shared memory
+        Coadd.__init__(self,
+                       bbox=afwGeom.Box2I(bbox.getMin(), afwGeom.Extent2I(1, 1)),
+                       wcs=wcs,
+                       badMaskPlanes=badMaskPlanes,
+                       numThreads=numThreads,
+                       doubleAccumulator=doubleAccumulator,
+                       logName=logName,
+                       )
+        self._bbox = afwGeom.Box2I(bbox)
+        self._coadd = None
+        self._weightMap = None
+
+        shape = (bbox.getHeight(), bbox.getWidth())
+        shmList = []
+        try:
+            for dtype in _getPlaneDtypes(doubleAccumulator):
+                shmList.append(shared_memory.SharedMemory(
+                    create=True, size=max(1, shape[0] * shape[1] * dtype.itemsize)))
+        except Exception:
+            for shm in shmList:
+                shm.close()
+                shm.unlink()
+            raise
+        numStripes = (shape[0] + stripeRows - 1) // stripeRows
+        self._handle = SharedMemoryCoaddHandle(
+            shmNames=tuple(shm.name for shm in shmList),
+            minX=bbox.getMinX(),
+            minY=bbox.getMinY(),
+            width=bbox.getWidth(),
+            height=bbox.getHeight(),
+            doubleAccumulator=doubleAccumulator,
+            badPixelMask=self._badPixelMask,
+            stripeRows=stripeRows,
+            locks=tuple(multiprocessing.Lock() for i in range(numStripes)),
+        )
+        self._writer = SharedMemoryCoaddWriter(self._handle, numThreads=numThreads, _shmList=shmList)
+        # the contents of new shared memory are not guaranteed on every platform
+        for plane in self._writer._planes:
+            plane[:] = 0
+
+    @classmethod
+    def fromConfig(cls, bbox, wcs, config, logName="coadd.chisquared.SharedMemoryCoadd"):
+        """Create a shared memory chi-squared coadd from a config
+
+        Parameters
+        ----------
+        bbox : `lsst.afw.geom.Box2I`
+            Bounding box of coadd Exposure with respect to parent.
+        wcs : `lsst.afw.geom.SkyWcs`
+            WCS of coadd exposure
+        config : `SharedMemoryCoaddConfig`
+            Coadd config.
+        logName : `str`, optional
+            Name by which messages are logged.
+        """
+        return cls(bbox=bbox,
+                   wcs=wcs,
+                   badMaskPlanes=config.badMaskPlanes,
+                   stripeRows=config.stripeRows,
+                   numThreads=config.numThreads,
+                   doubleAccumulator=config.doubleAccumulator,
+                   logName=logName,
+                   )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Free the shared memory of the accumulator
+
+        Writers in other processes must not add to the coadd afterwards.
+        The coadd cannot be used once closed; calling this again does
+        nothing.
+        """
+        if self._writer is None:
+            return
+        shmList = self._writer._shmList
+        self._writer.close()
+        self._writer = None
+        for shm in shmList:
+            shm.unlink()
+
+    def getHandle(self):
+        """Return the handle from which other processes attach a
+        `SharedMemoryCoaddWriter`
+
+        Returns
+        -------
+        handle : `SharedMemoryCoaddHandle`
+            Handle of the accumulator; pass it to worker processes as they
+            are started.
+        """
+        return self._handle
+
+    def getStripeRows(self):
+        """Return the number of accumulator rows guarded by each lock
+        """
+        return self._handle.stripeRows
+
+    def recordExposure(self, statistics, filterName=None, exposureId=None):
+        """Record an exposure that a writer has added to the accumulator
+
+        Parameters
+        ----------
+        statistics : `AddToCoaddStatistics`
+            Statistics returned by `SharedMemoryCoaddWriter.addExposure`.
+        filterName : `str`, optional
+            Name of the filter of the exposure.
+        exposureId : `str` or `int`, optional
+            Identifier of the exposure, recorded in the list of consumed
+            exposures (see `getConsumedIds`) and saved with checkpoints.
+        """
+        if filterName is not None:
+            self._filterDict.setdefault(filterName, afwImage.Filter(filterName, True))
+        self._recordExposure(exposureId, statistics)
+
+    def getCoadd(self):
+        """Get the coadd exposure for all exposures you have coadded so far
+
+        Exposures that writers are adding at the same time may be partly
+        included.
+
+        Returns
+        -------
+        coaddExposure : `lsst.afw.image.ExposureF`
+            Coadd, scaled by the weight map.
+        """
+        image, mask, weightMap = self._writer._planes
+        maskedImage = afwImage.MaskedImageF(self._bbox)
+        maskedImage.getImage().getArray()[:] = image
+        maskedImage.getMask().getArray()[:] = mask
+        return self._makeScaledExposure(maskedImage, self.getWeightMap())
+
+    def getWeightMap(self):
+        """Return a copy of the weight map
+        """
+        weightMap = afwImage.ImageF(self._bbox)
+        weightMap.getArray()[:] = self._writer._planes[2]
+        return weightMap
+
+    def _addMaskedImage(self, maskedImage, weight, statistics, varianceModel=None):
+        """Add a masked image to the accumulator one stripe at a time,
+        holding the lock of each stripe
+        """
+        return self._writer._addMaskedImage(maskedImage, weight, statistics, varianceModel=varianceModel)
+
+    def _getPlanes(self, bbox):
+        """Return views of a region of the accumulator planes in shared
+        memory, for reading
+        """
+        slices = self._getSlices(bbox)
+        return tuple(plane[slices] for plane in self._writer._planes)
+
+    def _addPlanes(self, bbox, image, mask, weightMap):
+        """Add accumulator planes of another coadd to a region of this one,
+        holding the lock of each stripe
+        """
+        rowSlice, colSlice = self._getSlices(bbox)
+        accImage, accMask, accWeightMap = self._writer._planes
+        for beginY, endY, lock in self._writer._iterStripes(rowSlice.start, rowSlice.stop):
+            rows = slice(beginY - rowSlice.start, endY - rowSlice.start)
+            with lock:
+                accImage[beginY:endY, colSlice] += image[rows]
+                accMask[beginY:endY, colSlice] |= mask[rows]
+                accWeightMap[beginY:endY, colSlice] += weightMap[rows]
+
+    def _copyAccumulator(self):
+        """Return in-memory copies of the accumulator and weight map
+        """
+        MaskedImageClass = afwImage.MaskedImageD if self._doubleAccumulator else afwImage.MaskedImageF
+        maskedImage = MaskedImageClass(self._bbox)
+        image, mask, weightMap = self._writer._planes
+        maskedImage.getImage().getArray()[:] = image
+        maskedImage.getMask().getArray()[:] = mask
+        return maskedImage, self.getWeightMap()
+
+    def _restoreAccumulator(self, maskedImage, weightMap):
+        """Copy saved copies of the accumulator and weight map to shared
+        memory
+        """
+        image, mask, accWeightMap = self._writer._planes
+        image[:] = maskedImage.getImage().getArray()
+        mask[:] = maskedImage.getMask().getArray()
+        accWeightMap[:] = weightMap.getArray()
+
+
+class SharedMemoryCoaddWriter:
+    """Add exposures to the accumulator of a `SharedMemoryCoadd` that
+    belongs to another process
+
+    Parameters
+    ----------
+    handle : `SharedMemoryCoaddHandle`
+        Handle returned by `SharedMemoryCoadd.getHandle`.
+    numThreads : `int`, optional
+        Number of threads used to add each stripe of an exposure.
+
+    Notes
+    -----
+    Attach writers only in processes started by the process that owns the
+    coadd (e.g. by `concurrent.futures.ProcessPoolExecutor`), which share
+    its resource tracker; the owner frees the shared memory.
+    """
+
+    def __init__(self, handle, numThreads=1, _shmList=None):
+        if _shmList is None:
+            _shmList = [shared_memory.SharedMemory(name=name) for name in handle.shmNames]
+        self._handle = handle
+        self._numThreads = numThreads
+        self._shmList = _shmList
+        self._bbox = afwGeom.Box2I(afwGeom.Point2I(handle.minX, handle.minY),
+                                   afwGeom.Extent2I(handle.width, handle.height))
+        shape = (handle.height, handle.width)
+        self._planes = tuple(np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+                             for shm, dtype in zip(_shmList, _getPlaneDtypes(handle.doubleAccumulator)))
+        # the coadd variance plane is never altered, so one zero stripe serves for all
+        self._variance = np.zeros((min(handle.stripeRows, handle.height), handle.width), dtype=np.float32)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Detach from the shared memory; calling this again does nothing
+        """
+        # the shared memory cannot be closed while views of it exist
+        self._planes = ()
+        for shm in self._shmList:
+            shm.close()
+        self._shmList = []
+
+    def getBBox(self):
+        """Return the bounding box of the coadd
+        """
+        return afwGeom.Box2I(self._bbox)
+
+    def addExposure(self, exposure, weightFactor=1.0, varianceModel=None):
+        """Add an exposure to the accumulator; it is assumed to have the
+        same WCS as the coadd
+
+        Parameters
+        ----------
+        exposure : `lsst.afw.image.Exposure`
+            Exposure to add to coadd, warped to match the coadd.
+        weightFactor : `float`
+            weight with which to add exposure to coadd
+        varianceModel : `lsst.coadd.chisquared.VarianceModel` or `float`, optional
+            Model of the variance of ``exposure``, or a constant variance,
+            used instead of its variance plane; see `Coadd.addExposure`.
+
+        Returns
+        -------
+        overlapBBox : `lsst.afw.geom.Box2I`
+            Region of overlap between ``exposure`` and coadd in parent
+            coordinates.
+        statistics : `AddToCoaddStatistics`
+            Statistics of the pixels that were added and rejected; pass
+            them to `SharedMemoryCoadd.recordExposure`.
+        """
+        statistics = AddToCoaddStatistics()
+        overlapBBox = self._addMaskedImage(exposure.getMaskedImage(), weightFactor, statistics,
+                                           varianceModel=makeVarianceModel(varianceModel))
+        return overlapBBox, statistics
+
+    def _addMaskedImage(self, maskedImage, weight, statistics, varianceModel=None):
+        """Add a masked image to the accumulator one stripe at a time,
+        holding the lock of each stripe
+        """
+        overlapBBox = afwGeom.Box2I(self._bbox)
+        overlapBBox.clip(maskedImage.getBBox())
+        if overlapBBox.isEmpty():
+            return overlapBBox
+
+        image, mask, weightMap = self._planes
+        beginY = overlapBBox.getMinY() - self._bbox.getMinY()
+        endY = overlapBBox.getMaxY() + 1 - self._bbox.getMinY()
+        for stripeBeginY, stripeEndY, lock in self._iterStripes(beginY, endY):
+            xy0 = afwGeom.Point2I(self._bbox.getMinX(), self._bbox.getMinY() + stripeBeginY)
+            coaddStripe = afwImage.makeMaskedImageFromArrays(image[stripeBeginY:stripeEndY],
+                                                             mask[stripeBeginY:stripeEndY],
+                                                             self._variance[:stripeEndY - stripeBeginY])
+            coaddStripe.setXY0(xy0)
+            weightMapStripe = afwImage.makeImageFromArray(weightMap[stripeBeginY:stripeEndY])
+            weightMapStripe.setXY0(xy0)
+            with lock:
+                addToCoadd(coaddStripe, weightMapStripe, maskedImage, self._handle.badPixelMask, weight,
+                           statistics, numThreads=self._numThreads, varianceModel=varianceModel)
+        return overlapBBox
+
+    def _iterStripes(self, beginY, endY):
+        """Iterate over (stripeBeginY, stripeEndY, lock) for the part of
+        each stripe in rows [beginY, endY) of the accumulator
+        """
+        stripeRows = self._handle.stripeRows
+        for stripe in range(beginY // stripeRows, (endY - 1) // stripeRows + 1):
+            yield (max(beginY, stripe * stripeRows), min(endY, (stripe + 1) * stripeRows),
+                   self._handle.locks[stripe])
+
+
+def _getPlaneDtypes(doubleAccumulator):
+    """Return the dtypes of the coadd image, coadd mask and weight map
+    """
+    return (np.dtype(np.float64 if doubleAccumulator else np.float32), np.dtype(np.int32),
+            np.dtype(np.float32))
@@ -0,0 +1,212 @@
+#
+# LSST Data Management System
+# Copyright 2008-2018 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Optional tracing of where a coadd pipeline spends its time
+
+A `Tracer` records spans: named intervals of wall time, each tagged with the
+process and thread that ran it and optional arguments (e.g. the exposure).
+Spans can be exported as Chrome trace-event JSON, for viewing in
+chrome://tracing or https://ui.perfetto.dev, or summarized as a table.
+
+When tracing is disabled use `NullTracer`, whose `span` returns a shared
+do-nothing context manager, so instrumented code costs one method call per
+span and records nothing.
+"""
+import collections
+import json
+import os
+import threading
+import time
+
+__all__ = ["Tracer", "NullTracer", "Span"]
+
+Span = collections.namedtuple("Span", ["name", "startTime", "duration", "pid", "tid", "args"])
+"""One traced interval: name, start time (sec since the epoch), duration
+(sec), process ID, thread ID and a `dict` of arguments (or None).
+"""
+
+
+class Tracer:
+    """Record spans of wall time
+
+    Spans may be recorded from any thread of this process; spans recorded
+    in other processes (e.g. a pool of workers, each with its own Tracer)
+    can be added with `addSpans`.
+    """
+    enabled = True
+
+    def __init__(self):
+        self._spans = []
+        self._lock = threading.Lock()
+
+    def span(self, name, **args):
+        """Return a context manager that records a span around its body
+
+        Parameters
+        ----------
+        name : `str`
+            Name of the span, e.g. "read" or "warp".
+        **args
+            Arguments recorded with the span, e.g. ``exposure=path``.
+        """
+        return _SpanContext(self, name, args or None)
+
+    def addSpans(self, spans):
+        """Add spans, e.g. ones recorded by another process
+
+        Parameters
+        ----------
+        spans : iterable of `Span`
+            Spans to add.
+        """
+        with self._lock:
+            self._spans.extend(spans)
+
+    def getSpans(self):
+        """Return a list of the spans recorded so far, ordered by start time
+        """
+        with self._lock:
+            return sorted(self._spans, key=lambda span: span.startTime)
+
+    def clear(self):
+        """Discard the spans recorded so far
+        """
+        with self._lock:
+            self._spans = []
+
+    def toChromeTrace(self):
+        """Return the spans in Chrome trace-event format
+
+        Returns
+        -------
+        trace : `dict`
+            Trace with one complete ("X") event per span; times are in
+            microseconds.
+        """
+        events = []
+        for span in self.getSpans():
+            event = dict(name=span.name, cat="coadd", ph="X", ts=span.startTime * 1e6,
+                         dur=span.duration * 1e6, pid=span.pid, tid=span.tid)
+            if span.args:
+                event["args"] = span.args
+            events.append(event)
+        return dict(traceEvents=events, displayTimeUnit="ms")
+
+    def writeChromeTrace(self, path):
+        """Write the spans to a file in Chrome trace-event JSON format
+        """
+        with open(path, "w") as outfile:
+            json.dump(self.toChromeTrace(), outfile)
+
+    def getSummary(self):
+        """Summarize the spans by name
+
+        Returns
+        -------
+        summary : `dict` of `str`: `dict`
+            For each span name, in order of first appearance: count, total,
+            mean and max duration (sec).
+        """
+        summary = collections.OrderedDict()
+        for span in self.getSpans():
+            entry = summary.setdefault(span.name, dict(count=0, total=0.0, max=0.0))
+            entry["count"] += 1
+            entry["total"] += span.duration
+            entry["max"] = max(entry["max"], span.duration)
+        for entry in summary.values():
+            entry["mean"] = entry["total"] / entry["count"]
+        return summary
+
+    def formatSummary(self):
+        """Return a table summarizing the spans by name, as a `str`
+
+        The table also gives the total duration of each kind of span as a
+        percentage of the wall time from the first span to the end of the
+        last. Spans run in parallel, so the percentages may add up to more
+        than 100.
+        """
+        spans = self.getSpans()
+        if not spans:
+            return "No spans recorded"
+        wallTime = max(span.startTime + span.duration for span in spans) - spans[0].startTime
+        lines = ["%-20s %8s %12s %12s %12s %8s" % ("span", "count", "total (s)", "mean (ms)", "max (ms)",
+                                                  "% wall")]
+        for name, entry in self.getSummary().items():
+            lines.append("%-20s %8d %12.3f %12.3f %12.3f %8.1f" %
+                         (name, entry["count"], entry["total"], entry["mean"] * 1e3, entry["max"] * 1e3,
+                          100.0 * entry["total"] / wallTime if wallTime > 0 else 0.0))
+        lines.append("wall time %.3f s" % (wallTime,))
+        return "\n".join(lines)
+
+
+class NullTracer:
+    """A tracer that records nothing, for when tracing is disabled
+    """
+    enabled = False
+
+    def span(self, name, **args):
+        return _NullSpanContext
+
+    def addSpans(self, spans):
+        pass
+
+    def getSpans(self):
+        return []
+
+    def clear(self):
+        pass
+
+
+class _SpanContext:
+    """Context manager that records a span in a Tracer
+    """
+    __slots__ = ("_tracer", "_name", "_args", "_startTime")
+
+    def __init__(self, tracer, name, args):
+        self._tracer = tracer
+        self._name = name
+        self._args = args
+
+    def __enter__(self):
+        self._startTime = time.time()
+        return self
+
+    def __exit__(self, *args):
+        duration = time.time() - self._startTime
+        span = Span(name=self._name, startTime=self._startTime, duration=duration, pid=os.getpid(),
+                    tid=threading.get_ident(), args=self._args)
+        with self._tracer._lock:
+            self._tracer._spans.append(span)
+
+
+class _NullSpanContextClass:
+    """Context manager that does nothing
+    """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+_NullSpanContext = _NullSpanContextClass()
@@ -0,0 +1,703 @@
+#
+# LSST Data Management System
+# Copyright 2008-2018 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Create a chi-squared coadd by warping exposures in a pool of processes
+
+Warping is CPU bound and holds the GIL, so exposures are read and warped by
+worker processes. Each warped masked image is copied once into a block of
+shared memory and the worker returns only the name of the block; the main
+process wraps the block as an `lsst.afw.image.Exposure` without copying it,
+adds it to the coadd and frees the block. Optionally a thread reads the next
+few input files ahead of the workers, so that their reads are served from
+the OS page cache, and workers read only the part of each exposure that can
+be warped into the coadd.
+"""
+import collections
+import concurrent.futures
+import contextlib
+import itertools
+import os
+import tempfile
+import time
+import traceback
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+import lsst.pex.config as pexConfig
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.afw.math as afwMath
+from lsst.log import Log
+from . coadd import Coadd, readCheckpointManifest
+from . footprint import filterOverlapping, getInputBBox, getWarpingPadding, readExposureFootprint
+from . prefetcher import Prefetcher
+from . sharedMemoryCoadd import SharedMemoryCoadd, SharedMemoryCoaddWriter
+from . tracing import NullTracer, Tracer
+from . warpCache import CachingWarper
+
+__all__ = ["WarpAndCoaddConfig", "WarpAndCoaddResult", "warpAndCoadd", "readExposurePathList"]
+
+_log = Log.getLogger("coadd.chisquared.warpAndCoadd")
+
+# dtypes of the image, mask and variance planes of a warped exposure
+_PlaneDtypes = (np.dtype(np.float32), np.dtype(np.int32), np.dtype(np.float32))
+
+WarpAndCoaddResult = collections.namedtuple(
+    "WarpAndCoaddResult", ["coadd", "numExposuresInCoadd", "numExposuresWarped", "numExposuresFailed",
+                           "numExposuresSkipped", "warpTime", "readTime", "numPixelsRead", "prefetchTime",
+                           "prefetchWaitTime", "prefetchHiddenTime", "prefetchBytes", "exposureReadTimes",
+                           "exposureStatistics", "tracer", "numWarpCacheHits"])
+"""Result of `warpAndCoadd`: the `Coadd`, the number of exposures in it,
+the number of exposures warped and added by this run, the number of
+exposures that could not be read or warped, the number of exposures skipped
+because their footprint does not overlap the coadd, and the wall time (sec)
+spent reading, warping and adding all exposures but the reference. With an
+exposure index, the exposures skipped are those of ``exposurePathList`` that
+the index does not return; other exposures in the index are not counted.
+
+The I/O statistics (sec and bytes) are: the total time workers spent
+reading exposures, the number of input pixels they read, the time the
+prefetch thread spent reading input files ahead of the workers, the time the
+pipeline waited for the prefetch thread, the I/O wait that prefetching hid
+from the pipeline, and the number of bytes the prefetch thread read. The
+hidden I/O wait is the prefetch thread's read time of each file less the
+time the pipeline waited for that file (see `Prefetcher.hiddenTime`); it is
+an upper bound with ``doMinimalRead``, as the prefetch thread reads whole
+files of which the workers read a part.
+
+exposureReadTimes is a `dict` of exposure path: (prefetch read time, worker
+read time) for each exposure read by a worker in this run, so the time the
+prefetch thread spent on a file (None if it was not prefetched) can be
+compared with the time the worker later spent reading it from the cache.
+
+exposureStatistics is a `dict` of exposure path:
+`lsst.coadd.chisquared.AddToCoaddStatistics` for each exposure added by
+this run, in the order they were added.
+
+tracer is the `lsst.coadd.chisquared.tracing.Tracer` holding the spans
+recorded by the run, if ``config.tracePath`` is set, else None.
+
+numWarpCacheHits is the number of exposures whose warped image was read
+from the warp cache (see ``config.warpCacheDir``) instead of being warped.
+"""
+
+# description of a warped exposure in shared memory, returned by worker processes
+_SharedExposure = collections.namedtuple(
+    "_SharedExposure", ["shmName", "minX", "minY", "width", "height", "filterName", "readTime", "readPixels",
+                        "spans", "isCacheHit", "statistics"])
+
+
+class WarpAndCoaddConfig(pexConfig.Config):
+    saveDebugImages = pexConfig.Field(
+        dtype=bool,
+        doc="Save intermediate images?",
+        default=False,
+    )
+    bboxMin = pexConfig.ListField(
+        dtype=int,
+        doc="Lower left corner of bounding box used to subframe to all input images",
+        default=(0, 0),
+        length=2,
+    )
+    bboxSize = pexConfig.ListField(
+        dtype=int,
+        doc="Size of bounding box used to subframe all input images; 0 0 for full input images",
+        default=(0, 0),
+        length=2,
+    )
+    numWorkers = pexConfig.Field(
+        dtype=int,
+        doc="Number of processes used to read and warp exposures while others are added to the coadd",
+        default=4,
+        check=lambda n: n >= 1,
+    )
+    maxInFlight = pexConfig.Field(
+        dtype=int,
+        doc="Maximum number of exposures being warped or waiting to be added; "
+            "this bounds the memory used by warped exposures. 0 for 2 * numWorkers.",
+        default=0,
+        check=lambda n: n >= 0,
+    )
+    doPrefilter = pexConfig.Field(
+        dtype=bool,
+        doc="Skip exposures whose footprint, computed from the WCS in their header, does not overlap "
+            "the coadd, before reading their pixels?",
+        default=True,
+    )
+    doMinimalRead = pexConfig.Field(
+        dtype=bool,
+        doc="Read only the bounding box of input pixels that can be warped into the coadd, computed "
+            "from the WCS of each exposure and padded by the size of the warping kernel?",
+        default=True,
+    )
+    numPrefetch = pexConfig.Field(
+        dtype=int,
+        doc="Number of input files to read ahead of the workers on a background thread, "
+            "so that the workers read them from the OS page cache; 0 to disable. Whole files are read, "
+            "so with doMinimalRead this may read much more than the workers do; it is worthwhile only "
+            "for storage with a high latency per read, or if most of each file is used.",
+        default=0,
+        check=lambda n: n >= 0,
+    )
+    doSharedAccumulator = pexConfig.Field(
+        dtype=bool,
+        doc="Have the workers add warped exposures to an accumulator in shared memory themselves, "
+            "instead of passing them to the main process to add? This bounds the memory used by "
+            "warped exposures to one per worker. Not compatible with checkpointDir.",
+        default=False,
+    )
+    stripeRows = pexConfig.Field(
+        dtype=int,
+        doc="Number of shared accumulator rows guarded by each lock, if doSharedAccumulator",
+        default=64,
+        check=lambda n: n >= 1,
+    )
+    checkpointDir = pexConfig.Field(
+        dtype=str,
+        doc="Directory for checkpoints, from which an interrupted run resumes; None to disable",
+        default=None,
+        optional=True,
+    )
+    checkpointEveryN = pexConfig.Field(
+        dtype=int,
+        doc="Checkpoint after this many exposures have been added",
+        default=50,
+        check=lambda n: n >= 1,
+    )
+    checkpointEverySeconds = pexConfig.Field(
+        dtype=float,
+        doc="Checkpoint after this many seconds",
+        default=600.0,
+        check=lambda t: t > 0,
+    )
+    warpCacheDir = pexConfig.Field(
+        dtype=str,
+        doc="Directory of a cache of warped exposures, keyed by input pixels and WCS, coadd WCS and bbox "
+            "and warp config, so that re-running a coadd over the same inputs skips warping; "
+            "None to disable",
+        default=None,
+        optional=True,
+    )
+    warpCacheMaxBytes = pexConfig.Field(
+        dtype=int,
+        doc="Maximum size of the warp cache (bytes); least recently used entries are evicted",
+        default=10 * 1024**3,
+        check=lambda n: n >= 1,
+    )
+    tracePath = pexConfig.Field(
+        dtype=str,
+        doc="Path to which to write a Chrome trace-event JSON file of spans for reading, warping, "
+            "adding and writing each exposure; None to disable tracing",
+        default=None,
+        optional=True,
+    )
+    coadd = pexConfig.ConfigField(dtype=Coadd.ConfigClass, doc="")
+    warp = pexConfig.ConfigField(dtype=afwMath.Warper.ConfigClass, doc="")
+
+
+def readExposurePathList(exposureListPath):
+    """Read a file containing a list of paths to exposures
+
+    Blank lines and lines that start with # are ignored.
+    """
+    exposurePathList = []
+    with open(exposureListPath, "r") as infile:
+        for exposurePath in infile:
+            exposurePath = exposurePath.strip()
+            if not exposurePath or exposurePath.startswith("#"):
+                continue
+            exposurePathList.append(exposurePath)
+    return exposurePathList
+
+
+def warpAndCoadd(coaddPath, exposurePathList, config, exposureIndex=None):
+    """Create a coadd by warping exposures and write it
+
+    Parameters
+    ----------
+    coaddPath : `str`
+        Path to desired coadd; overwritten if it exists. The weight map is
+        written to the same path with "_weight" appended to the base name.
+    exposurePathList : `list` of `str`
+        Paths to input exposures. The first exposure that can be read is
+        used as the reference: it is added without warping and all other
+        exposures are warped to match it.
+    config : `WarpAndCoaddConfig`
+        Configuration.
+    exposureIndex : `lsst.coadd.chisquared.exposureIndex.ExposureIndex`, optional
+        Index of input exposure footprints. If specified, the exposures to
+        warp are those the index returns for the coadd, in place of the rest
+        of ``exposurePathList`` (which then need only contain the reference),
+        and ``config.doPrefilter`` is ignored.
+
+    Returns
+    -------
+    result : `WarpAndCoaddResult`
+        The coadd and statistics.
+
+    Notes
+    -----
+    If ``config.tracePath`` is set then the time spent reading, warping,
+    adding and writing is traced, in the workers as well as in this
+    process, and the trace is written to that path.
+
+    If ``config.checkpointDir`` is set then checkpoints are written there
+    and, if it already holds one, the run resumes from it: exposures
+    recorded in the checkpoint are skipped (exposures that failed are tried
+    again).
+
+    If ``config.doSharedAccumulator`` is set then the coadd is accumulated
+    in a `lsst.coadd.chisquared.sharedMemoryCoadd.SharedMemoryCoadd`, to
+    which the workers add the exposures they warp, and is copied into the
+    returned `Coadd` at the end. The order in which exposures are summed
+    then depends on timing, so pixel values may differ by rounding from
+    run to run.
+
+    Raises
+    ------
+    ValueError
+        If ``config.doSharedAccumulator`` and ``config.checkpointDir`` are
+        both set; a checkpoint could hold part of an exposure.
+    RuntimeError
+        If no exposure could be processed.
+    """
+    if config.doSharedAccumulator and config.checkpointDir is not None:
+        raise ValueError("Cannot checkpoint a coadd accumulated in shared memory")
+    weightPath = os.path.splitext(coaddPath)[0] + "_weight.fits"
+    bbox = afwGeom.Box2I(
+        afwGeom.Point2I(config.bboxMin[0], config.bboxMin[1]),
+        afwGeom.Extent2I(config.bboxSize[0], config.bboxSize[1]),
+    )
+
+    coadd = None
+    numExposuresInCoadd = 0
+    numExposuresWarped = 0
+    numExposuresFailed = 0
+    readTime = 0.0
+    numPixelsRead = 0
+    numWarpCacheHits = 0
+    exposureStatistics = collections.OrderedDict()
+    exposureReadTimes = collections.OrderedDict()
+    tracer = NullTracer() if config.tracePath is None else Tracer()
+    if config.checkpointDir is not None and readCheckpointManifest(config.checkpointDir) is not None:
+        _log.info("Resume from checkpoint in %s" % (config.checkpointDir,))
+        coadd = Coadd.fromCheckpoint(config.checkpointDir, numThreads=config.coadd.numThreads)
+        numExposuresInCoadd = len(coadd.getConsumedIds())
+        remainingItems = [(expNum, exposurePath)
+                          for expNum, exposurePath in enumerate(exposurePathList, 1)
+                          if not coadd.isConsumed(exposurePath)]
+        _log.info("Skipping %d exposures already in the coadd" % (numExposuresInCoadd,))
+
+    if coadd is None:
+        # process the reference exposure; if it cannot be read, try the next one
+        for expNum, exposurePath in enumerate(exposurePathList, 1):
+            try:
+                _log.info("Processing reference exposure: %s" % (exposurePath,))
+                with tracer.span("read", exposure=exposurePath):
+                    exposure = afwImage.ExposureF(exposurePath, 0, bbox, afwImage.LOCAL)
+                if config.saveDebugImages:
+                    exposure.writeFits("exposure%s.fits" % (expNum,))
+                coadd = Coadd.fromConfig(
+                    bbox=exposure.getBBox(),
+                    wcs=exposure.getWcs(),
+                    config=config.coadd)
+                with tracer.span("addExposure", exposure=exposurePath):
+                    coadd.addExposure(exposure, exposureId=exposurePath)
+                exposureStatistics[exposurePath] = _logStatistics(exposurePath, coadd.getLastStatistics())
+                numExposuresInCoadd += 1
+                remainingItems = list(enumerate(exposurePathList[expNum:], expNum + 1))
+                break
+            except Exception as e:
+                _log.warn("Exposure %s failed: %s\n%s" % (exposurePath, e, traceback.format_exc()))
+                numExposuresFailed += 1
+        else:
+            raise RuntimeError("No exposures could be processed")
+
+    numExposuresSkipped = 0
+    if exposureIndex is not None:
+        consumed = set(os.path.abspath(exposureId) for exposureId in coadd.getConsumedIds())
+        indexedPathList = exposureIndex.query(coadd.getWcs(), coadd.getBBox(),
+                                              padding=getWarpingPadding(config.warp))
+        # only count the listed exposures the index excludes, not every other exposure it holds
+        indexedPaths = set(indexedPathList)
+        numExposuresSkipped = sum(1 for expNum, exposurePath in remainingItems
+                                  if os.path.abspath(exposurePath) not in indexedPaths)
+        remainingItems = [(expNum, exposurePath) for expNum, exposurePath in enumerate(indexedPathList, 1)
+                          if exposurePath not in consumed]
+        _log.info("Index returned %d exposures that overlap the coadd and skipped %d listed ones" %
+                  (len(indexedPathList), numExposuresSkipped))
+    elif config.doPrefilter:
+        with tracer.span("prefilter"):
+            overlapping, skipped = filterOverlapping(
+                [exposurePath for expNum, exposurePath in remainingItems],
+                coaddWcs=coadd.getWcs(),
+                coaddBBox=coadd.getBBox(),
+                subframeBBox=bbox,
+                padding=getWarpingPadding(config.warp),
+            )
+        overlapping = set(overlapping)
+        remainingItems = [item for item in remainingItems if item[1] in overlapping]
+        numExposuresSkipped = len(skipped)
+        _log.info("Skipping %d exposures that do not overlap the coadd" % (numExposuresSkipped,))
+
+    if config.checkpointDir is not None:
+        coadd.enableCheckpoints(config.checkpointDir, everyN=config.checkpointEveryN,
+                                everySeconds=config.checkpointEverySeconds)
+
+    # ignore time for reference exposure since nothing happens to it
+    startTime = time.time()
+    maxInFlight = config.maxInFlight or 2 * config.numWorkers
+    with tempfile.TemporaryDirectory() as tempDir, contextlib.ExitStack() as exitStack:
+        sharedCoadd = None
+        if config.doSharedAccumulator:
+            sharedCoadd = exitStack.enter_context(SharedMemoryCoadd(
+                bbox=coadd.getBBox(),
+                wcs=coadd.getWcs(),
+                badMaskPlanes=config.coadd.badMaskPlanes,
+                stripeRows=config.stripeRows,
+                numThreads=config.coadd.numThreads,
+                doubleAccumulator=config.coadd.doubleAccumulator,
+            ))
+            sharedCoadd.merge(coadd)
+            # free the reference accumulator
+            coadd = sharedCoadd
+        # worker processes read the coadd WCS from a tiny exposure
+        wcsPath = os.path.join(tempDir, "coaddWcs.fits")
+        afwImage.ExposureF(afwGeom.Box2I(coadd.getBBox().getMin(), afwGeom.Extent2I(1, 1)),
+                           coadd.getWcs()).writeFits(wcsPath)
+        coaddBBox = coadd.getBBox()
+        initargs = (
+            wcsPath,
+            (coaddBBox.getMinX(), coaddBBox.getMinY(), coaddBBox.getWidth(), coaddBBox.getHeight()),
+            (bbox.getMinX(), bbox.getMinY(), bbox.getWidth(), bbox.getHeight()),
+            config.warp,
+            config.doMinimalRead,
+            tracer.enabled,
+            config.saveDebugImages,
+            config.warpCacheDir,
+            config.warpCacheMaxBytes,
+            None if sharedCoadd is None else sharedCoadd.getHandle(),
+        )
+        prefetcher = None
+        if config.numPrefetch > 0:
+            prefetcher = Prefetcher([exposurePath for expNum, exposurePath in remainingItems],
+                                     numAhead=config.numPrefetch)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=config.numWorkers,
+                                                    initializer=_initWorker,
+                                                    initargs=initargs) as executor:
+            # submit each item once its file has been prefetched
+            itemIter = iter(remainingItems) if prefetcher is None else \
+                (item for item, _ in zip(remainingItems, prefetcher))
+            pending = collections.deque((item, executor.submit(_readAndWarp, item))
+                                        for item in itertools.islice(itemIter, maxInFlight))
+            try:
+                while pending:
+                    (expNum, exposurePath), future = pending.popleft()
+                    with tracer.span("waitForWorker"):
+                        sharedExposure = future.result()
+                    for item in itertools.islice(itemIter, 1):
+                        pending.append((item, executor.submit(_readAndWarp, item)))
+                    if sharedExposure is None:
+                        numExposuresFailed += 1
+                        continue
+                    tracer.addSpans(sharedExposure.spans)
+                    readTime += sharedExposure.readTime
+                    exposureReadTimes[exposurePath] = (
+                        None if prefetcher is None else prefetcher.readTimes.get(exposurePath),
+                        sharedExposure.readTime)
+                    numPixelsRead += sharedExposure.readPixels
+                    numWarpCacheHits += sharedExposure.isCacheHit
+                    if sharedExposure.statistics is not None:
+                        # the worker has added the exposure to the shared accumulator
+                        sharedCoadd.recordExposure(sharedExposure.statistics,
+                                                   filterName=sharedExposure.filterName,
+                                                   exposureId=exposurePath)
+                        statistics = sharedExposure.statistics
+                    elif sharedExposure.shmName is None:
+                        numExposuresSkipped += 1
+                        continue
+                    else:
+                        with tracer.span("addExposure", exposure=exposurePath):
+                            _addSharedExposure(coadd, sharedExposure, exposureId=exposurePath)
+                        statistics = coadd.getLastStatistics()
+                    exposureStatistics[exposurePath] = _logStatistics(exposurePath, statistics)
+                    numExposuresWarped += 1
+            except BaseException:
+                for item, future in pending:
+                    future.cancel()
+                for item, future in pending:
+                    if not future.cancelled() and future.exception() is None and future.result() \
+                            and future.result().shmName is not None:
+                        _unlinkSharedMemory(future.result().shmName)
+                raise
+            finally:
+                if prefetcher is not None:
+                    prefetcher.close()
+        if sharedCoadd is not None:
+            with tracer.span("copySharedAccumulator"):
+                coadd = Coadd.fromConfig(bbox=sharedCoadd.getBBox(), wcs=sharedCoadd.getWcs(),
+                                         config=config.coadd)
+                coadd.merge(sharedCoadd)
+    warpTime = time.time() - startTime
+    numExposuresInCoadd += numExposuresWarped
+
+    with tracer.span("write", exposure=coaddPath):
+        coadd.getCoadd().writeFits(coaddPath)
+    _log.info("Wrote coadd: %s" % (coaddPath,))
+    with tracer.span("write", exposure=weightPath):
+        coadd.getWeightMap().writeFits(weightPath)
+    _log.info("Wrote weightMap: %s" % (weightPath,))
+    if config.checkpointDir is not None:
+        with tracer.span("waitForCheckpoint"):
+            coadd.waitForCheckpoint()
+    if config.tracePath is not None:
+        tracer.writeChromeTrace(config.tracePath)
+        _log.info("Wrote trace: %s" % (config.tracePath,))
+
+    return WarpAndCoaddResult(
+        coadd=coadd,
+        numExposuresInCoadd=numExposuresInCoadd,
+        numExposuresWarped=numExposuresWarped,
+        numExposuresFailed=numExposuresFailed,
+        numExposuresSkipped=numExposuresSkipped,
+        warpTime=warpTime,
+        readTime=readTime,
+        numPixelsRead=numPixelsRead,
+        prefetchTime=0.0 if prefetcher is None else prefetcher.readTime,
+        prefetchWaitTime=0.0 if prefetcher is None else prefetcher.waitTime,
+        prefetchHiddenTime=0.0 if prefetcher is None else prefetcher.hiddenTime,
+        prefetchBytes=0 if prefetcher is None else prefetcher.readBytes,
+        exposureReadTimes=exposureReadTimes,
+        exposureStatistics=exposureStatistics,
+        tracer=tracer if tracer.enabled else None,
+        numWarpCacheHits=numWarpCacheHits,
+    )
+
+
+def _logStatistics(exposurePath, statistics):
+    """Log the statistics of an exposure added to the coadd and return them
+    """
+    _log.info("Added %s: %d pixels accepted, %d rejected %s, %d non-finite, in %.3f sec" %
+              (exposurePath, statistics.numAccepted, statistics.numRejected,
+               statistics.getNumRejectedByPlane(), statistics.numNonFinite, statistics.seconds))
+    return statistics
+
+
+def _addSharedExposure(coadd, sharedExposure, exposureId):
+    """Add a warped exposure in shared memory to the coadd, then free the
+    shared memory
+    """
+    shm = shared_memory.SharedMemory(name=sharedExposure.shmName)
+    try:
+        exposure = _makeExposureFromBuffer(shm.buf, sharedExposure, coadd.getWcs())
+        coadd.addExposure(exposure, exposureId=exposureId)
+        # the exposure is a view of the shared memory, which cannot be closed while it exists
+        del exposure
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def _makeExposureFromBuffer(buffer, sharedExposure, wcs):
+    """Make an exposure that is a view of the planes in a buffer
+    """
+    shape = (sharedExposure.height, sharedExposure.width)
+    planes = []
+    offset = 0
+    for dtype in _PlaneDtypes:
+        planes.append(np.ndarray(shape, dtype=dtype, buffer=buffer, offset=offset))
+        offset += planes[-1].nbytes
+    maskedImage = afwImage.makeMaskedImageFromArrays(*planes)
+    maskedImage.setXY0(afwGeom.Point2I(sharedExposure.minX, sharedExposure.minY))
+    exposure = afwImage.makeExposure(maskedImage, wcs)
+    exposure.setFilter(afwImage.Filter(sharedExposure.filterName, True))
+    return exposure
+
+
+def _unlinkSharedMemory(shmName):
+    """Free shared memory that a worker filled but that was never added
+    """
+    shm = shared_memory.SharedMemory(name=shmName)
+    shm.close()
+    shm.unlink()
+
+
+# state of a worker process, set by _initWorker
+_workerState = None
+
+
+def _initWorker(wcsPath, coaddBBoxArgs, bboxArgs, warpConfig, doMinimalRead, doTrace, saveDebugImages,
+                warpCacheDir, warpCacheMaxBytes, sharedCoaddHandle):
+    """Initialize a worker process
+    """
+    global _workerState
+    if warpCacheDir is None:
+        warper = afwMath.Warper.fromConfig(warpConfig)
+    else:
+        warper = CachingWarper.fromConfig(warpConfig, warpCacheDir, maxBytes=warpCacheMaxBytes)
+    _workerState = dict(
+        wcs=afwImage.ExposureF(wcsPath).getWcs(),
+        coaddBBox=afwGeom.Box2I(afwGeom.Point2I(*coaddBBoxArgs[0:2]), afwGeom.Extent2I(*coaddBBoxArgs[2:4])),
+        bbox=afwGeom.Box2I(afwGeom.Point2I(*bboxArgs[0:2]), afwGeom.Extent2I(*bboxArgs[2:4])),
+        warper=warper,
+        padding=getWarpingPadding(warpConfig),
+        doMinimalRead=doMinimalRead,
+        tracer=Tracer() if doTrace else NullTracer(),
+        saveDebugImages=saveDebugImages,
+        coaddWriter=None if sharedCoaddHandle is None else SharedMemoryCoaddWriter(sharedCoaddHandle),
+    )
+
+
+def _readAndWarp(item):
+    """Read and warp one exposure and copy it to shared memory, or add it
+    to the shared accumulator; return None if reading or warping fails
+
+    Called in a worker process.
+
+    Parameters
+    ----------
+    item : `tuple`
+        Exposure number and path.
+
+    Returns
+    -------
+    sharedExposure : `_SharedExposure` or `None`
+        Description of the warped exposure in shared memory. The main
+        process owns the shared memory and must unlink it. shmName is None
+        if no pixels of the exposure can be warped into the coadd, or if
+        the exposure was added to the shared accumulator, in which case
+        statistics is set.
+
+    Raises
+    ------
+    Exception
+        Raised if adding the warped exposure to the shared accumulator
+        fails; the exposure may have been partly added, so the coadd is
+        no longer valid.
+    """
+    expNum, exposurePath = item
+    tracer = _workerState["tracer"]
+    try:
+        try:
+            _log.info("Processing exposure: %s" % (exposurePath,))
+            warpedExposure, sharedExposure = _readAndWarpExposure(expNum, exposurePath, tracer)
+        except Exception as e:
+            _log.warn("Exposure %s failed: %s\n%s" % (exposurePath, e, traceback.format_exc()))
+            return None
+        if warpedExposure is not None and _workerState["coaddWriter"] is not None:
+            with tracer.span("addExposure", exposure=exposurePath):
+                statistics = _workerState["coaddWriter"].addExposure(warpedExposure)[1]
+            sharedExposure = sharedExposure._replace(filterName=warpedExposure.getFilter().getName(),
+                                                     statistics=statistics)
+        elif warpedExposure is not None:
+            try:
+                with tracer.span("copyToSharedMemory", exposure=exposurePath):
+                    sharedExposure = _copyToSharedMemory(warpedExposure)._replace(
+                        readTime=sharedExposure.readTime, readPixels=sharedExposure.readPixels,
+                        isCacheHit=sharedExposure.isCacheHit)
+            except Exception as e:
+                _log.warn("Exposure %s failed: %s\n%s" % (exposurePath, e, traceback.format_exc()))
+                return None
+        return sharedExposure._replace(spans=tracer.getSpans())
+    finally:
+        # spans are returned with the result, so do not keep them for the next exposure
+        tracer.clear()
+
+
+def _readAndWarpExposure(expNum, exposurePath, tracer):
+    """Read and warp one exposure
+
+    Called in a worker process.
+
+    Returns
+    -------
+    warpedExposure : `lsst.afw.image.ExposureF` or `None`
+        Warped exposure, or None if no pixels of the exposure can be
+        warped into the coadd.
+    sharedExposure : `_SharedExposure`
+        Description of the exposure with only the read statistics and
+        isCacheHit set.
+    """
+    startTime = time.time()
+    with tracer.span("read", exposure=exposurePath):
+        if _workerState["doMinimalRead"]:
+            wcs, bbox = readExposureFootprint(exposurePath, subframeBBox=_workerState["bbox"])
+            inputBBox = getInputBBox(wcs, bbox, _workerState["wcs"], _workerState["coaddBBox"],
+                                     padding=_workerState["padding"])
+            if inputBBox.isEmpty():
+                _log.info("Exposure %s does not overlap the coadd" % (exposurePath,))
+                exposure = None
+            else:
+                exposure = afwImage.ExposureF(exposurePath, 0, inputBBox, afwImage.PARENT)
+        else:
+            exposure = afwImage.ExposureF(exposurePath, 0, _workerState["bbox"], afwImage.LOCAL)
+    sharedExposure = _SharedExposure(shmName=None, minX=0, minY=0, width=0, height=0, filterName=None,
+                                     readTime=time.time() - startTime, readPixels=0, spans=(),
+                                     isCacheHit=False, statistics=None)
+    if exposure is None:
+        return None, sharedExposure
+    sharedExposure = sharedExposure._replace(readPixels=exposure.getWidth() * exposure.getHeight())
+    if _workerState["saveDebugImages"]:
+        exposure.writeFits("exposure%s.fits" % (expNum,))
+
+    warper = _workerState["warper"]
+    isCaching = isinstance(warper, CachingWarper)
+    numHits = warper.numHits if isCaching else 0
+    with tracer.span("warp", exposure=exposurePath):
+        warpedExposure = warper.warpExposure(
+            destWcs=_workerState["wcs"],
+            srcExposure=exposure,
+            maxBBox=_workerState["coaddBBox"],
+        )
+    sharedExposure = sharedExposure._replace(isCacheHit=isCaching and warper.numHits > numHits)
+    if _workerState["saveDebugImages"]:
+        warpedExposure.writeFits("warped%s.fits" % (expNum,))
+    return warpedExposure, sharedExposure
+
+
+def _copyToSharedMemory(exposure):
+    """Copy the planes of an exposure into a new block of shared memory
+    """
+    maskedImage = exposure.getMaskedImage()
+    planes = (maskedImage.getImage().getArray(), maskedImage.getMask().getArray(),
+              maskedImage.getVariance().getArray())
+    shm = shared_memory.SharedMemory(create=True, size=max(1, sum(plane.nbytes for plane in planes)))
+    try:
+        offset = 0
+        for plane, dtype in zip(planes, _PlaneDtypes):
+            view = np.ndarray(plane.shape, dtype=dtype, buffer=shm.buf, offset=offset)
+            view[:] = plane
+            offset += view.nbytes
+            del view
+    except Exception:
+        shm.close()
+        shm.unlink()
+        raise
+    # ownership passes to the main process, which unlinks the block once it is added;
+    # stop this process's resource tracker from unlinking it when the worker exits
+    resource_tracker.unregister(shm._name, "shared_memory")
+    shm.close()
+    bbox = maskedImage.getBBox()
+    return _SharedExposure(shmName=shm.name, minX=bbox.getMinX(), minY=bbox.getMinY(),
+                           width=bbox.getWidth(), height=bbox.getHeight(),
+                           filterName=exposure.getFilter().getName(), readTime=0.0, readPixels=0, spans=(),
+                           isCacheHit=False, statistics=None)
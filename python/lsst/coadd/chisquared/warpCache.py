@@ -0,0 +1,320 @@
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""On-disk cache of warped exposures
+
+Warping is the most expensive step of making a coadd, and re-running a coadd
+over the same inputs (e.g. with different bad mask planes or weights) warps
+every exposure again. `CachingWarper` is a drop-in replacement for
+`lsst.afw.math.Warper.warpExposure` that stores each warped masked image in a
+`WarpCache`, keyed by everything that determines it: the input pixels and
+WCS, the destination WCS and bounding box, and the warper config. Cached
+planes are memory mapped copy-on-write, so a cache hit reads only the pages
+that `Coadd.addExposure` touches.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+import lsst.afw.image as afwImage
+import lsst.afw.math as afwMath
+from . hashing import hashMaskedImage
+
+__all__ = ["WarpCache", "CachingWarper", "makeWarpKey"]
+
+_PlaneNames = ("image", "mask", "variance")
+_MetadataName = "metadata.json"
+
+
+def makeWarpKey(srcExposure, destWcs, maxBBox, warpConfig):
+    """Return the cache key of a warped exposure
+
+    Parameters
+    ----------
+    srcExposure : `lsst.afw.image.Exposure`
+        Exposure to warp.
+    destWcs : `lsst.afw.geom.SkyWcs`
+        WCS to which to warp it.
+    maxBBox : `lsst.afw.geom.Box2I` or `None`
+        Maximum bounding box of the warped exposure.
+    warpConfig : `lsst.afw.math.Warper.ConfigClass`
+        Warper config.
+
+    Returns
+    -------
+    key : `str`
+        SHA-256 hex digest.
+    """
+    hasher = hashlib.sha256()
+    hasher.update(hashMaskedImage(srcExposure.getMaskedImage()).encode())
+    hasher.update(srcExposure.getWcs().writeString().encode())
+    hasher.update(destWcs.writeString().encode())
+    hasher.update(_formatBBox(maxBBox).encode())
+    hasher.update(json.dumps(warpConfig.toDict(), sort_keys=True, default=str).encode())
+    return hasher.hexdigest()
+
+
+def _formatBBox(bbox):
+    """Format a bounding box, or None, for a cache key
+    """
+    if bbox is None:
+        return "None"
+    return "%d,%d,%d,%d" % (bbox.getMinX(), bbox.getMinY(), bbox.getWidth(), bbox.getHeight())
+
+
+class WarpCache:
+    """Size-limited on-disk cache of warped masked images, with least
+    recently used eviction
+
+    Each entry is a directory holding the image, mask and variance planes as
+    ``.npy`` files and a small metadata file, whose modification time records
+    when the entry was last used. Entries are written to a temporary
+    directory and renamed into place, and the size of the cache is taken
+    from the directory when evicting, so processes may share a cache; an
+    entry that another process evicts while it is mapped stays readable
+    until it is unmapped.
+
+    Parameters
+    ----------
+    directory : `str`
+        Cache directory; created if necessary.
+    maxBytes : `int`, optional
+        Maximum total size of the entries. Least recently used entries are
+        evicted to stay within it; a warped exposure larger than this is not
+        cached.
+
+    Raises
+    ------
+    ValueError
+        If ``maxBytes`` < 1.
+    """
+
+    def __init__(self, directory, maxBytes=10 * 1024**3):
+        if maxBytes < 1:
+            raise ValueError("maxBytes = %s < 1" % (maxBytes,))
+        self._directory = directory
+        self._maxBytes = maxBytes
+        os.makedirs(directory, exist_ok=True)
+
+    def getDirectory(self):
+        """Return the cache directory
+        """
+        return self._directory
+
+    def getMaxBytes(self):
+        """Return the maximum total size of the entries
+        """
+        return self._maxBytes
+
+    def get(self, key, wcs):
+        """Return a cached warped exposure, or None if it is not cached
+
+        Parameters
+        ----------
+        key : `str`
+            Cache key; see `makeWarpKey`.
+        wcs : `lsst.afw.geom.SkyWcs`
+            WCS of the warped exposure.
+
+        Returns
+        -------
+        exposure : `lsst.afw.image.ExposureF` or `None`
+            Warped exposure, whose planes are copy-on-write memory maps of
+            the cached files; only its masked image and filter are cached.
+        """
+        entryDir = os.path.join(self._directory, key)
+        try:
+            with open(os.path.join(entryDir, _MetadataName)) as infile:
+                metadata = json.load(infile)
+            planes = [np.load(os.path.join(entryDir, name + ".npy"), mmap_mode="c") for name in _PlaneNames]
+            os.utime(os.path.join(entryDir, _MetadataName))
+        except FileNotFoundError:
+            return None
+        maskedImage = afwImage.makeMaskedImageFromArrays(*planes)
+        maskedImage.setXY0(metadata["minX"], metadata["minY"])
+        exposure = afwImage.makeExposure(maskedImage, wcs)
+        exposure.setFilter(afwImage.Filter(metadata["filterName"], True))
+        return exposure
+
+    def put(self, key, exposure):
+        """Add a warped exposure to the cache, evicting the least recently
+        used entries as needed
+
+        Parameters
+        ----------
+        key : `str`
+            Cache key; see `makeWarpKey`.
+        exposure : `lsst.afw.image.Exposure`
+            Warped exposure.
+
+        Returns
+        -------
+        isCached : `bool`
+            True if the exposure was cached, False if it is larger than the
+            cache or is already cached.
+        """
+        maskedImage = exposure.getMaskedImage()
+        planes = (maskedImage.getImage().getArray(), maskedImage.getMask().getArray(),
+                  maskedImage.getVariance().getArray())
+        if sum(plane.nbytes for plane in planes) > self._maxBytes:
+            return False
+        entryDir = os.path.join(self._directory, key)
+        if os.path.exists(entryDir):
+            return False
+
+        tempDir = tempfile.mkdtemp(prefix=".tmp-", dir=self._directory)
+        try:
+            for name, plane in zip(_PlaneNames, planes):
+                np.save(os.path.join(tempDir, name + ".npy"), plane)
+            with open(os.path.join(tempDir, _MetadataName), "w") as outfile:
+                json.dump(dict(minX=maskedImage.getX0(), minY=maskedImage.getY0(),
+                               filterName=exposure.getFilter().getName()), outfile)
+        except Exception:
+            shutil.rmtree(tempDir, ignore_errors=True)
+            raise
+        try:
+            os.rename(tempDir, entryDir)
+        except OSError:
+            # another process cached the same exposure first
+            shutil.rmtree(tempDir, ignore_errors=True)
+            return False
+        self._evict(keep=key)
+        return True
+
+    def getEntries(self):
+        """Return the cached entries, least recently used first
+
+        Returns
+        -------
+        entries : `list` of `tuple`
+            (key, size in bytes) of each entry.
+        """
+        entries = []
+        for key in os.listdir(self._directory):
+            if key.startswith("."):
+                continue
+            entryDir = os.path.join(self._directory, key)
+            try:
+                lastUsed = os.stat(os.path.join(entryDir, _MetadataName)).st_mtime_ns
+                size = sum(entry.stat().st_size for entry in os.scandir(entryDir))
+            except FileNotFoundError:
+                continue
+            entries.append((lastUsed, key, size))
+        entries.sort()
+        return [(key, size) for lastUsed, key, size in entries]
+
+    def getNumBytes(self):
+        """Return the total size of the cached entries
+        """
+        return sum(size for key, size in self.getEntries())
+
+    def clear(self):
+        """Remove all entries
+        """
+        for key, size in self.getEntries():
+            shutil.rmtree(os.path.join(self._directory, key), ignore_errors=True)
+
+    def _evict(self, keep):
+        """Remove least recently used entries, other than ``keep``, until the
+        cache is within its size limit
+        """
+        entries = self.getEntries()
+        numBytes = sum(size for key, size in entries)
+        for key, size in entries:
+            if numBytes <= self._maxBytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(os.path.join(self._directory, key), ignore_errors=True)
+            numBytes -= size
+
+
+class CachingWarper:
+    """Warp exposures as `lsst.afw.math.Warper` does, caching the results
+
+    Parameters
+    ----------
+    warpConfig : `lsst.afw.math.Warper.ConfigClass`
+        Warper config.
+    cache : `WarpCache`
+        Cache of warped exposures.
+    """
+
+    def __init__(self, warpConfig, cache):
+        self._warpConfig = warpConfig
+        self._warper = afwMath.Warper.fromConfig(warpConfig)
+        self._cache = cache
+        self.numHits = 0
+        self.numMisses = 0
+
+    @classmethod
+    def fromConfig(cls, warpConfig, cacheDir, maxBytes=10 * 1024**3):
+        """Make a caching warper with a cache in a directory
+
+        Parameters
+        ----------
+        warpConfig : `lsst.afw.math.Warper.ConfigClass`
+            Warper config.
+        cacheDir : `str`
+            Cache directory.
+        maxBytes : `int`, optional
+            Maximum size of the cache; see `WarpCache`.
+        """
+        return cls(warpConfig, WarpCache(cacheDir, maxBytes=maxBytes))
+
+    def getCache(self):
+        """Return the cache
+        """
+        return self._cache
+
+    def getWarpingKernel(self):
+        """Return the warping kernel
+        """
+        return self._warper.getWarpingKernel()
+
+    def warpExposure(self, destWcs, srcExposure, border=0, maxBBox=None, destBBox=None):
+        """Warp an exposure, or return the cached result of warping it
+
+        Parameters are as for `lsst.afw.math.Warper.warpExposure`.
+
+        Returns
+        -------
+        destExposure : `lsst.afw.image.Exposure`
+            Warped exposure; if it was cached, its planes are copy-on-write
+            memory maps and only its masked image, WCS and filter are set.
+        """
+        key = makeWarpKey(srcExposure, destWcs, maxBBox, self._warpConfig)
+        if border != 0 or destBBox is not None:
+            key = hashlib.sha256(("%s,border=%d,destBBox=%s" %
+                                  (key, border, _formatBBox(destBBox))).encode()).hexdigest()
+        destExposure = self._cache.get(key, destWcs)
+        if destExposure is not None:
+            self.numHits += 1
+            return destExposure
+        self.numMisses += 1
+        destExposure = self._warper.warpExposure(destWcs=destWcs, srcExposure=srcExposure, border=border,
+                                                 maxBBox=maxBBox, destBBox=destBBox)
+        self._cache.put(key, destExposure)
+        return destExposure
@@ -25,8 +25,16 @@
  *
  * @author Russell Owen
  */
+#include <algorithm>
+#include <chrono>
 #include <cmath>
 #include <cstdint>
+#include <cstring>
+#include <limits>
+#include <memory>
+#include <mutex>
+#include <thread>
+#include <vector>
 
 #include "lsst/pex/exceptions.h"
 #include "lsst/coadd/chisquared/addToCoadd.h"
@@ -36,70 +44,770 @@ namespace afwImage = lsst::afw::image;
 namespace afwGeom = lsst::afw::geom;
 namespace coaddChiSq = lsst::coadd::chisquared;
 
-template <typename CoaddPixelT, typename WeightPixelT>
-afwGeom::Box2I coaddChiSq::addToCoadd(
-        // spell out lsst:afw::image to make Doxygen happy
-        lsst::afw::image::MaskedImage<CoaddPixelT, lsst::afw::image::MaskPixel,
-                                      lsst::afw::image::VariancePixel> &coadd,
-        lsst::afw::image::Image<WeightPixelT> &weightMap,
-        lsst::afw::image::MaskedImage<CoaddPixelT, lsst::afw::image::MaskPixel,
-                                      lsst::afw::image::VariancePixel> const &image,
-        lsst::afw::image::MaskPixel const badPixelMask, WeightPixelT weight) {
+namespace {
+
+/*
+ * Unsigned integer type of a given size, in bytes
+ */
+template <std::size_t Size>
+struct UnsignedOfSize;
+template <>
+struct UnsignedOfSize<2> {
+    typedef std::uint16_t type;
+};
+template <>
+struct UnsignedOfSize<4> {
+    typedef std::uint32_t type;
+};
+template <>
+struct UnsignedOfSize<8> {
+    typedef std::uint64_t type;
+};
+
+/*
+ * Return condition ? a : b, computed with bitwise operations instead of a branch
+ *
+ * The result is bit-for-bit a or b (unlike e.g. a * condition + b * !condition),
+ * and the compiler can vectorize loops that use it, even for floating point types.
+ */
+template <typename T>
+inline T bitSelect(bool condition, T a, T b) {
+    typedef typename UnsignedOfSize<sizeof(T)>::type Bits;
+    Bits aBits, bBits;
+    std::memcpy(&aBits, &a, sizeof(T));
+    std::memcpy(&bBits, &b, sizeof(T));
+    Bits const mask = static_cast<Bits>(-static_cast<Bits>(condition));
+    Bits const resultBits = (aBits & mask) | (bBits & static_cast<Bits>(~mask));
+    T result;
+    std::memcpy(&result, &resultBits, sizeof(T));
+    return result;
+}
+
+/*
+ * Divide image**2 by the variance plane, for the pixels of a row
+ */
+struct DivideByVariance {
+    afwImage::VariancePixel const *__restrict__ variance;  ///< variance of the first pixel of the row
+
+    template <typename T>
+    T operator()(T imageSquared, int x) const {
+        return imageSquared / variance[x];
+    }
+};
+
+/*
+ * Multiply image**2 by an inverse variance that is the same for all pixels of a row
+ */
+template <typename T>
+struct MultiplyByInverseVariance {
+    T inverseVariance;
+
+    T operator()(T imageSquared, int) const { return imageSquared * inverseVariance; }
+};
+
+/*
+ * Add one row of input pixels to one row of the coadd and weight map
+ *
+ * This is the fast path for images with contiguous rows: it works on raw row pointers and replaces
+ * the test for bad pixels with a select, so that the compiler can vectorize the loop.
+ * Bad pixels leave the coadd and weight map unchanged (the select picks the old value),
+ * so the result is identical to the branching loop in addBoxToCoaddGeneric.
+ *
+ * Input pixels are converted to CoaddPixelT before they are used, so e.g. adding a float image
+ * to a double coadd gives the same result as adding a double copy of that image.
+ *
+ * scaleByVariance(image**2, x) returns image**2 / variance for pixel x of the row: DivideByVariance,
+ * or MultiplyByInverseVariance, which does not read a variance plane at all.
+ */
+template <typename CoaddPixelT, typename WeightPixelT, typename InputPixelT, typename ScaleByVariance>
+void addRowToCoadd(CoaddPixelT *__restrict__ coaddImage, afwImage::MaskPixel *__restrict__ coaddMask,
+                   WeightPixelT *__restrict__ weightMap, InputPixelT const *__restrict__ image,
+                   afwImage::MaskPixel const *__restrict__ mask, ScaleByVariance const scaleByVariance,
+                   int width, afwImage::MaskPixel const badPixelMask, WeightPixelT weight) {
+    for (int x = 0; x < width; ++x) {
+        bool const isGood = (mask[x] & badPixelMask) == 0;
+        CoaddPixelT const imageValue = image[x];
+        CoaddPixelT const value = scaleByVariance(imageValue * imageValue, x);
+        coaddImage[x] = bitSelect(isGood, static_cast<CoaddPixelT>(coaddImage[x] + value), coaddImage[x]);
+        coaddMask[x] |= bitSelect(isGood, mask[x], afwImage::MaskPixel(0));
+        weightMap[x] = bitSelect(isGood, static_cast<WeightPixelT>(weightMap[x] + weight), weightMap[x]);
+    }
+}
+
+/*
+ * Count a rejected pixel in numRejectedByBit for each bit set in badBits (= mask & badPixelMask)
+ */
+inline void countRejectedBits(afwImage::MaskPixel const badBits,
+                              coaddChiSq::AddToCoaddStatistics &statistics) {
+    auto bits = static_cast<std::uint32_t>(badBits);
+    for (int bit = 0; bits != 0; ++bit, bits >>= 1) {
+        if (bits & 1u) {
+            ++statistics.numRejectedByBit[bit];
+        }
+    }
+}
+
+/*
+ * Subtract one row of input pixels from one row of the coadd and weight map
+ *
+ * This undoes addRowToCoadd, called with the same scaleByVariance, for the image and weight map,
+ * up to rounding; the coadd mask is not altered.
+ */
+template <typename CoaddPixelT, typename WeightPixelT, typename InputPixelT, typename ScaleByVariance>
+void subtractRowFromCoadd(CoaddPixelT *__restrict__ coaddImage, WeightPixelT *__restrict__ weightMap,
+                          InputPixelT const *__restrict__ image, afwImage::MaskPixel const *__restrict__ mask,
+                          ScaleByVariance const scaleByVariance, int width,
+                          afwImage::MaskPixel const badPixelMask, WeightPixelT weight) {
+    for (int x = 0; x < width; ++x) {
+        bool const isGood = (mask[x] & badPixelMask) == 0;
+        CoaddPixelT const imageValue = image[x];
+        CoaddPixelT const value = scaleByVariance(imageValue * imageValue, x);
+        coaddImage[x] = bitSelect(isGood, static_cast<CoaddPixelT>(coaddImage[x] - value), coaddImage[x]);
+        weightMap[x] = bitSelect(isGood, static_cast<WeightPixelT>(weightMap[x] - weight), weightMap[x]);
+    }
+}
+
+/*
+ * Add the statistics of one row of input pixels to statistics
+ *
+ * This is called for each row right after addRowToCoadd has added it, while the row is still in cache,
+ * so that addRowToCoadd itself stays branch free. Values are computed as in addRowToCoadd.
+ */
+template <typename CoaddPixelT, typename InputPixelT, typename ScaleByVariance>
+void countRow(InputPixelT const *__restrict__ image, afwImage::MaskPixel const *__restrict__ mask,
+              ScaleByVariance const scaleByVariance, int width, afwImage::MaskPixel const badPixelMask,
+              coaddChiSq::AddToCoaddStatistics &statistics) {
+    std::int64_t numAccepted = 0;
+    std::int64_t numNonFinite = 0;
+    for (int x = 0; x < width; ++x) {
+        afwImage::MaskPixel const badBits = mask[x] & badPixelMask;
+        if (badBits == 0) {
+            ++numAccepted;
+            CoaddPixelT const imageValue = image[x];
+            CoaddPixelT const value = scaleByVariance(imageValue * imageValue, x);
+            if (!std::isfinite(value)) {
+                ++numNonFinite;
+            }
+        } else {
+            countRejectedBits(badBits, statistics);
+        }
+    }
+    statistics.numAccepted += numAccepted;
+    statistics.numRejected += width - numAccepted;
+    statistics.numNonFinite += numNonFinite;
+}
+
+/*
+ * Return a pointer to pixel (x, y) of image, in local coordinates
+ */
+template <typename PixelT>
+PixelT *getPixelPointer(afwImage::ImageBase<PixelT> &image, int x, int y) {
+    auto array = image.getArray();
+    return array.getData() + y * array.template getStride<0>() + x;
+}
+
+/*
+ * Return true if successive pixels of a row of image are adjacent in memory
+ */
+template <typename PixelT>
+bool hasContiguousRows(afwImage::ImageBase<PixelT> &image) {
+    return image.getArray().template getStride<1>() == 1;
+}
+
+/*
+ * Return image**2 scaled by the inverse variance of pixel (x, y) of a masked image, in local coordinates,
+ * taken from varianceModel if it is not null, else from the variance plane (variance)
+ */
+template <typename CoaddPixelT>
+inline CoaddPixelT scaleByVarianceAt(CoaddPixelT imageSquared, afwImage::VariancePixel variance, int x, int y,
+                                     coaddChiSq::VarianceModel const *varianceModel) {
+    if (varianceModel) {
+        return imageSquared * static_cast<CoaddPixelT>(varianceModel->getInverseVariance(
+                                      x / varianceModel->getCellWidth(), y / varianceModel->getCellHeight()));
+    }
+    return imageSquared / variance;
+}
+
+/*
+ * Split a row of pixels into runs with the same way of scaling by the variance, and call
+ * runFunction(beginX, endX, scaleByVariance) for each run [beginX, endX)
+ *
+ * The row is pixels [imageX, imageX + width) of row imageY of an input masked image, in local coordinates;
+ * beginX and endX are relative to imageX. Without a varianceModel the row is one run, divided by the
+ * variance plane; with one there is one run per cell of the model, which does not read the variance plane.
+ */
+template <typename CoaddPixelT, typename RunFunction>
+void forEachVarianceRun(afwImage::Image<afwImage::VariancePixel> &inputVariance,
+                        coaddChiSq::VarianceModel const *varianceModel, int imageX, int imageY, int width,
+                        RunFunction runFunction) {
+    if (!varianceModel) {
+        runFunction(0, width, DivideByVariance{getPixelPointer(inputVariance, imageX, imageY)});
+        return;
+    }
+    int const cellY = imageY / varianceModel->getCellHeight();
+    for (int beginX = 0; beginX < width;) {
+        int const cellX = (imageX + beginX) / varianceModel->getCellWidth();
+        // 64 bits, as a constant variance is one cell of the largest int width
+        std::int64_t const cellEndX =
+                static_cast<std::int64_t>(cellX + 1) * varianceModel->getCellWidth() - imageX;
+        int const endX = static_cast<int>(std::min(static_cast<std::int64_t>(width), cellEndX));
+        runFunction(beginX, endX,
+                    MultiplyByInverseVariance<CoaddPixelT>{
+                            static_cast<CoaddPixelT>(varianceModel->getInverseVariance(cellX, cellY))});
+        beginX = endX;
+    }
+}
+
+/*
+ * Add the pixels of image in box to coadd and weightMap using afw iterators
+ *
+ * This is the generic path, for images whose rows are not contiguous in memory.
+ * box is in parent coordinates and must be contained in the bboxes of all three images.
+ * If statistics is not null then the statistics of the pixels in box are added to it.
+ * If varianceModel is not null then it is used instead of the variance plane of image.
+ */
+template <typename CoaddPixelT, typename WeightPixelT, typename InputPixelT>
+void addBoxToCoaddGeneric(
+        afwImage::MaskedImage<CoaddPixelT, afwImage::MaskPixel, afwImage::VariancePixel> &coadd,
+        afwImage::Image<WeightPixelT> &weightMap,
+        afwImage::MaskedImage<InputPixelT, afwImage::MaskPixel, afwImage::VariancePixel> const &image,
+        afwGeom::Box2I const &box, afwImage::MaskPixel const badPixelMask, WeightPixelT weight,
+        coaddChiSq::AddToCoaddStatistics *statistics, coaddChiSq::VarianceModel const *varianceModel) {
     typedef typename afwImage::MaskedImage<CoaddPixelT, afwImage::MaskPixel, afwImage::VariancePixel> Coadd;
+    typedef typename afwImage::MaskedImage<InputPixelT, afwImage::MaskPixel, afwImage::VariancePixel> Input;
     typedef typename afwImage::Image<WeightPixelT> WeightMap;
 
+    int const coaddX = box.getMinX() - coadd.getX0();
+    int const coaddY = box.getMinY() - coadd.getY0();
+    int const imageX = box.getMinX() - image.getX0();
+    int const imageY = box.getMinY() - image.getY0();
+    int const width = box.getWidth();
+    for (int y = 0, endY = box.getHeight(); y != endY; ++y) {
+        typename Input::const_x_iterator imageIter = image.x_at(imageX, imageY + y);
+        typename Input::const_x_iterator const imageEndIter = image.x_at(imageX + width, imageY + y);
+        typename Coadd::x_iterator coaddIter = coadd.x_at(coaddX, coaddY + y);
+        typename WeightMap::x_iterator weightMapIter = weightMap.x_at(coaddX, coaddY + y);
+        for (int x = imageX; imageIter != imageEndIter; ++imageIter, ++coaddIter, ++weightMapIter, ++x) {
+            afwImage::MaskPixel const badBits = imageIter.mask() & badPixelMask;
+            if (badBits == 0) {
+                CoaddPixelT const imageValue = imageIter.image();
+                CoaddPixelT const value = scaleByVarianceAt(imageValue * imageValue, imageIter.variance(),
+                                                            x, imageY + y, varianceModel);
+                coaddIter.image() += value;
+                coaddIter.mask() |= imageIter.mask();
+                *weightMapIter += weight;
+                if (statistics) {
+                    ++statistics->numAccepted;
+                    if (!std::isfinite(value)) {
+                        ++statistics->numNonFinite;
+                    }
+                }
+            } else if (statistics) {
+                ++statistics->numRejected;
+                countRejectedBits(badBits, *statistics);
+            }
+        }
+    }
+}
+
+/*
+ * Add the pixels of image in box to coadd and weightMap
+ *
+ * box is in parent coordinates and must be contained in the bboxes of all three images.
+ * If statistics is not null then the statistics of the pixels in box are added to it.
+ * If varianceModel is not null then it is used instead of the variance plane of image, which is not read;
+ * each row is then added as one run of pixels per cell of the model.
+ */
+template <typename CoaddPixelT, typename WeightPixelT, typename InputPixelT>
+void addBoxToCoadd(
+        afwImage::MaskedImage<CoaddPixelT, afwImage::MaskPixel, afwImage::VariancePixel> &coadd,
+        afwImage::Image<WeightPixelT> &weightMap,
+        afwImage::MaskedImage<InputPixelT, afwImage::MaskPixel, afwImage::VariancePixel> const &image,
+        afwGeom::Box2I const &box, afwImage::MaskPixel const badPixelMask, WeightPixelT weight,
+        coaddChiSq::AddToCoaddStatistics *statistics = nullptr,
+        coaddChiSq::VarianceModel const *varianceModel = nullptr) {
+    auto &coaddImage = *coadd.getImage();
+    auto &coaddMask = *coadd.getMask();
+    auto &inputImage = *image.getImage();
+    auto &inputMask = *image.getMask();
+    auto &inputVariance = *image.getVariance();
+    if (!(hasContiguousRows(coaddImage) && hasContiguousRows(coaddMask) && hasContiguousRows(weightMap) &&
+          hasContiguousRows(inputImage) && hasContiguousRows(inputMask) &&
+          (varianceModel || hasContiguousRows(inputVariance)))) {
+        addBoxToCoaddGeneric(coadd, weightMap, image, box, badPixelMask, weight, statistics, varianceModel);
+        return;
+    }
+
+    int const coaddX = box.getMinX() - coadd.getX0();
+    int const coaddY = box.getMinY() - coadd.getY0();
+    int const imageX = box.getMinX() - image.getX0();
+    int const imageY = box.getMinY() - image.getY0();
+    int const width = box.getWidth();
+    // add pixels [beginX, endX) of row y of box
+    auto addRun = [&](int y, int beginX, int endX, auto const &scaleByVariance) {
+        addRowToCoadd(getPixelPointer(coaddImage, coaddX + beginX, coaddY + y),
+                      getPixelPointer(coaddMask, coaddX + beginX, coaddY + y),
+                      getPixelPointer(weightMap, coaddX + beginX, coaddY + y),
+                      getPixelPointer(inputImage, imageX + beginX, imageY + y),
+                      getPixelPointer(inputMask, imageX + beginX, imageY + y), scaleByVariance,
+                      endX - beginX, badPixelMask, weight);
+        if (statistics) {
+            countRow<CoaddPixelT>(getPixelPointer(inputImage, imageX + beginX, imageY + y),
+                                  getPixelPointer(inputMask, imageX + beginX, imageY + y), scaleByVariance,
+                                  endX - beginX, badPixelMask, *statistics);
+        }
+    };
+    for (int y = 0, endY = box.getHeight(); y != endY; ++y) {
+        forEachVarianceRun<CoaddPixelT>(inputVariance, varianceModel, imageX, imageY + y, width,
+                                        [&](int beginX, int endX, auto const &scaleByVariance) {
+                                            addRun(y, beginX, endX, scaleByVariance);
+                                        });
+    }
+}
+
+/*
+ * Subtract the pixels of image in box from coadd and weightMap
+ *
+ * box is in parent coordinates and must be contained in the bboxes of all three images.
+ * If statistics is not null then the statistics of the pixels in box are added to it.
+ * If varianceModel is not null then it is used instead of the variance plane of image, which is not read.
+ */
+template <typename CoaddPixelT, typename WeightPixelT, typename InputPixelT>
+void subtractBoxFromCoadd(
+        afwImage::MaskedImage<CoaddPixelT, afwImage::MaskPixel, afwImage::VariancePixel> &coadd,
+        afwImage::Image<WeightPixelT> &weightMap,
+        afwImage::MaskedImage<InputPixelT, afwImage::MaskPixel, afwImage::VariancePixel> const &image,
+        afwGeom::Box2I const &box, afwImage::MaskPixel const badPixelMask, WeightPixelT weight,
+        coaddChiSq::AddToCoaddStatistics *statistics, coaddChiSq::VarianceModel const *varianceModel) {
+    auto &coaddImage = *coadd.getImage();
+    auto &inputImage = *image.getImage();
+    auto &inputMask = *image.getMask();
+    auto &inputVariance = *image.getVariance();
+    int const coaddX = box.getMinX() - coadd.getX0();
+    int const coaddY = box.getMinY() - coadd.getY0();
+    int const imageX = box.getMinX() - image.getX0();
+    int const imageY = box.getMinY() - image.getY0();
+    int const width = box.getWidth();
+    if (!(hasContiguousRows(coaddImage) && hasContiguousRows(weightMap) && hasContiguousRows(inputImage) &&
+          hasContiguousRows(inputMask) && (varianceModel || hasContiguousRows(inputVariance)))) {
+        typedef typename afwImage::MaskedImage<InputPixelT, afwImage::MaskPixel, afwImage::VariancePixel>
+                Input;
+        for (int y = 0, endY = box.getHeight(); y != endY; ++y) {
+            typename Input::const_x_iterator imageIter = image.x_at(imageX, imageY + y);
+            auto coaddIter = coaddImage.x_at(coaddX, coaddY + y);
+            auto weightMapIter = weightMap.x_at(coaddX, coaddY + y);
+            for (int x = 0; x != width; ++x, ++imageIter, ++coaddIter, ++weightMapIter) {
+                afwImage::MaskPixel const badBits = imageIter.mask() & badPixelMask;
+                if (badBits == 0) {
+                    CoaddPixelT const imageValue = imageIter.image();
+                    CoaddPixelT const value = scaleByVarianceAt(imageValue * imageValue, imageIter.variance(),
+                                                                imageX + x, imageY + y, varianceModel);
+                    *coaddIter -= value;
+                    *weightMapIter -= weight;
+                    if (statistics) {
+                        ++statistics->numAccepted;
+                        if (!std::isfinite(value)) {
+                            ++statistics->numNonFinite;
+                        }
+                    }
+                } else if (statistics) {
+                    ++statistics->numRejected;
+                    countRejectedBits(badBits, *statistics);
+                }
+            }
+        }
+        return;
+    }
+
+    for (int y = 0, endY = box.getHeight(); y != endY; ++y) {
+        forEachVarianceRun<CoaddPixelT>(
+                inputVariance, varianceModel, imageX, imageY + y, width,
+                [&](int beginX, int endX, auto const &scaleByVariance) {
+                    subtractRowFromCoadd(getPixelPointer(coaddImage, coaddX + beginX, coaddY + y),
+                                         getPixelPointer(weightMap, coaddX + beginX, coaddY + y),
+                                         getPixelPointer(inputImage, imageX + beginX, imageY + y),
+                                         getPixelPointer(inputMask, imageX + beginX, imageY + y),
+                                         scaleByVariance, endX - beginX, badPixelMask, weight);
+                    if (statistics) {
+                        countRow<CoaddPixelT>(getPixelPointer(inputImage, imageX + beginX, imageY + y),
+                                              getPixelPointer(inputMask, imageX + beginX, imageY + y),
+                                              scaleByVariance, endX - beginX, badPixelMask, *statistics);
+                    }
+                });
+    }
+}
+
+/*
+ * Split [0, size) into min(numThreads, size) contiguous bands and call function(beginBand, endBand)
+ * for each band, each in its own thread
+ *
+ * size must be > 0 and function must not throw.
+ */
+template <typename Function>
+void runInBands(int size, int numThreads, Function function) {
+    int const numBands = std::min(numThreads, size);
+    std::vector<std::thread> threads;
+    threads.reserve(numBands - 1);
+    try {
+        for (int band = 1; band < numBands; ++band) {
+            threads.emplace_back(function, (band * size) / numBands, ((band + 1) * size) / numBands);
+        }
+    } catch (...) {
+        for (auto &thread : threads) {
+            thread.join();
+        }
+        throw;
+    }
+    function(0, size / numBands);
+    for (auto &thread : threads) {
+        thread.join();
+    }
+}
+
+template <typename CoaddPixelT, typename WeightPixelT>
+void assertCoaddArgumentsValid(
+        afwImage::MaskedImage<CoaddPixelT, afwImage::MaskPixel, afwImage::VariancePixel> const &coadd,
+        afwImage::Image<WeightPixelT> const &weightMap, int numThreads) {
     if (coadd.getBBox() != weightMap.getBBox()) {
         throw LSST_EXCEPT(pexExcept::InvalidParameterError,
                           (boost::format("coadd and weightMap parent bboxes differ: %s != %s") %
                            coadd.getBBox() % weightMap.getBBox())
                                   .str());
     }
+    if (numThreads < 1) {
+        throw LSST_EXCEPT(pexExcept::InvalidParameterError,
+                          (boost::format("numThreads = %d < 1") % numThreads).str());
+    }
+}
+
+/*
+ * Throw if varianceModel is not null and does not cover a masked image of the given dimensions
+ */
+void assertVarianceModelCovers(coaddChiSq::VarianceModel const *varianceModel,
+                               afwGeom::Extent2I const &dimensions) {
+    if (varianceModel && !varianceModel->covers(dimensions)) {
+        throw LSST_EXCEPT(pexExcept::InvalidParameterError,
+                          (boost::format("varianceModel of %d x %d cells of %d x %d pixels does not cover "
+                                         "a masked image of %d x %d pixels") %
+                           varianceModel->getNumCellsX() % varianceModel->getNumCellsY() %
+                           varianceModel->getCellWidth() % varianceModel->getCellHeight() %
+                           dimensions.getX() % dimensions.getY())
+                                  .str());
+    }
+}
+
+/*
+ * Implement both overloads of addToCoadd; statistics and varianceModel may be null
+ */
+template <typename CoaddPixelT, typename WeightPixelT, typename InputPixelT>
+afwGeom::Box2I addToCoaddImpl(
+        afwImage::MaskedImage<CoaddPixelT, afwImage::MaskPixel, afwImage::VariancePixel> &coadd,
+        afwImage::Image<WeightPixelT> &weightMap,
+        afwImage::MaskedImage<InputPixelT, afwImage::MaskPixel, afwImage::VariancePixel> const &image,
+        afwImage::MaskPixel const badPixelMask, WeightPixelT weight, int numThreads,
+        coaddChiSq::AddToCoaddStatistics *statistics, coaddChiSq::VarianceModel const *varianceModel) {
+    assertCoaddArgumentsValid(coadd, weightMap, numThreads);
+    assertVarianceModelCovers(varianceModel, image.getDimensions());
+    auto const startTime = std::chrono::steady_clock::now();
 
     afwGeom::Box2I overlapBBox = coadd.getBBox();
     overlapBBox.clip(image.getBBox());
-    if (overlapBBox.isEmpty()) {
-        return overlapBBox;
-    }
-
-    Coadd coaddView(coadd, overlapBBox, afwImage::PARENT, false);
-    WeightMap weightMapView(weightMap, overlapBBox, afwImage::PARENT, false);
-    Coadd imageView(image, overlapBBox, afwImage::PARENT, false);
-
-    for (int y = 0, endY = imageView.getHeight(); y != endY; ++y) {
-        typename Coadd::const_x_iterator imageIter = imageView.row_begin(y);
-        typename Coadd::const_x_iterator const imageEndIter = imageView.row_end(y);
-        typename Coadd::x_iterator coaddIter = coaddView.row_begin(y);
-        typename WeightMap::x_iterator weightMapIter = weightMapView.row_begin(y);
-        for (; imageIter != imageEndIter; ++imageIter, ++coaddIter, ++weightMapIter) {
-            if ((imageIter.mask() & badPixelMask) == 0) {
-                CoaddPixelT value = imageIter.image() * imageIter.image() / imageIter.variance();
-                coaddIter.image() += value;
-                coaddIter.mask() |= imageIter.mask();
-                *weightMapIter += weight;
+    if (!overlapBBox.isEmpty()) {
+        // Split the overlap region into row bands, one per thread. Each output pixel is touched by exactly
+        // one band and is computed exactly as in the serial loop, so the result does not depend on
+        // numThreads. Each band counts into its own statistics, which are totalled as the band finishes.
+        std::mutex statisticsMutex;
+        runInBands(overlapBBox.getHeight(), numThreads, [&](int beginY, int endY) {
+            afwGeom::Box2I const bandBBox(
+                    afwGeom::Point2I(overlapBBox.getMinX(), overlapBBox.getMinY() + beginY),
+                    afwGeom::Extent2I(overlapBBox.getWidth(), endY - beginY));
+            if (!statistics) {
+                addBoxToCoadd(coadd, weightMap, image, bandBBox, badPixelMask, weight, nullptr,
+                              varianceModel);
+                return;
             }
-        }
+            coaddChiSq::AddToCoaddStatistics bandStatistics;
+            addBoxToCoadd(coadd, weightMap, image, bandBBox, badPixelMask, weight, &bandStatistics,
+                          varianceModel);
+            std::lock_guard<std::mutex> lock(statisticsMutex);
+            *statistics += bandStatistics;
+        });
+    }
+
+    if (statistics) {
+        statistics->seconds +=
+                std::chrono::duration<double>(std::chrono::steady_clock::now() - startTime).count();
+    }
+    return overlapBBox;
+}
+
+/*
+ * Implement both overloads of subtractFromCoadd; statistics and varianceModel may be null
+ */
+template <typename CoaddPixelT, typename WeightPixelT, typename InputPixelT>
+afwGeom::Box2I subtractFromCoaddImpl(
+        afwImage::MaskedImage<CoaddPixelT, afwImage::MaskPixel, afwImage::VariancePixel> &coadd,
+        afwImage::Image<WeightPixelT> &weightMap,
+        afwImage::MaskedImage<InputPixelT, afwImage::MaskPixel, afwImage::VariancePixel> const &image,
+        afwImage::MaskPixel const badPixelMask, WeightPixelT weight, int numThreads,
+        coaddChiSq::AddToCoaddStatistics *statistics, coaddChiSq::VarianceModel const *varianceModel) {
+    assertCoaddArgumentsValid(coadd, weightMap, numThreads);
+    assertVarianceModelCovers(varianceModel, image.getDimensions());
+    auto const startTime = std::chrono::steady_clock::now();
+
+    afwGeom::Box2I overlapBBox = coadd.getBBox();
+    overlapBBox.clip(image.getBBox());
+    if (!overlapBBox.isEmpty()) {
+        std::mutex statisticsMutex;
+        runInBands(overlapBBox.getHeight(), numThreads, [&](int beginY, int endY) {
+            afwGeom::Box2I const bandBBox(
+                    afwGeom::Point2I(overlapBBox.getMinX(), overlapBBox.getMinY() + beginY),
+                    afwGeom::Extent2I(overlapBBox.getWidth(), endY - beginY));
+            if (!statistics) {
+                subtractBoxFromCoadd(coadd, weightMap, image, bandBBox, badPixelMask, weight, nullptr,
+                                     varianceModel);
+                return;
+            }
+            coaddChiSq::AddToCoaddStatistics bandStatistics;
+            subtractBoxFromCoadd(coadd, weightMap, image, bandBBox, badPixelMask, weight, &bandStatistics,
+                                 varianceModel);
+            std::lock_guard<std::mutex> lock(statisticsMutex);
+            *statistics += bandStatistics;
+        });
+    }
+
+    if (statistics) {
+        statistics->seconds +=
+                std::chrono::duration<double>(std::chrono::steady_clock::now() - startTime).count();
     }
     return overlapBBox;
 }
 
+}  // namespace
+
+coaddChiSq::VarianceModel::VarianceModel(double variance)
+        : _cellWidth(std::numeric_limits<int>::max()),
+          _cellHeight(std::numeric_limits<int>::max()),
+          _numCellsX(1),
+          _numCellsY(1),
+          _variance(1, variance),
+          _inverseVariance(1, 1.0 / variance) {}
+
+coaddChiSq::VarianceModel::VarianceModel(
+        lsst::afw::image::Image<lsst::afw::image::VariancePixel> const &cellVariance, int cellWidth,
+        int cellHeight)
+        : _cellWidth(cellWidth),
+          _cellHeight(cellHeight),
+          _numCellsX(cellVariance.getWidth()),
+          _numCellsY(cellVariance.getHeight()),
+          _variance(),
+          _inverseVariance() {
+    if (cellWidth < 1 || cellHeight < 1) {
+        throw LSST_EXCEPT(pexExcept::InvalidParameterError,
+                          (boost::format("cellWidth = %d and cellHeight = %d must both be >= 1") % cellWidth %
+                           cellHeight)
+                                  .str());
+    }
+    if (_numCellsX < 1 || _numCellsY < 1) {
+        throw LSST_EXCEPT(pexExcept::InvalidParameterError, "cellVariance is empty");
+    }
+    _variance.reserve(_numCellsX * _numCellsY);
+    _inverseVariance.reserve(_numCellsX * _numCellsY);
+    for (int y = 0; y != _numCellsY; ++y) {
+        for (auto iter = cellVariance.row_begin(y), end = cellVariance.row_end(y); iter != end; ++iter) {
+            _variance.push_back(*iter);
+            _inverseVariance.push_back(1.0 / *iter);
+        }
+    }
+}
+
+bool coaddChiSq::VarianceModel::covers(lsst::afw::geom::Extent2I const &dimensions) const {
+    return static_cast<std::int64_t>(_numCellsX) * _cellWidth >= dimensions.getX() &&
+           static_cast<std::int64_t>(_numCellsY) * _cellHeight >= dimensions.getY();
+}
+
+coaddChiSq::AddToCoaddStatistics &coaddChiSq::AddToCoaddStatistics::operator+=(
+        AddToCoaddStatistics const &other) {
+    numAccepted += other.numAccepted;
+    numRejected += other.numRejected;
+    for (int bit = 0; bit != NumMaskBits; ++bit) {
+        numRejectedByBit[bit] += other.numRejectedByBit[bit];
+    }
+    numNonFinite += other.numNonFinite;
+    seconds += other.seconds;
+    return *this;
+}
+
+coaddChiSq::AddToCoaddStatistics &coaddChiSq::AddToCoaddStatistics::operator-=(
+        AddToCoaddStatistics const &other) {
+    numAccepted -= other.numAccepted;
+    numRejected -= other.numRejected;
+    for (int bit = 0; bit != NumMaskBits; ++bit) {
+        numRejectedByBit[bit] -= other.numRejectedByBit[bit];
+    }
+    numNonFinite -= other.numNonFinite;
+    return *this;
+}
+
+template <typename CoaddPixelT, typename WeightPixelT, typename InputPixelT>
+afwGeom::Box2I coaddChiSq::addToCoadd(
+        // spell out lsst:afw::image to make Doxygen happy
+        lsst::afw::image::MaskedImage<CoaddPixelT, lsst::afw::image::MaskPixel,
+                                      lsst::afw::image::VariancePixel> &coadd,
+        lsst::afw::image::Image<WeightPixelT> &weightMap,
+        lsst::afw::image::MaskedImage<InputPixelT, lsst::afw::image::MaskPixel,
+                                      lsst::afw::image::VariancePixel> const &image,
+        lsst::afw::image::MaskPixel const badPixelMask, WeightPixelT weight, int numThreads,
+        VarianceModel const *varianceModel) {
+    return addToCoaddImpl(coadd, weightMap, image, badPixelMask, weight, numThreads, nullptr, varianceModel);
+}
+
+template <typename CoaddPixelT, typename WeightPixelT, typename InputPixelT>
+afwGeom::Box2I coaddChiSq::addToCoadd(
+        lsst::afw::image::MaskedImage<CoaddPixelT, lsst::afw::image::MaskPixel,
+                                      lsst::afw::image::VariancePixel> &coadd,
+        lsst::afw::image::Image<WeightPixelT> &weightMap,
+        lsst::afw::image::MaskedImage<InputPixelT, lsst::afw::image::MaskPixel,
+                                      lsst::afw::image::VariancePixel> const &image,
+        lsst::afw::image::MaskPixel const badPixelMask, WeightPixelT weight,
+        AddToCoaddStatistics &statistics, int numThreads, VarianceModel const *varianceModel) {
+    return addToCoaddImpl(coadd, weightMap, image, badPixelMask, weight, numThreads, &statistics,
+                          varianceModel);
+}
+
+template <typename CoaddPixelT, typename WeightPixelT, typename InputPixelT>
+afwGeom::Box2I coaddChiSq::subtractFromCoadd(
+        lsst::afw::image::MaskedImage<CoaddPixelT, lsst::afw::image::MaskPixel,
+                                      lsst::afw::image::VariancePixel> &coadd,
+        lsst::afw::image::Image<WeightPixelT> &weightMap,
+        lsst::afw::image::MaskedImage<InputPixelT, lsst::afw::image::MaskPixel,
+                                      lsst::afw::image::VariancePixel> const &image,
+        lsst::afw::image::MaskPixel const badPixelMask, WeightPixelT weight, int numThreads,
+        VarianceModel const *varianceModel) {
+    return subtractFromCoaddImpl(coadd, weightMap, image, badPixelMask, weight, numThreads, nullptr,
+                                 varianceModel);
+}
+
+template <typename CoaddPixelT, typename WeightPixelT, typename InputPixelT>
+afwGeom::Box2I coaddChiSq::subtractFromCoadd(
+        lsst::afw::image::MaskedImage<CoaddPixelT, lsst::afw::image::MaskPixel,
+                                      lsst::afw::image::VariancePixel> &coadd,
+        lsst::afw::image::Image<WeightPixelT> &weightMap,
+        lsst::afw::image::MaskedImage<InputPixelT, lsst::afw::image::MaskPixel,
+                                      lsst::afw::image::VariancePixel> const &image,
+        lsst::afw::image::MaskPixel const badPixelMask, WeightPixelT weight,
+        AddToCoaddStatistics &statistics, int numThreads, VarianceModel const *varianceModel) {
+    return subtractFromCoaddImpl(coadd, weightMap, image, badPixelMask, weight, numThreads, &statistics,
+                                 varianceModel);
+}
+
+template <typename CoaddPixelT, typename WeightPixelT, typename InputPixelT>
+std::vector<afwGeom::Box2I> coaddChiSq::addManyToCoadd(
+        lsst::afw::image::MaskedImage<CoaddPixelT, lsst::afw::image::MaskPixel,
+                                      lsst::afw::image::VariancePixel> &coadd,
+        lsst::afw::image::Image<WeightPixelT> &weightMap,
+        std::vector<std::shared_ptr<lsst::afw::image::MaskedImage<
+                InputPixelT, lsst::afw::image::MaskPixel, lsst::afw::image::VariancePixel>>> const
+                &maskedImageList,
+        lsst::afw::image::MaskPixel const badPixelMask, std::vector<WeightPixelT> const &weightList,
+        int tileSize, int numThreads) {
+    assertCoaddArgumentsValid(coadd, weightMap, numThreads);
+    if (maskedImageList.size() != weightList.size()) {
+        throw LSST_EXCEPT(pexExcept::InvalidParameterError,
+                          (boost::format("maskedImageList has %d elements but weightList has %d") %
+                           maskedImageList.size() % weightList.size())
+                                  .str());
+    }
+    if (tileSize < 1) {
+        throw LSST_EXCEPT(pexExcept::InvalidParameterError,
+                          (boost::format("tileSize = %d < 1") % tileSize).str());
+    }
+
+    std::vector<afwGeom::Box2I> overlapBBoxList;
+    overlapBBoxList.reserve(maskedImageList.size());
+    afwGeom::Box2I unionBBox;
+    for (auto const &maskedImagePtr : maskedImageList) {
+        if (!maskedImagePtr) {
+            throw LSST_EXCEPT(pexExcept::InvalidParameterError, "maskedImageList contains a null pointer");
+        }
+        afwGeom::Box2I overlapBBox = coadd.getBBox();
+        overlapBBox.clip(maskedImagePtr->getBBox());
+        overlapBBoxList.push_back(overlapBBox);
+        unionBBox.include(overlapBBox);
+    }
+    if (unionBBox.isEmpty()) {
+        return overlapBBoxList;
+    }
+
+    // Visit the coadd one tile at a time and add every overlapping input to that tile before moving on,
+    // so the tile stays in cache while it is updated. Each pixel receives the inputs in list order,
+    // so the result is identical to calling addToCoadd once per input.
+    int const numTilesX = (unionBBox.getWidth() + tileSize - 1) / tileSize;
+    int const numTilesY = (unionBBox.getHeight() + tileSize - 1) / tileSize;
+    runInBands(numTilesY, numThreads, [&](int beginTileY, int endTileY) {
+        for (int tileY = beginTileY; tileY != endTileY; ++tileY) {
+            for (int tileX = 0; tileX != numTilesX; ++tileX) {
+                afwGeom::Box2I tileBBox(afwGeom::Point2I(unionBBox.getMinX() + tileX * tileSize,
+                                                         unionBBox.getMinY() + tileY * tileSize),
+                                        afwGeom::Extent2I(tileSize, tileSize));
+                tileBBox.clip(unionBBox);
+                for (std::size_t i = 0; i != maskedImageList.size(); ++i) {
+                    afwGeom::Box2I box = overlapBBoxList[i];
+                    box.clip(tileBBox);
+                    if (!box.isEmpty()) {
+                        addBoxToCoadd(coadd, weightMap, *maskedImageList[i], box, badPixelMask,
+                                      weightList[i]);
+                    }
+                }
+            }
+        }
+    });
+    return overlapBBoxList;
+}
+
 //
 // Explicit instantiations
 //
 /// \cond
 #define MASKEDIMAGE(IMAGEPIXEL) \
     afwImage::MaskedImage<IMAGEPIXEL, afwImage::MaskPixel, afwImage::VariancePixel>
-#define INSTANTIATE(COADDPIXEL, WEIGHTPIXEL)                                              \
-    template afwGeom::Box2I coaddChiSq::addToCoadd<COADDPIXEL, WEIGHTPIXEL>(              \
-            MASKEDIMAGE(COADDPIXEL) & coadd, afwImage::Image<WEIGHTPIXEL> & weightMap,    \
-            MASKEDIMAGE(COADDPIXEL) const &image, afwImage::MaskPixel const badPixelMask, \
-            WEIGHTPIXEL weight);
-
-INSTANTIATE(double, double);
-INSTANTIATE(double, float);
-INSTANTIATE(double, int);
-INSTANTIATE(double, std::uint16_t);
-INSTANTIATE(float, double);
-INSTANTIATE(float, float);
-INSTANTIATE(float, int);
-INSTANTIATE(float, std::uint16_t);
+#define INSTANTIATE(COADDPIXEL, WEIGHTPIXEL, INPUTPIXEL)                                          \
+    template afwGeom::Box2I coaddChiSq::addToCoadd<COADDPIXEL, WEIGHTPIXEL, INPUTPIXEL>(          \
+            MASKEDIMAGE(COADDPIXEL) & coadd, afwImage::Image<WEIGHTPIXEL> & weightMap,            \
+            MASKEDIMAGE(INPUTPIXEL) const &image, afwImage::MaskPixel const badPixelMask,         \
+            WEIGHTPIXEL weight, int numThreads, coaddChiSq::VarianceModel const *varianceModel);  \
+    template afwGeom::Box2I coaddChiSq::addToCoadd<COADDPIXEL, WEIGHTPIXEL, INPUTPIXEL>(          \
+            MASKEDIMAGE(COADDPIXEL) & coadd, afwImage::Image<WEIGHTPIXEL> & weightMap,            \
+            MASKEDIMAGE(INPUTPIXEL) const &image, afwImage::MaskPixel const badPixelMask,         \
+            WEIGHTPIXEL weight, coaddChiSq::AddToCoaddStatistics &statistics, int numThreads,     \
+            coaddChiSq::VarianceModel const *varianceModel);                                      \
+    template afwGeom::Box2I coaddChiSq::subtractFromCoadd<COADDPIXEL, WEIGHTPIXEL, INPUTPIXEL>(   \
+            MASKEDIMAGE(COADDPIXEL) & coadd, afwImage::Image<WEIGHTPIXEL> & weightMap,            \
+            MASKEDIMAGE(INPUTPIXEL) const &image, afwImage::MaskPixel const badPixelMask,         \
+            WEIGHTPIXEL weight, int numThreads, coaddChiSq::VarianceModel const *varianceModel);  \
+    template afwGeom::Box2I coaddChiSq::subtractFromCoadd<COADDPIXEL, WEIGHTPIXEL, INPUTPIXEL>(   \
+            MASKEDIMAGE(COADDPIXEL) & coadd, afwImage::Image<WEIGHTPIXEL> & weightMap,            \
+            MASKEDIMAGE(INPUTPIXEL) const &image, afwImage::MaskPixel const badPixelMask,         \
+            WEIGHTPIXEL weight, coaddChiSq::AddToCoaddStatistics &statistics, int numThreads,     \
+            coaddChiSq::VarianceModel const *varianceModel);                                      \
+    template std::vector<afwGeom::Box2I>                                                          \
+    coaddChiSq::addManyToCoadd<COADDPIXEL, WEIGHTPIXEL, INPUTPIXEL>(                              \
+            MASKEDIMAGE(COADDPIXEL) & coadd, afwImage::Image<WEIGHTPIXEL> & weightMap,            \
+            std::vector<std::shared_ptr<MASKEDIMAGE(INPUTPIXEL)>> const &maskedImageList,         \
+            afwImage::MaskPixel const badPixelMask, std::vector<WEIGHTPIXEL> const &weightList,   \
+            int tileSize, int numThreads);
+
+INSTANTIATE(double, double, double);
+INSTANTIATE(double, float, double);
+INSTANTIATE(double, int, double);
+INSTANTIATE(double, std::uint16_t, double);
+INSTANTIATE(float, double, float);
+INSTANTIATE(float, float, float);
+INSTANTIATE(float, int, float);
+INSTANTIATE(float, std::uint16_t, float);
+// float input, double accumulator
+INSTANTIATE(double, double, float);
+INSTANTIATE(double, float, float);
+INSTANTIATE(double, int, float);
+INSTANTIATE(double, std::uint16_t, float);
 /// \endcond
@@ -22,14 +22,19 @@
 
 """Test Coadd class
 """
+import os
+import pickle
+import tempfile
 import unittest
 
 import numpy as np
 
 import lsst.utils.tests
+import lsst.afw.geom as afwGeom
 import lsst.afw.image as afwImage
 import lsst.afw.image.utils as imageUtils
 import lsst.afw.image.testUtils as afwTestUtils
+import lsst.afw.math as afwMath
 import lsst.coadd.chisquared as coaddChiSq
 
 doPlot = False
@@ -71,6 +76,27 @@ def makeHistogram(coadd, numBins, numImages):
     return (histX, histY, chiSqY)
 
 
+def makeMaskedImage(dimensions, xy0=(0, 0), badFraction=0.1, badMaskPlane="EDGE"):
+    """Make a Gaussian noise masked image with some pixels flagged as bad
+
+    Inputs:
+    - dimensions: dimensions of masked image (x, y)
+    - xy0: xy0 of masked image
+    - badFraction: fraction of pixels to flag in badMaskPlane
+    - badMaskPlane: name of mask plane for bad pixels
+
+    Returns:
+    - maskedImage: an lsst.afw.image.MaskedImageF
+    """
+    maskedImage = afwTestUtils.makeGaussianNoiseMaskedImage(
+        dimensions=dimensions, sigma=1.0, variance=1.0)
+    maskedImage.setXY0(afwGeom.Point2I(*xy0))
+    badPixelMask = afwImage.Mask.getPlaneBitMask(badMaskPlane)
+    maskArr = maskedImage.getMask().getArray()
+    maskArr[:] = np.where(np.random.random_sample(maskArr.shape) < badFraction, badPixelMask, 0)
+    return maskedImage
+
+
 class CoaddTestCase(unittest.TestCase):
 
     def testNoiseCoadd(self):
@@ -166,6 +192,699 @@ class CoaddTestCase(unittest.TestCase):
         self.assertEqualFilters(coadd.getCoadd().getFilter(), unkFilter)
         self.assertEqualFilterSets(coadd.getFilters(), (gFilter, rFilter))
 
+    def testAgainstNumpy(self):
+        """Test addToCoadd against a NumPy implementation, for float and double coadds
+        """
+        np.random.seed(0)
+        badPixelMask = afwImage.Mask.getPlaneBitMask("EDGE")
+        bbox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(131, 70))
+        inputF = makeMaskedImage(dimensions=(131, 70), badFraction=0.3)
+        inputF.getMask().getArray()[0, 0:3] |= afwImage.Mask.getPlaneBitMask("SAT")
+        inputF.getImage().getArray()[1, 0:3] = np.nan
+        for MaskedImageT, ImageT, weight in ((afwImage.MaskedImageF, afwImage.ImageF, 0.5),
+                                             (afwImage.MaskedImageD, afwImage.ImageD, 0.5),
+                                             (afwImage.MaskedImageF, afwImage.ImageU, 3)):
+            maskedImage = MaskedImageT(bbox)
+            maskedImage.getImage().getArray()[:] = inputF.getImage().getArray()
+            maskedImage.getMask().getArray()[:] = inputF.getMask().getArray()
+            maskedImage.getVariance().getArray()[:] = inputF.getVariance().getArray()
+            coadd = MaskedImageT(bbox)
+            weightMap = ImageT(bbox)
+            for i in range(2):
+                coaddChiSq.addToCoadd(coadd, weightMap, maskedImage, badPixelMask, weight)
+
+            image = maskedImage.getImage().getArray()
+            mask = maskedImage.getMask().getArray()
+            isGood = (mask & badPixelMask) == 0
+            value = np.where(isGood, image * image / maskedImage.getVariance().getArray(), 0)
+            weightArr = weightMap.getArray()
+            np.testing.assert_array_equal(coadd.getImage().getArray(), value + value)
+            np.testing.assert_array_equal(coadd.getMask().getArray(), np.where(isGood, mask, 0))
+            np.testing.assert_array_equal(weightArr, np.where(isGood, weightArr.dtype.type(2 * weight), 0))
+
+    def testMixedPrecision(self):
+        """Test adding float masked images to a double coadd
+        """
+        np.random.seed(0)
+        badPixelMask = afwImage.Mask.getPlaneBitMask("EDGE")
+        coaddBBox = afwGeom.Box2I(afwGeom.Point2I(-5, 3), afwGeom.Extent2I(140, 117))
+        maskedImageList = [makeMaskedImage(dimensions=(150, 100), xy0=xy0) for xy0 in ((0, 0), (-20, 40))]
+
+        # reference: add double copies of the inputs
+        coadd = afwImage.MaskedImageD(coaddBBox)
+        weightMap = afwImage.ImageF(coaddBBox)
+        for maskedImage in maskedImageList:
+            maskedImageD = afwImage.MaskedImageD(maskedImage.getBBox())
+            maskedImageD.getImage().getArray()[:] = maskedImage.getImage().getArray()
+            maskedImageD.getMask().getArray()[:] = maskedImage.getMask().getArray()
+            maskedImageD.getVariance().getArray()[:] = maskedImage.getVariance().getArray()
+            coaddChiSq.addToCoadd(coadd, weightMap, maskedImageD, badPixelMask, 1.0)
+
+        mixedCoadd = afwImage.MaskedImageD(coaddBBox)
+        mixedWeightMap = afwImage.ImageF(coaddBBox)
+        for maskedImage in maskedImageList:
+            coaddChiSq.addToCoadd(mixedCoadd, mixedWeightMap, maskedImage, badPixelMask, 1.0)
+        self.assertMaskedImagesEqual(mixedCoadd, coadd)
+        np.testing.assert_array_equal(mixedWeightMap.getArray(), weightMap.getArray())
+
+        manyCoadd = afwImage.MaskedImageD(coaddBBox)
+        manyWeightMap = afwImage.ImageF(coaddBBox)
+        coaddChiSq.addManyToCoadd(manyCoadd, manyWeightMap, maskedImageList, badPixelMask, [1.0, 1.0])
+        self.assertMaskedImagesEqual(manyCoadd, coadd)
+
+        # Coadd picks the mixed precision kernel and still returns a float exposure
+        exposureList = [afwImage.ExposureF(maskedImage) for maskedImage in maskedImageList]
+        floatCoadd = coaddChiSq.Coadd(bbox=coaddBBox, wcs=None, badMaskPlanes=["EDGE"])
+        doubleCoadd = coaddChiSq.Coadd(bbox=coaddBBox, wcs=None, badMaskPlanes=["EDGE"],
+                                       doubleAccumulator=True)
+        for exposure in exposureList:
+            floatCoadd.addExposure(exposure)
+            doubleCoadd.addExposure(exposure)
+        floatCoaddExposure = floatCoadd.getCoadd()
+        doubleCoaddExposure = doubleCoadd.getCoadd()
+        self.assertIsInstance(doubleCoaddExposure, afwImage.ExposureF)
+        np.testing.assert_allclose(doubleCoaddExposure.getMaskedImage().getImage().getArray(),
+                                   floatCoaddExposure.getMaskedImage().getImage().getArray(), rtol=1e-5)
+        np.testing.assert_array_equal(doubleCoaddExposure.getMaskedImage().getMask().getArray(),
+                                      floatCoaddExposure.getMaskedImage().getMask().getArray())
+
+    def testNumThreads(self):
+        """Test that addToCoadd gives identical results for any number of threads
+        """
+        np.random.seed(0)
+        badPixelMask = afwImage.Mask.getPlaneBitMask("EDGE")
+        coaddBBox = afwGeom.Box2I(afwGeom.Point2I(-5, 3), afwGeom.Extent2I(140, 117))
+        maskedImageList = [makeMaskedImage(dimensions=(150, 100), xy0=xy0) for xy0 in ((0, 0), (-20, 40))]
+
+        def makeCoadd(numThreads):
+            coadd = afwImage.MaskedImageF(coaddBBox)
+            weightMap = afwImage.ImageF(coaddBBox)
+            for maskedImage in maskedImageList:
+                overlapBBox = coaddChiSq.addToCoadd(coadd, weightMap, maskedImage, badPixelMask, 1.0,
+                                                    numThreads=numThreads)
+                expectedBBox = afwGeom.Box2I(coaddBBox)
+                expectedBBox.clip(maskedImage.getBBox())
+                self.assertEqual(overlapBBox, expectedBBox)
+            return coadd, weightMap
+
+        serialCoadd, serialWeightMap = makeCoadd(numThreads=1)
+        for numThreads in (2, 3, 8, 1000):
+            coadd, weightMap = makeCoadd(numThreads=numThreads)
+            np.testing.assert_array_equal(coadd.getImage().getArray(), serialCoadd.getImage().getArray())
+            np.testing.assert_array_equal(coadd.getMask().getArray(), serialCoadd.getMask().getArray())
+            np.testing.assert_array_equal(weightMap.getArray(), serialWeightMap.getArray())
+
+        with self.assertRaises(Exception):
+            coaddChiSq.addToCoadd(afwImage.MaskedImageF(coaddBBox), afwImage.ImageF(coaddBBox),
+                                  maskedImageList[0], badPixelMask, 1.0, numThreads=0)
+
+    def testVarianceModel(self):
+        """Test adding with a model of a constant or per-amplifier variance
+        """
+        np.random.seed(0)
+        badPixelMask = afwImage.Mask.getPlaneBitMask("EDGE")
+        coaddBBox = afwGeom.Box2I(afwGeom.Point2I(-5, 3), afwGeom.Extent2I(140, 117))
+        maskedImage = makeMaskedImage(dimensions=(150, 100), xy0=(-20, 40))
+        varianceArr = maskedImage.getVariance().getArray()
+        varianceArr[:, :75] = 0.7
+        varianceArr[:, 75:] = 1.3
+
+        varianceModel = coaddChiSq.detectVarianceModel(maskedImage.getVariance())
+        self.assertEqual((varianceModel.getNumCellsX(), varianceModel.getNumCellsY()), (2, 1))
+        self.assertEqual((varianceModel.getCellWidth(), varianceModel.getCellHeight()), (75, 100))
+        self.assertAlmostEqual(varianceModel.getVariance(1, 0), 1.3, places=6)
+        self.assertTrue(varianceModel.covers(maskedImage.getDimensions()))
+
+        def addMaskedImage(varianceModel):
+            coadd = afwImage.MaskedImageF(coaddBBox)
+            weightMap = afwImage.ImageF(coaddBBox)
+            statistics = coaddChiSq.AddToCoaddStatistics()
+            coaddChiSq.addToCoadd(coadd, weightMap, maskedImage, badPixelMask, 1.0, statistics,
+                                  numThreads=2, varianceModel=varianceModel)
+            return coadd, weightMap, statistics
+
+        coadd, weightMap, statistics = addMaskedImage(None)
+        modelCoadd, modelWeightMap, modelStatistics = addMaskedImage(varianceModel)
+        # multiplying by the inverse variance may round differently from dividing by the variance
+        np.testing.assert_allclose(modelCoadd.getImage().getArray(), coadd.getImage().getArray(), rtol=1e-6)
+        np.testing.assert_array_equal(modelCoadd.getMask().getArray(), coadd.getMask().getArray())
+        np.testing.assert_array_equal(modelWeightMap.getArray(), weightMap.getArray())
+        modelStatisticsDict = modelStatistics.toDict()
+        statisticsDict = statistics.toDict()
+        del modelStatisticsDict["seconds"], statisticsDict["seconds"]
+        self.assertEqual(modelStatisticsDict, statisticsDict)
+
+        # by default Coadd divides by the variance plane; given a model, it never reads the plane
+        exposure = afwImage.ExposureF(maskedImage)
+        planeCoadd = coaddChiSq.Coadd(bbox=coaddBBox, wcs=None, badMaskPlanes=["EDGE"], numThreads=2)
+        planeCoadd.addExposure(exposure)
+        np.testing.assert_array_equal(planeCoadd._coadd.getMaskedImage().getImage().getArray(),
+                                      coadd.getImage().getArray())
+        varianceArr[:] = np.nan
+        givenCoadd = coaddChiSq.Coadd(bbox=coaddBBox, wcs=None, badMaskPlanes=["EDGE"], numThreads=2)
+        givenCoadd.addExposure(exposure, varianceModel=varianceModel)
+        np.testing.assert_array_equal(givenCoadd._coadd.getMaskedImage().getImage().getArray(),
+                                      modelCoadd.getImage().getArray())
+        np.testing.assert_array_equal(givenCoadd.getWeightMap().getArray(), weightMap.getArray())
+
+        # a constant variance that is a power of two gives identical results
+        varianceArr[:] = 0.25
+        coadd, weightMap, statistics = addMaskedImage(None)
+        constantModel = coaddChiSq.detectVarianceModel(maskedImage.getVariance())
+        self.assertEqual((constantModel.getNumCellsX(), constantModel.getNumCellsY()), (1, 1))
+        self.assertEqual(constantModel.getVariance(0, 0), 0.25)
+        for model in (constantModel, coaddChiSq.VarianceModel(0.25)):
+            modelCoadd, modelWeightMap, modelStatistics = addMaskedImage(model)
+            self.assertMaskedImagesEqual(modelCoadd, coadd)
+
+        # variance planes that are not constant over large enough cells are not modelled
+        varianceArr[:] = np.random.random_sample(varianceArr.shape) + 0.5
+        self.assertIsNone(coaddChiSq.detectVarianceModel(maskedImage.getVariance()))
+        varianceArr[:] = 1.0
+        varianceArr[:, 4:] = 2.0
+        self.assertIsNone(coaddChiSq.detectVarianceModel(maskedImage.getVariance()))
+        self.assertIsNotNone(coaddChiSq.detectVarianceModel(maskedImage.getVariance(), minCellSize=4))
+        varianceArr[60, 100] = 3.0
+        self.assertIsNone(coaddChiSq.detectVarianceModel(maskedImage.getVariance(), minCellSize=4))
+
+        with self.assertRaises(Exception):
+            addMaskedImage(coaddChiSq.VarianceModel(afwImage.ImageF(2, 1), 70, 100))
+        with self.assertRaises(Exception):
+            coaddChiSq.VarianceModel(afwImage.ImageF(2, 1), 0, 100)
+
+    def testAddManyToCoadd(self):
+        """Test that addManyToCoadd matches calling addToCoadd for each input
+        """
+        np.random.seed(0)
+        badPixelMask = afwImage.Mask.getPlaneBitMask("EDGE")
+        coaddBBox = afwGeom.Box2I(afwGeom.Point2I(-5, 3), afwGeom.Extent2I(140, 117))
+        maskedImageList = [makeMaskedImage(dimensions=(90, 70), xy0=xy0)
+                           for xy0 in ((0, 0), (-20, 40), (60, 30), (500, 500))]
+        weightList = [1.0, 2.0, 0.5, 1.0]
+
+        coadd = afwImage.MaskedImageF(coaddBBox)
+        weightMap = afwImage.ImageF(coaddBBox)
+        overlapBBoxList = [coaddChiSq.addToCoadd(coadd, weightMap, maskedImage, badPixelMask, weight)
+                           for maskedImage, weight in zip(maskedImageList, weightList)]
+
+        for tileSize, numThreads in ((1, 1), (16, 1), (16, 3), (1000, 2)):
+            manyCoadd = afwImage.MaskedImageF(coaddBBox)
+            manyWeightMap = afwImage.ImageF(coaddBBox)
+            manyOverlapBBoxList = coaddChiSq.addManyToCoadd(manyCoadd, manyWeightMap, maskedImageList,
+                                                            badPixelMask, weightList,
+                                                            tileSize=tileSize, numThreads=numThreads)
+            self.assertEqual(list(manyOverlapBBoxList), overlapBBoxList)
+            self.assertMaskedImagesEqual(manyCoadd, coadd)
+            np.testing.assert_array_equal(manyWeightMap.getArray(), weightMap.getArray())
+
+        with self.assertRaises(Exception):
+            coaddChiSq.addManyToCoadd(manyCoadd, manyWeightMap, maskedImageList, badPixelMask, [1.0])
+
+    def testAddExposures(self):
+        """Test that addExposures matches calling addExposure in a loop
+        """
+        np.random.seed(0)
+        exposureList = [afwImage.ExposureF(makeMaskedImage(dimensions=(120, 80), xy0=xy0))
+                        for xy0 in ((0, 0), (10, -5), (-30, 20), (50, 50), (200, 200))]
+        bbox = exposureList[0].getBBox()
+        wcs = exposureList[0].getWcs()
+
+        serialCoadd = coaddChiSq.Coadd(bbox=bbox, wcs=wcs, badMaskPlanes=["EDGE"])
+        for exposure in exposureList:
+            serialCoadd.addExposure(exposure)
+
+        def prepare(index):
+            # skip every third input
+            return None if index % 3 == 2 else exposureList[index]
+
+        for maxWorkers in (1, 3):
+            coadd = coaddChiSq.Coadd(bbox=bbox, wcs=wcs, badMaskPlanes=["EDGE"])
+            results = coadd.addExposures(exposureList, maxWorkers=maxWorkers)
+            self.assertEqual(len(results), len(exposureList))
+            self.assertTrue(results[-1][0].isEmpty())
+            self.assertMaskedImagesEqual(coadd.getCoadd().getMaskedImage(),
+                                         serialCoadd.getCoadd().getMaskedImage())
+            np.testing.assert_array_equal(coadd.getWeightMap().getArray(),
+                                          serialCoadd.getWeightMap().getArray())
+
+            partialCoadd = coaddChiSq.Coadd(bbox=bbox, wcs=wcs, badMaskPlanes=["EDGE"])
+            results = partialCoadd.addExposures(range(len(exposureList)), prepare=prepare,
+                                                maxWorkers=maxWorkers)
+            self.assertEqual([result is None for result in results], [False, False, True, False, False])
+
+        with self.assertRaises(ValueError):
+            coadd.addExposures(exposureList, maxWorkers=0)
+
+        idCoadd = coaddChiSq.Coadd(bbox=bbox, wcs=wcs, badMaskPlanes=["EDGE"])
+        idCoadd.addExposures(exposureList[:2], exposureIds=["a", "b"])
+        self.assertEqual(idCoadd.getConsumedIds(), ["a", "b"])
+        for exposureIds in (["a"], ["a", "b", "c"]):
+            with self.assertRaises(ValueError):
+                idCoadd.addExposures(exposureList[:2], exposureIds=exposureIds)
+            # inputs with no length are checked as they are reached
+            with self.assertRaises(ValueError):
+                idCoadd.addExposures(iter(exposureList[:2]), exposureIds=exposureIds)
+
+    def testStatistics(self):
+        """Test the statistics counted by addToCoadd and Coadd
+        """
+        np.random.seed(0)
+        maskedImage = makeMaskedImage(dimensions=(120, 80), xy0=(10, -5), badFraction=0.2)
+        edgeBit = afwImage.Mask.getPlaneBitMask("EDGE")
+        satBit = afwImage.Mask.getPlaneBitMask("SAT")
+        maskArr = maskedImage.getMask().getArray()
+        maskArr[np.random.random_sample(maskArr.shape) < 0.1] |= satBit
+        imageArr = maskedImage.getImage().getArray()
+        imageArr[np.random.random_sample(imageArr.shape) < 0.05] = np.nan
+        exposure = afwImage.ExposureF(maskedImage)
+        bbox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(120, 80))
+        badPixelMask = edgeBit | satBit
+
+        # expected counts in the overlap
+        overlapBBox = afwGeom.Box2I(bbox)
+        overlapBBox.clip(maskedImage.getBBox())
+        overlapMask = afwImage.Mask(maskedImage.getMask(), overlapBBox, afwImage.PARENT).getArray()
+        overlapImage = afwImage.ImageF(maskedImage.getImage(), overlapBBox, afwImage.PARENT).getArray()
+        isBad = (overlapMask & badPixelMask) != 0
+        expectedDict = dict(
+            numAccepted=np.count_nonzero(~isBad),
+            numRejected=np.count_nonzero(isBad),
+            numRejectedByPlane=dict(EDGE=np.count_nonzero(overlapMask & edgeBit),
+                                    SAT=np.count_nonzero(overlapMask & satBit)),
+            numNonFinite=np.count_nonzero(~isBad & np.isnan(overlapImage)),
+        )
+
+        for numThreads in (1, 3):
+            coadd = afwImage.MaskedImageF(bbox)
+            weightMap = afwImage.ImageF(bbox)
+            statistics = coaddChiSq.AddToCoaddStatistics()
+            coaddChiSq.addToCoadd(coadd, weightMap, maskedImage, badPixelMask, 1.0, statistics,
+                                  numThreads=numThreads)
+            statisticsDict = statistics.toDict()
+            self.assertGreaterEqual(statisticsDict.pop("seconds"), 0)
+            self.assertEqual(statisticsDict, expectedDict)
+
+            # counting does not change the result
+            refCoadd = afwImage.MaskedImageF(bbox)
+            refWeightMap = afwImage.ImageF(bbox)
+            coaddChiSq.addToCoadd(refCoadd, refWeightMap, maskedImage, badPixelMask, 1.0)
+            self.assertMaskedImagesEqual(coadd, refCoadd)
+
+        chiSqCoadd = coaddChiSq.Coadd(bbox=bbox, wcs=exposure.getWcs(), badMaskPlanes=["EDGE", "SAT"])
+        self.assertIsNone(chiSqCoadd.getLastStatistics())
+        for i in range(2):
+            chiSqCoadd.addExposure(exposure)
+            self.assertEqual(chiSqCoadd.getLastStatistics().numAccepted, expectedDict["numAccepted"])
+        self.assertEqual(chiSqCoadd.getTotalStatistics().numRejected, 2 * expectedDict["numRejected"])
+
+        # statistics can be pickled, e.g. to return them from a worker process
+        statistics = pickle.loads(pickle.dumps(chiSqCoadd.getTotalStatistics()))
+        self.assertEqual(statistics.toDict(), chiSqCoadd.getTotalStatistics().toDict())
+
+        with tempfile.TemporaryDirectory() as directory:
+            memmapCoadd = coaddChiSq.MemmapCoadd(bbox=bbox, wcs=exposure.getWcs(),
+                                                 badMaskPlanes=["EDGE", "SAT"], directory=directory,
+                                                 tileBudget=5000)
+            memmapCoadd.addExposure(exposure)
+            statisticsDict = memmapCoadd.getLastStatistics().toDict()
+            del statisticsDict["seconds"]
+            self.assertEqual(statisticsDict, expectedDict)
+
+    def testMemmapCoadd(self):
+        """Test that MemmapCoadd matches Coadd for any tile budget
+        """
+        np.random.seed(0)
+        exposureList = [afwImage.ExposureF(makeMaskedImage(dimensions=(120, 80), xy0=xy0))
+                        for xy0 in ((0, 0), (10, -5), (-30, 20), (200, 200))]
+        bbox = exposureList[0].getBBox()
+        wcs = exposureList[0].getWcs()
+
+        for doubleAccumulator in (False, True):
+            coadd = coaddChiSq.Coadd(bbox=bbox, wcs=wcs, badMaskPlanes=["EDGE"],
+                                     doubleAccumulator=doubleAccumulator)
+            results = [coadd.addExposure(exposure, 0.5) for exposure in exposureList]
+            for tileBudget in (1, 5000, 1 << 30):
+                with tempfile.TemporaryDirectory() as directory:
+                    memmapCoadd = coaddChiSq.MemmapCoadd(bbox=bbox, wcs=wcs, badMaskPlanes=["EDGE"],
+                                                         directory=directory, tileBudget=tileBudget,
+                                                         doubleAccumulator=doubleAccumulator)
+                    mappedRows = []
+                    mapRows = memmapCoadd._mapRows
+
+                    def recordMapRows(name, beginY, endY):
+                        mappedRows.append(endY - beginY)
+                        return mapRows(name, beginY, endY)
+
+                    memmapCoadd._mapRows = recordMapRows
+                    memmapResults = [memmapCoadd.addExposure(exposure, 0.5) for exposure in exposureList]
+                    self.assertEqual(memmapResults, results)
+                    # full-width bands, with a variance plane, fit in the budget (or are one row)
+                    bytesPerRow = bbox.getWidth() * (20 if doubleAccumulator else 16)
+                    self.assertLessEqual(max(mappedRows), max(1, tileBudget // bytesPerRow))
+                    self.assertEqual(memmapCoadd.getBBox(), bbox)
+                    self.assertMaskedImagesEqual(memmapCoadd.getCoadd().getMaskedImage(),
+                                                 coadd.getCoadd().getMaskedImage())
+                    np.testing.assert_array_equal(memmapCoadd.getWeightMap().getArray(),
+                                                  coadd.getWeightMap().getArray())
+                    self.assertTrue(os.path.exists(memmapCoadd.getPath("image")))
+
+                    # a checkpoint copies the accumulator files one band at a time, without a variance plane
+                    checkpointDir = os.path.join(directory, "checkpoint")
+                    memmapCoadd.enableCheckpoints(checkpointDir, everyN=100)
+                    del mappedRows[:]
+                    memmapCoadd.writeCheckpoint(wait=True)
+                    bytesPerRow = bbox.getWidth() * (16 if doubleAccumulator else 12)
+                    self.assertLessEqual(max(mappedRows), max(1, tileBudget // bytesPerRow))
+                    self.assertIn("planes", coaddChiSq.readCheckpointManifest(checkpointDir))
+                    resumedList = [
+                        coaddChiSq.MemmapCoadd.fromCheckpoint(checkpointDir, tileBudget=tileBudget,
+                                                              directory=os.path.join(directory, "resumed")),
+                        coaddChiSq.Coadd.fromCheckpoint(checkpointDir),
+                    ]
+                    for resumedCoadd in resumedList:
+                        self.assertEqual(resumedCoadd.getBBox(), bbox)
+                        self.assertMaskedImagesEqual(resumedCoadd.getCoadd().getMaskedImage(),
+                                                     coadd.getCoadd().getMaskedImage())
+                        np.testing.assert_array_equal(resumedCoadd.getWeightMap().getArray(),
+                                                      coadd.getWeightMap().getArray())
+
+                    with self.assertRaises(RuntimeError):
+                        coaddChiSq.MemmapCoadd(bbox=bbox, wcs=wcs, badMaskPlanes=["EDGE"],
+                                               directory=directory)
+
+        with self.assertRaises(ValueError):
+            coaddChiSq.MemmapCoadd(bbox=bbox, wcs=wcs, badMaskPlanes=["EDGE"], directory=directory,
+                                   tileBudget=0)
+
+    def testCheckpoint(self):
+        """Test that a coadd resumed from a checkpoint matches an uninterrupted one
+        """
+        np.random.seed(0)
+        exposureList = [afwImage.ExposureF(makeMaskedImage(dimensions=(120, 80), xy0=xy0))
+                        for xy0 in ((0, 0), (10, -5), (-30, 20), (50, 50), (5, 5))]
+        exposureIdList = ["exp%d" % (i,) for i in range(len(exposureList))]
+        bbox = exposureList[0].getBBox()
+        wcs = exposureList[0].getWcs()
+
+        fullCoadd = coaddChiSq.Coadd(bbox=bbox, wcs=wcs, badMaskPlanes=["EDGE"])
+        for exposure in exposureList:
+            fullCoadd.addExposure(exposure)
+
+        with tempfile.TemporaryDirectory() as checkpointDir:
+            self.assertIsNone(coaddChiSq.readCheckpointManifest(checkpointDir))
+            coadd = coaddChiSq.Coadd(bbox=bbox, wcs=wcs, badMaskPlanes=["EDGE"])
+            with self.assertRaises(RuntimeError):
+                coadd.writeCheckpoint()
+            coadd.enableCheckpoints(checkpointDir, everyN=2)
+            for exposure, exposureId in zip(exposureList[:3], exposureIdList[:3]):
+                coadd.addExposure(exposure, exposureId=exposureId)
+            coadd.waitForCheckpoint()
+            coadd.writeCheckpoint(wait=True)
+            self.assertEqual(coaddChiSq.readCheckpointManifest(checkpointDir)["consumedIds"],
+                             exposureIdList[:3])
+            self.assertEqual(len(os.listdir(checkpointDir)), 3)
+
+            resumedCoadd = coaddChiSq.Coadd.fromCheckpoint(checkpointDir, numThreads=2)
+            self.assertEqual(resumedCoadd.getBBox(), bbox)
+            self.assertEqual(resumedCoadd.getNumThreads(), 2)
+            self.assertEqual(resumedCoadd.getConsumedIds(), exposureIdList[:3])
+            self.assertEqualFilterSets(resumedCoadd.getFilters(), coadd.getFilters())
+            for exposure, exposureId in zip(exposureList, exposureIdList):
+                if not resumedCoadd.isConsumed(exposureId):
+                    resumedCoadd.addExposure(exposure, exposureId=exposureId)
+            self.assertMaskedImagesEqual(resumedCoadd.getCoadd().getMaskedImage(),
+                                         fullCoadd.getCoadd().getMaskedImage())
+            np.testing.assert_array_equal(resumedCoadd.getWeightMap().getArray(),
+                                          fullCoadd.getWeightMap().getArray())
+
+            with tempfile.TemporaryDirectory() as directory:
+                memmapCoadd = coaddChiSq.MemmapCoadd.fromCheckpoint(checkpointDir, directory=directory)
+                np.testing.assert_array_equal(memmapCoadd.getWeightMap().getArray(),
+                                              coadd.getWeightMap().getArray())
+
+        with self.assertRaises(ValueError):
+            coadd.enableCheckpoints(checkpointDir)
+
+    def testMerge(self):
+        """Test that merging partial coadds matches a single coadd
+        """
+        np.random.seed(0)
+        exposureList = [afwImage.ExposureF(makeMaskedImage(dimensions=(120, 80), xy0=xy0))
+                        for xy0 in ((0, 0), (10, -5), (-30, 20), (50, 50), (5, 5))]
+        bbox = exposureList[0].getBBox()
+        wcs = exposureList[0].getWcs()
+
+        fullCoadd = coaddChiSq.Coadd(bbox=bbox, wcs=wcs, badMaskPlanes=["EDGE"])
+        for exposure in exposureList:
+            fullCoadd.addExposure(exposure)
+
+        # partial coadds with bboxes that are smaller than, overlap and contain the full bbox
+        partialBBoxList = [afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(120, 40)),
+                           afwGeom.Box2I(afwGeom.Point2I(0, 40), afwGeom.Extent2I(120, 40)),
+                           afwGeom.Box2I(afwGeom.Point2I(-100, -100), afwGeom.Extent2I(400, 400))]
+        for maxWorkers in (1, 2):
+            partialCoaddList = [coaddChiSq.Coadd(bbox=partialBBox, wcs=wcs, badMaskPlanes=["EDGE"])
+                                for partialBBox in partialBBoxList]
+            partialCoaddList[2].addExposure(exposureList[0], exposureId=0)
+            for i, exposure in enumerate(exposureList[1:], 1):
+                partialCoaddList[i % 2].addExposure(exposure, exposureId=i)
+
+            mergedCoadd = coaddChiSq.mergeCoadds(partialCoaddList, maxWorkers=maxWorkers)
+            self.assertEqual(mergedCoadd.getBBox(), partialBBoxList[2])
+            self.assertEqual(sorted(mergedCoadd.getConsumedIds()), [0, 1, 2, 3, 4])
+
+            subCoadd = coaddChiSq.Coadd(bbox=bbox, wcs=wcs, badMaskPlanes=["EDGE"])
+            overlapBBox = subCoadd.merge(mergedCoadd)
+            self.assertEqual(overlapBBox, bbox)
+            np.testing.assert_allclose(subCoadd.getCoadd().getImage().getArray(),
+                                       fullCoadd.getCoadd().getImage().getArray(), rtol=1e-6)
+            np.testing.assert_array_equal(subCoadd.getCoadd().getMask().getArray(),
+                                          fullCoadd.getCoadd().getMask().getArray())
+            np.testing.assert_array_equal(subCoadd.getWeightMap().getArray(),
+                                          fullCoadd.getWeightMap().getArray())
+
+        with tempfile.TemporaryDirectory() as directory:
+            memmapCoadd = coaddChiSq.MemmapCoadd(bbox=bbox, wcs=wcs, badMaskPlanes=["EDGE"],
+                                                 directory=directory, tileBudget=1000)
+            memmapCoadd.merge(fullCoadd)
+            np.testing.assert_array_equal(memmapCoadd.getWeightMap().getArray(),
+                                          fullCoadd.getWeightMap().getArray())
+            mergedCoadd = coaddChiSq.Coadd(bbox=bbox, wcs=wcs, badMaskPlanes=["EDGE"])
+            mergedCoadd.merge(memmapCoadd)
+            self.assertMaskedImagesEqual(mergedCoadd.getCoadd().getMaskedImage(),
+                                         fullCoadd.getCoadd().getMaskedImage())
+
+        with self.assertRaises(ValueError):
+            fullCoadd.merge(coaddChiSq.Coadd(bbox=bbox, wcs=wcs, badMaskPlanes=["EDGE", "SAT"]))
+        with self.assertRaises(ValueError):
+            coaddChiSq.mergeCoadds([])
+
+    def testWarpAndAddExposure(self):
+        """Test that warping and adding tile by tile matches warping the
+        whole exposure and adding it
+        """
+        np.random.seed(0)
+        bbox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(100, 80))
+        coaddWcs = afwGeom.makeSkyWcs(crpix=afwGeom.Point2D(50, 40),
+                                      crval=afwGeom.SpherePoint(10.0, 20.0, afwGeom.degrees),
+                                      cdMatrix=afwGeom.makeCdMatrix(scale=0.2*afwGeom.arcseconds))
+        exposureList = []
+        for crpix in ((45.3, 42.1), (90.5, 10.2), (-60, 40)):
+            wcs = afwGeom.makeSkyWcs(crpix=afwGeom.Point2D(*crpix),
+                                     crval=afwGeom.SpherePoint(10.0, 20.0, afwGeom.degrees),
+                                     cdMatrix=afwGeom.makeCdMatrix(scale=0.21*afwGeom.arcseconds,
+                                                                   orientation=5*afwGeom.degrees))
+            exposureList.append(afwImage.makeExposure(makeMaskedImage(dimensions=(100, 80)), wcs))
+
+        # without interpolating the transform the tiled warp is exact
+        warpConfig = afwMath.Warper.ConfigClass()
+        warpConfig.interpLength = 0
+        warper = afwMath.Warper.fromConfig(warpConfig)
+        coadd = coaddChiSq.Coadd(bbox=bbox, wcs=coaddWcs, badMaskPlanes=["EDGE", "NO_DATA"])
+        for exposure in exposureList:
+            warpedExposure = warper.warpExposure(destWcs=coaddWcs, srcExposure=exposure, maxBBox=bbox)
+            coadd.addExposure(warpedExposure, 0.5)
+
+        warpingControl = coaddChiSq.makeWarpingControl(warpConfig)
+        for tileSize in (1, 17, 1000):
+            tiledCoadd = coaddChiSq.Coadd(bbox=bbox, wcs=coaddWcs, badMaskPlanes=["EDGE", "NO_DATA"])
+            results = [tiledCoadd.warpAndAddExposure(exposure, warpingControl, 0.5, exposureId=i,
+                                                     tileSize=tileSize)
+                       for i, exposure in enumerate(exposureList)]
+            self.assertEqual([result[1] for result in results], [0.5, 0.5, 0.5])
+            self.assertTrue(results[-1][0].isEmpty())
+            self.assertEqual(tiledCoadd.getConsumedIds(), [0, 1, 2])
+            self.assertMaskedImagesEqual(tiledCoadd.getCoadd().getMaskedImage(),
+                                         coadd.getCoadd().getMaskedImage())
+            np.testing.assert_array_equal(tiledCoadd.getWeightMap().getArray(),
+                                          coadd.getWeightMap().getArray())
+
+        # a constant variance of the warped exposure is used as by addExposure; a grid cannot be
+        modelCoadd = coaddChiSq.Coadd(bbox=bbox, wcs=coaddWcs, badMaskPlanes=["EDGE", "NO_DATA"])
+        tiledModelCoadd = coaddChiSq.Coadd(bbox=bbox, wcs=coaddWcs, badMaskPlanes=["EDGE", "NO_DATA"])
+        # one cell smaller than a tile acts as a constant variance
+        oneCellModel = coaddChiSq.VarianceModel(afwImage.ImageF(1, 1, 0.8), 10, 10)
+        for exposure in exposureList:
+            warpedExposure = warper.warpExposure(destWcs=coaddWcs, srcExposure=exposure, maxBBox=bbox)
+            modelCoadd.addExposure(warpedExposure, 0.5, varianceModel=0.8)
+            tiledModelCoadd.warpAndAddExposure(exposure, warpingControl, 0.5, tileSize=17,
+                                               varianceModel=oneCellModel)
+        self.assertMaskedImagesEqual(tiledModelCoadd.getCoadd().getMaskedImage(),
+                                     modelCoadd.getCoadd().getMaskedImage())
+        with self.assertRaises(AssertionError):
+            self.assertMaskedImagesEqual(modelCoadd.getCoadd().getMaskedImage(),
+                                         coadd.getCoadd().getMaskedImage())
+
+        with self.assertRaises(ValueError):
+            coadd.warpAndAddExposure(exposureList[0], warpingControl, tileSize=0)
+        with self.assertRaises(ValueError):
+            coadd.warpAndAddExposure(exposureList[0], warpingControl,
+                                     varianceModel=coaddChiSq.VarianceModel(afwImage.ImageF(2, 1), 50, 80))
+
+    def testIncrementalCoadd(self):
+        """Test that removing an exposure from an incremental coadd matches
+        a coadd built without it, and that a saved coadd can be extended
+        """
+        np.random.seed(0)
+        exposureList = [afwImage.ExposureF(makeMaskedImage(dimensions=(120, 80), xy0=xy0))
+                        for xy0 in ((0, 0), (10, -5), (-30, 20), (50, 50))]
+        # flag some good pixels in a mask plane that is ORed into the coadd
+        crBit = afwImage.Mask.getPlaneBitMask("CR")
+        for exposure in exposureList:
+            maskArr = exposure.getMaskedImage().getMask().getArray()
+            maskArr |= np.where(np.random.random_sample(maskArr.shape) < 0.05, crBit, 0).astype(maskArr.dtype)
+        bbox = exposureList[0].getBBox()
+        wcs = exposureList[0].getWcs()
+
+        def makeCoadd(indices):
+            coadd = coaddChiSq.IncrementalCoadd(bbox=bbox, wcs=wcs, badMaskPlanes=["EDGE"])
+            for i in indices:
+                coadd.addExposure(exposureList[i], weightFactor=i + 1, exposureId="exp%d" % (i,))
+            return coadd
+
+        expectedCoadd = makeCoadd([0, 1, 3])
+        coadd = makeCoadd([0, 1, 2, 3])
+        with self.assertRaises(ValueError):
+            coadd.addExposure(exposureList[2], exposureId="exp2")
+        with self.assertRaises(ValueError):
+            coadd.addExposure(exposureList[2])
+        with self.assertRaises(ValueError):
+            coadd.removeExposure(exposureList[1], exposureId="exp2")
+        with self.assertRaises(ValueError):
+            coadd.removeExposure(exposureList[2], exposureId="exp4")
+
+        overlapBBox = coadd.removeExposure(exposureList[2], exposureId="exp2")
+        self.assertEqual(overlapBBox, afwGeom.Box2I(afwGeom.Point2I(0, 20), afwGeom.Extent2I(90, 60)))
+        self.assertEqual(coadd.getConsumedIds(), ["exp0", "exp1", "exp3"])
+        self.assertEqual([record.weight for record in coadd.getExposureRecords()], [1, 2, 4])
+        np.testing.assert_array_equal(coadd.getWeightMap().getArray(),
+                                      expectedCoadd.getWeightMap().getArray())
+        np.testing.assert_array_equal(coadd.getCoadd().getMaskedImage().getMask().getArray(),
+                                      expectedCoadd.getCoadd().getMaskedImage().getMask().getArray())
+        np.testing.assert_allclose(coadd.getCoadd().getMaskedImage().getImage().getArray(),
+                                   expectedCoadd.getCoadd().getMaskedImage().getImage().getArray(),
+                                   rtol=1e-6)
+        # the counts of the removed pixels are removed from the totals
+        statisticsDict = coadd.getTotalStatistics().toDict()
+        expectedStatisticsDict = expectedCoadd.getTotalStatistics().toDict()
+        del statisticsDict["seconds"], expectedStatisticsDict["seconds"]
+        self.assertEqual(statisticsDict, expectedStatisticsDict)
+        statistics = coaddChiSq.AddToCoaddStatistics()
+        statistics += coadd.getTotalStatistics()
+        statistics -= coadd.getTotalStatistics()
+        self.assertEqual((statistics.numAccepted, statistics.numRejected), (0, 0))
+        self.assertEqual(statistics.seconds, coadd.getTotalStatistics().seconds)
+
+        with tempfile.TemporaryDirectory() as directory:
+            coadd.save(directory)
+            reopenedCoadd = coaddChiSq.IncrementalCoadd.open(directory)
+            self.assertEqual(reopenedCoadd.getExposureRecords(), coadd.getExposureRecords())
+            # the total statistics are saved, so removing an exposure after reopening leaves them valid
+            self.assertEqual(reopenedCoadd.getTotalStatistics().toDict(), coadd.getTotalStatistics().toDict())
+            reopenedCoadd.removeExposure(exposureList[0], exposureId="exp0")
+            reopenedCoadd.addExposure(exposureList[2], weightFactor=3, exposureId="exp2")
+            reopenedCoadd.save()
+
+            expectedCoadd = makeCoadd([1, 3, 2])
+            expectedStatisticsDict = expectedCoadd.getTotalStatistics().toDict()
+            del expectedStatisticsDict["seconds"]
+            savedCoadd = coaddChiSq.IncrementalCoadd.open(directory)
+            self.assertEqual(savedCoadd.getConsumedIds(), ["exp1", "exp3", "exp2"])
+            for statisticsCoadd in (reopenedCoadd, savedCoadd):
+                statisticsDict = statisticsCoadd.getTotalStatistics().toDict()
+                del statisticsDict["seconds"]
+                self.assertEqual(statisticsDict, expectedStatisticsDict)
+                self.assertGreater(statisticsDict["numAccepted"], 0)
+            np.testing.assert_array_equal(savedCoadd.getWeightMap().getArray(),
+                                          expectedCoadd.getWeightMap().getArray())
+            np.testing.assert_array_equal(savedCoadd.getCoadd().getMaskedImage().getMask().getArray(),
+                                          expectedCoadd.getCoadd().getMaskedImage().getMask().getArray())
+
+        with self.assertRaises(RuntimeError):
+            makeCoadd([]).save()
+
+    def testIncrementalCoaddVarianceModel(self):
+        """Test that an exposure added with a variance model other than its
+        variance plane is removed with the same model, also after saving
+        """
+        np.random.seed(1)
+        exposureList = [afwImage.ExposureF(makeMaskedImage(dimensions=(120, 80), xy0=xy0))
+                        for xy0 in ((0, 0), (10, -5), (-30, 20))]
+        bbox = exposureList[0].getBBox()
+        wcs = exposureList[0].getWcs()
+        cellVariance = afwImage.ImageF(3, 2)
+        cellVariance.getArray()[:] = [[0.5, 1.5, 3.0], [0.75, 2.0, 4.0]]
+        # the variance planes are 1.0, so subtracting with them instead would leave a residue
+        varianceModels = [None, 2.0, coaddChiSq.VarianceModel(cellVariance, 50, 50)]
+
+        def makeCoadd(indices):
+            coadd = coaddChiSq.IncrementalCoadd(bbox=bbox, wcs=wcs, badMaskPlanes=["EDGE"])
+            for i in indices:
+                coadd.addExposure(exposureList[i], weightFactor=i + 1, exposureId="exp%d" % (i,),
+                                  varianceModel=varianceModels[i])
+            return coadd
+
+        def assertCoaddsEqual(coadd, expectedCoadd):
+            np.testing.assert_array_equal(coadd.getWeightMap().getArray(),
+                                          expectedCoadd.getWeightMap().getArray())
+            np.testing.assert_allclose(coadd.getCoadd().getMaskedImage().getImage().getArray(),
+                                       expectedCoadd.getCoadd().getMaskedImage().getImage().getArray(),
+                                       rtol=1e-6)
+
+        coadd = makeCoadd([0, 1, 2])
+        self.assertEqual([record.varianceModel for record in coadd.getExposureRecords()][:2], [None, 2.0])
+        self.assertEqual(coadd.getExposureRecords()[2].varianceModel,
+                         dict(cellWidth=50, cellHeight=50, cellVariance=cellVariance.getArray().tolist()))
+        coadd.removeExposure(exposureList[1], exposureId="exp1")
+        assertCoaddsEqual(coadd, makeCoadd([0, 2]))
+
+        with tempfile.TemporaryDirectory() as directory:
+            coadd.save(directory)
+            reopenedCoadd = coaddChiSq.IncrementalCoadd.open(directory)
+            self.assertEqual(reopenedCoadd.getExposureRecords(), coadd.getExposureRecords())
+            reopenedCoadd.removeExposure(exposureList[2], exposureId="exp2")
+            assertCoaddsEqual(reopenedCoadd, makeCoadd([0]))
+
+        # an exposure that fails to be added is not recorded, so it can be added again
+        coadd = makeCoadd([0])
+        smallModel = coaddChiSq.VarianceModel(afwImage.ImageF(1, 1, 2.0), 10, 10)
+        with self.assertRaises(Exception):
+            coadd.addExposure(exposureList[1], weightFactor=2, exposureId="exp1", varianceModel=smallModel)
+        self.assertEqual([record.exposureId for record in coadd.getExposureRecords()], ["exp0"])
+        self.assertEqual(coadd.getConsumedIds(), ["exp0"])
+        coadd.addExposure(exposureList[1], weightFactor=2, exposureId="exp1", varianceModel=2.0)
+        assertCoaddsEqual(coadd, makeCoadd([0, 1]))
+
+        # records saved before variance models were recorded used the variance plane
+        record = coaddChiSq.ExposureRecord(exposureId="exp0", hash="", weight=1.0, filterName="g")
+        self.assertIsNone(record.varianceModel)
+
+    def assertMaskedImagesEqual(self, maskedImage1, maskedImage2):
+        """Assert that the image and mask planes of two masked images are identical
+        """
+        np.testing.assert_array_equal(maskedImage1.getImage().getArray(), maskedImage2.getImage().getArray())
+        np.testing.assert_array_equal(maskedImage1.getMask().getArray(), maskedImage2.getMask().getArray())
+
     def assertEqualFilters(self, f1, f2):
         """Compare two filters
 
@@ -0,0 +1,162 @@
+#
+# LSST Data Management System
+# Copyright 2008-2018 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+"""Test exposure footprints computed from FITS headers
+"""
+import os
+import tempfile
+import unittest
+
+import lsst.utils.tests
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.coadd.chisquared.footprint as footprint
+from lsst.coadd.chisquared.exposureIndex import ExposureIndex
+
+
+def makeWcs(crval, crpix=(50, 40)):
+    """Make a simple TAN WCS with 0.2 arcsec pixels
+    """
+    return afwGeom.makeSkyWcs(crpix=afwGeom.Point2D(*crpix),
+                              crval=afwGeom.SpherePoint(crval[0], crval[1], afwGeom.degrees),
+                              cdMatrix=afwGeom.makeCdMatrix(scale=0.2*afwGeom.arcseconds))
+
+
+class FootprintTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.coaddWcs = makeWcs((10.0, 20.0))
+        self.coaddBBox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(100, 80))
+
+    def testProjectFootprint(self):
+        """Test projecting an outline onto the coadd pixel grid
+        """
+        bbox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(100, 80))
+        # shifting crpix by (10, 5) shifts the footprint by (-10, -5) coadd pixels
+        coaddBox = footprint.projectFootprint(makeWcs((10.0, 20.0), crpix=(60, 45)), bbox, self.coaddWcs)
+        expectedBox = afwGeom.Box2D(bbox)
+        expectedBox.shift(afwGeom.Extent2D(-10, -5))
+        for value, expectedValue in zip((coaddBox.getMinX(), coaddBox.getMinY(),
+                                         coaddBox.getMaxX(), coaddBox.getMaxY()),
+                                        (expectedBox.getMinX(), expectedBox.getMinY(),
+                                         expectedBox.getMaxX(), expectedBox.getMaxY())):
+            self.assertAlmostEqual(value, expectedValue, places=3)
+
+    def testGetInputBBox(self):
+        """Test the part of an exposure that can contribute to the coadd
+        """
+        bbox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(100, 80))
+        # shifting crpix by (60.5, 5) shifts coadd pixels by (60.5, 5) exposure pixels
+        inputBBox = footprint.getInputBBox(makeWcs((10.0, 20.0), crpix=(110.5, 45)), bbox,
+                                           self.coaddWcs, self.coaddBBox, padding=3)
+        self.assertEqual(inputBBox, afwGeom.Box2I(afwGeom.Point2I(56, 0), afwGeom.Point2I(99, 79)))
+
+        inputBBox = footprint.getInputBBox(makeWcs((30.0, 20.0)), bbox, self.coaddWcs, self.coaddBBox)
+        self.assertTrue(inputBBox.isEmpty())
+
+    def writeExposures(self, directory):
+        """Write exposures that overlap, touch, nearly touch and miss the coadd
+
+        Returns the paths of those exposures and of a missing exposure.
+        """
+        pathList = []
+        for name, crval, crpix in (("same", (10.0, 20.0), (50, 40)),
+                                   ("edge", (10.0, 20.0), (150, 40)),
+                                   ("near", (10.0, 20.0), (160, 40)),
+                                   ("far", (30.0, 20.0), (50, 40))):
+            path = os.path.join(directory, "%s.fits" % (name,))
+            exposure = afwImage.ExposureF(afwGeom.Extent2I(100, 80))
+            exposure.setWcs(makeWcs(crval, crpix=crpix))
+            exposure.writeFits(path)
+            pathList.append(path)
+        pathList.append(os.path.join(directory, "missing.fits"))
+        return pathList
+
+    def testFilterOverlapping(self):
+        """Test that only exposures that miss the coadd are skipped
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            pathList = self.writeExposures(directory)
+
+            overlapping, skipped = footprint.filterOverlapping(pathList, self.coaddWcs, self.coaddBBox)
+            self.assertEqual(overlapping, pathList[0:2] + pathList[4:5])
+            self.assertEqual(skipped, pathList[2:4])
+
+            # padding lets the near exposure through
+            overlapping, skipped = footprint.filterOverlapping(pathList, self.coaddWcs, self.coaddBBox,
+                                                               padding=20)
+            self.assertEqual(skipped, pathList[3:4])
+
+            # the subframe of the edge exposure that is read is far from the coadd
+            subframeBBox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(20, 80))
+            overlapping, skipped = footprint.filterOverlapping(pathList[0:2], self.coaddWcs, self.coaddBBox,
+                                                               subframeBBox=subframeBBox)
+            self.assertEqual(skipped, pathList[1:2])
+
+    def testExposureIndex(self):
+        """Test that an index query matches filterOverlapping and that the
+        index is updated incrementally
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            pathList = self.writeExposures(directory)
+            # an exposure with no WCS is always returned
+            noWcsPath = os.path.join(directory, "noWcs.fits")
+            afwImage.ExposureF(afwGeom.Extent2I(10, 10)).writeFits(noWcsPath)
+            pathList.append(noWcsPath)
+            indexPath = os.path.join(directory, "index.sqlite3")
+
+            with ExposureIndex(indexPath) as exposureIndex:
+                self.assertEqual(exposureIndex.update(pathList), 5)
+                self.assertEqual(len(exposureIndex), 5)
+                for padding in (0, 20):
+                    overlapping, skipped = footprint.filterOverlapping(pathList, self.coaddWcs,
+                                                                       self.coaddBBox, padding=padding)
+                    overlapping.remove(pathList[4])
+                    self.assertEqual(exposureIndex.query(self.coaddWcs, self.coaddBBox, padding=padding),
+                                     overlapping)
+
+            with ExposureIndex(indexPath) as exposureIndex:
+                self.assertEqual(exposureIndex.update(pathList), 0)
+                stat = os.stat(pathList[2])
+                os.utime(pathList[2], (stat.st_atime, stat.st_mtime + 10))
+                os.remove(pathList[1])
+                self.assertEqual(exposureIndex.update(pathList), 1)
+                self.assertEqual(len(exposureIndex), 4)
+                self.assertEqual(exposureIndex.query(self.coaddWcs, self.coaddBBox, padding=20),
+                                 [pathList[0], pathList[2], noWcsPath])
+
+            with self.assertRaises(ValueError):
+                ExposureIndex(indexPath, subframeBBox=afwGeom.Box2I(afwGeom.Point2I(0, 0),
+                                                                    afwGeom.Extent2I(20, 80)))
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,174 @@
+#
+# LSST Data Management System
+# Copyright 2008-2018 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+
+"""Test the streaming chi-squared histogram
+"""
+import os
+import tempfile
+import unittest
+
+import numpy as np
+from astropy.io import fits
+
+import lsst.utils.tests
+from lsst.coadd.chisquared.histogram import ChiSquaredHistogram, OrderHistograms, fitDegreesOfFreedom
+
+
+def makeChiSquaredCoadd(shape, order):
+    """Make a normalized chi-squared coadd of noise and its weight map,
+    with some pixels of lower order, not finite or large
+    """
+    weightMap = np.full(shape, order, dtype=np.float32)
+    weightMap[:, :5] = order - 1
+    coadd = (np.random.chisquare(order, size=shape) / order).astype(np.float32)
+    coadd[3, 10:13] = np.nan
+    coadd[7, 20:24] = 1000.0
+    return coadd, weightMap
+
+
+class ChiSquaredHistogramTestCase(unittest.TestCase):
+
+    def testFromFits(self):
+        """Test that a histogram computed in chunks from files matches one
+        computed directly
+        """
+        np.random.seed(0)
+        order = 4
+        coadd, weightMap = makeChiSquaredCoadd((53, 40), order)
+        with tempfile.TemporaryDirectory() as directory:
+            coaddPath = os.path.join(directory, "coadd.fits")
+            weightMapPath = os.path.join(directory, "coadd_weight.fits")
+            # a coadd written as an exposure has an empty primary HDU
+            fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(coadd)]).writeto(coaddPath)
+            fits.PrimaryHDU(weightMap).writeto(weightMapPath)
+            histogram = ChiSquaredHistogram.fromFits(coaddPath, weightMapPath, numBins=100, maxValue=50.0,
+                                                     chunkRows=7)
+
+        self.assertEqual(histogram.getOrder(), order)
+        self.assertEqual(histogram.getNumPixels(), coadd.size)
+        self.assertEqual(histogram.getNumWrongOrder(), 53 * 5)
+        self.assertEqual(histogram.getNumNonFinite(), 3)
+        self.assertEqual(histogram.getNumLarge(), 4)
+        values = coadd[weightMap == order].astype(np.float64) * order
+        values = values[np.isfinite(values) & (values < 50.0)]
+        expectedCounts, binEdges = np.histogram(values, bins=100, range=(0.0, 50.0))
+        np.testing.assert_array_equal(histogram.getCounts(), expectedCounts)
+        np.testing.assert_allclose(histogram.getBinEdges(), binEdges)
+        self.assertEqual(histogram.getNumGood(), values.size)
+
+        expected = histogram.getExpected()
+        self.assertEqual(expected.shape, (100,))
+        self.assertAlmostEqual(expected.sum() / histogram.getNumGood(), 1.0, delta=0.1)
+        self.assertGreater(histogram.getExpected(orderOffset=1.0).argmax(), expected.argmax())
+        self.assertIn("ChiSquared order = 4", histogram.formatSummary())
+
+    def testOrderChange(self):
+        """Test that pixels counted before the maximum weight is seen are
+        recounted as having the wrong order
+        """
+        np.random.seed(1)
+        coadd, weightMap = makeChiSquaredCoadd((20, 30), 3)
+        weightMap[10:] = 5
+        histogram = ChiSquaredHistogram(numBins=10)
+        histogram.update(coadd[:10], weightMap[:10])
+        self.assertEqual(histogram.getOrder(), 3)
+        self.assertEqual(histogram.getNumWrongOrder(), 10 * 5)
+        histogram.update(coadd[10:], weightMap[10:])
+        self.assertEqual(histogram.getOrder(), 5)
+        self.assertEqual(histogram.getNumWrongOrder(), 10 * 30)
+        self.assertEqual(histogram.getNumGood() + histogram.getNumNonFinite() + histogram.getNumLarge(),
+                         10 * 30)
+
+        fixedHistogram = ChiSquaredHistogram(numBins=10, order=3)
+        fixedHistogram.update(coadd, weightMap)
+        self.assertEqual(fixedHistogram.getOrder(), 3)
+        self.assertEqual(fixedHistogram.getNumWrongOrder(), 10 * 30 + 10 * 5)
+
+        with self.assertRaises(RuntimeError):
+            ChiSquaredHistogram().getExpected()
+        with self.assertRaises(ValueError):
+            ChiSquaredHistogram(numBins=0)
+        with self.assertRaises(ValueError):
+            ChiSquaredHistogram(maxValue=0)
+
+    def testOrderHistograms(self):
+        """Test per-order histograms and fitted degrees of freedom of a coadd
+        with variable depth
+        """
+        np.random.seed(2)
+        shape = (200, 150)
+        weightMap = np.random.randint(0, 5, size=shape).astype(np.float32)
+        weightMap[0, :10] = 2.5
+        order = np.maximum(weightMap, 1)
+        coadd = (np.random.chisquare(order) / order).astype(np.float32)
+        coadd[5, :8] = np.inf
+        coadd[weightMap == 0] = np.nan
+
+        histograms = OrderHistograms(numBins=200, maxValue=40.0)
+        for beginY in range(0, shape[0], 30):
+            histograms.update(coadd[beginY:beginY + 30], weightMap[beginY:beginY + 30])
+        self.assertEqual(histograms.getOrders(), [1, 2, 3, 4])
+        self.assertEqual(histograms.getNumPixels(), coadd.size)
+        self.assertEqual(histograms.getNumOtherWeight(), np.count_nonzero(weightMap == 0) + 10)
+        self.assertEqual(sum(histograms.getNumNonFinite(order) for order in range(1, 5)),
+                         np.count_nonzero(weightMap[5, :8] > 0))
+        for order in range(1, 5):
+            values = coadd[weightMap == order].astype(np.float64) * order
+            values = values[np.isfinite(values)]
+            self.assertEqual(histograms.getNumLarge(order), np.count_nonzero(values >= 40.0))
+            expectedCounts = np.histogram(values[values < 40.0], bins=200, range=(0.0, 40.0))[0]
+            np.testing.assert_array_equal(histograms.getCounts(order), expectedCounts)
+        np.testing.assert_array_equal(histograms.getCounts(7), np.zeros(200))
+
+        dofDict = histograms.fitDegreesOfFreedom()
+        self.assertEqual(sorted(dofDict), [1, 2, 3, 4])
+        for order, dof in dofDict.items():
+            self.assertAlmostEqual(dof, order, delta=0.1 * order)
+        self.assertTrue(np.isnan(histograms.fitDegreesOfFreedom(minCount=coadd.size)[1]))
+        self.assertEqual(len(histograms.formatSummary().split("\n")), 6)
+
+    def testFitDegreesOfFreedom(self):
+        """Test fitting chi-squared distributions to histograms
+        """
+        np.random.seed(3)
+        binEdges = np.linspace(0.0, 30.0, 301)
+        dofList = [0.7, 1.0, 2.5, 6.0]
+        counts = np.array([np.histogram(np.random.chisquare(dof, size=200000), bins=binEdges)[0]
+                           for dof in dofList] + [np.zeros(300)])
+        fitDof = fitDegreesOfFreedom(counts, binEdges)
+        np.testing.assert_allclose(fitDof[:-1], dofList, rtol=0.01)
+        self.assertTrue(np.isnan(fitDof[-1]))
+        self.assertAlmostEqual(fitDegreesOfFreedom(counts[2], binEdges), fitDof[2])
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,166 @@
+#
+# LSST Data Management System
+# Copyright 2008-2018 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+
+"""Test coadding several patches in one pass over the exposures
+"""
+import os
+import tempfile
+import unittest
+import unittest.mock
+
+import numpy as np
+
+import lsst.utils.tests
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.afw.image.testUtils as afwTestUtils
+import lsst.coadd.chisquared as coaddChiSq
+from lsst.coadd.chisquared.multiPatchCoadd import (AccumulatorPool, MultiPatchCoaddConfig, makePatchGrid,
+                                                   multiPatchCoadd)
+
+
+def makeExposure(crpix, crval=(10.0, 20.0)):
+    """Make a Gaussian noise exposure with a simple TAN WCS
+    """
+    maskedImage = afwTestUtils.makeGaussianNoiseMaskedImage(dimensions=(100, 80), sigma=1.0, variance=1.0)
+    wcs = afwGeom.makeSkyWcs(crpix=afwGeom.Point2D(*crpix),
+                             crval=afwGeom.SpherePoint(crval[0], crval[1], afwGeom.degrees),
+                             cdMatrix=afwGeom.makeCdMatrix(scale=0.2*afwGeom.arcseconds))
+    return afwImage.makeExposure(maskedImage, wcs)
+
+
+class MultiPatchCoaddTestCase(unittest.TestCase):
+
+    def testMakePatchGrid(self):
+        """Test that a patch grid tiles the region
+        """
+        bbox = afwGeom.Box2I(afwGeom.Point2I(-3, 5), afwGeom.Extent2I(101, 80))
+        patches = makePatchGrid(None, bbox, 3, 2)
+        self.assertEqual([patch.name for patch in patches], ["0,0", "1,0", "2,0", "0,1", "1,1", "2,1"])
+        self.assertEqual(sum(patch.bbox.getArea() for patch in patches), bbox.getArea())
+        for patch in patches:
+            self.assertTrue(bbox.contains(patch.bbox))
+            self.assertIn(patch.bbox.getWidth(), (33, 34))
+            self.assertEqual(patch.bbox.getHeight(), 40)
+
+    def testMultiPatchCoadd(self):
+        """Test that coadding patches in one pass, with accumulators spilled
+        to disk, matches coadding each patch separately
+        """
+        np.random.seed(0)
+        with tempfile.TemporaryDirectory() as directory:
+            exposureList = [makeExposure(crpix) for crpix in ((50, 40), (45, 42), (58.5, 33.2), (110, 40))]
+            exposurePathList = []
+            for i, exposure in enumerate(exposureList):
+                exposurePath = os.path.join(directory, "exposure%d.fits" % (i,))
+                exposure.writeFits(exposurePath)
+                exposurePathList.append(exposurePath)
+            exposurePathList.insert(2, os.path.join(directory, "missing.fits"))
+            farPath = os.path.join(directory, "far.fits")
+            makeExposure((50, 40), crval=(30.0, 20.0)).writeFits(farPath)
+            exposurePathList.append(farPath)
+
+            wcs = exposureList[0].getWcs()
+            patches = makePatchGrid(wcs, exposureList[0].getBBox(), 2, 2)
+            config = MultiPatchCoaddConfig()
+            config.maxOpenAccumulators = 1
+            config.numReadThreads = 2
+            config.numPrefetch = 2
+            config.tileSize = 17
+            # interpolation over the warping grid depends on the tile origin
+            config.warp.interpLength = 0
+            outputDir = os.path.join(directory, "patches")
+            result = multiPatchCoadd(patches, exposurePathList, config, outputDir)
+
+            self.assertEqual(list(result.coaddPaths), [patch.name for patch in patches])
+            self.assertEqual(result.numExposuresRead, 4)
+            self.assertEqual(result.numExposuresFailed, 1)
+            self.assertEqual(result.numExposuresSkipped, 1)
+            # the last exposure only overlaps the left-hand patches
+            self.assertEqual(result.numPatchExposures, 3 * 4 + 2)
+            self.assertGreater(result.numSpills, 0)
+            self.assertEqual(result.numReloads, result.numSpills)
+
+            warpingControl = coaddChiSq.makeWarpingControl(config.warp)
+            for patch in patches:
+                expectedCoadd = coaddChiSq.Coadd.fromConfig(patch.bbox, wcs, config.coadd)
+                for exposure in exposureList:
+                    expectedCoadd.warpAndAddExposure(exposure, warpingControl)
+                coadd = afwImage.ExposureF(result.coaddPaths[patch.name])
+                weightMap = afwImage.ImageF(os.path.join(outputDir, "%s_weight.fits" % (patch.name,)))
+                self.assertEqual(coadd.getBBox(), patch.bbox)
+                np.testing.assert_array_equal(weightMap.getArray(), expectedCoadd.getWeightMap().getArray())
+                np.testing.assert_array_equal(coadd.getMaskedImage().getImage().getArray(),
+                                              expectedCoadd.getCoadd().getMaskedImage().getImage().getArray())
+
+    def testWarpFailure(self):
+        """Test that an exposure that fails partway through being added to a
+        patch aborts the run instead of leaving part of it in the patch
+        """
+        np.random.seed(2)
+        with tempfile.TemporaryDirectory() as directory:
+            exposure = makeExposure((50, 40))
+            exposurePath = os.path.join(directory, "exposure.fits")
+            exposure.writeFits(exposurePath)
+            patches = makePatchGrid(exposure.getWcs(), exposure.getBBox(), 2, 1)
+            with unittest.mock.patch.object(coaddChiSq.Coadd, "warpAndAddExposure",
+                                            side_effect=MemoryError("cannot allocate tile")):
+                with self.assertRaises(RuntimeError):
+                    multiPatchCoadd(patches, [exposurePath], MultiPatchCoaddConfig(),
+                                    os.path.join(directory, "patches"))
+
+    def testAccumulatorPool(self):
+        """Test that the pool keeps at most maxOpen accumulators in memory
+        and restores spilled ones
+        """
+        np.random.seed(1)
+        exposure = makeExposure((50, 40))
+        patches = makePatchGrid(exposure.getWcs(), exposure.getBBox(), 3, 1)
+        with tempfile.TemporaryDirectory() as spillDir:
+            pool = AccumulatorPool(patches, coaddChiSq.CoaddConfig(), spillDir, maxOpen=2)
+            for patch in patches:
+                pool.get(patch.name).addExposure(exposure, exposureId=patch.name)
+            self.assertEqual([pool.isOpen(patch.name) for patch in patches], [False, True, True])
+            self.assertEqual((pool.numSpills, pool.numReloads), (1, 0))
+            for name, coadd in pool.items():
+                self.assertEqual(coadd.getConsumedIds(), [name])
+                np.testing.assert_array_equal(coadd.getWeightMap().getArray(), 1)
+            self.assertEqual(pool.numReloads, 1)
+
+            with self.assertRaises(ValueError):
+                AccumulatorPool(patches, coaddChiSq.CoaddConfig(), spillDir, maxOpen=0)
+            with self.assertRaises(ValueError):
+                AccumulatorPool(patches + patches[:1], coaddChiSq.CoaddConfig(), spillDir)
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
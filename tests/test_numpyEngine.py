@@ -0,0 +1,116 @@
+#
+# LSST Data Management System
+# Copyright 2008-2018 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+"""Test the NumPy accumulation engine against the C++ addToCoadd
+"""
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.coadd.chisquared as coaddChiSq
+import lsst.coadd.chisquared.numpy_engine as numpyEngine
+
+
+class NumpyEngineTestCase(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        self.badPixelMask = afwImage.Mask.getPlaneBitMask("EDGE")
+        self.satMask = afwImage.Mask.getPlaneBitMask("SAT")
+        self.coaddBBox = afwGeom.Box2I(afwGeom.Point2I(-5, 3), afwGeom.Extent2I(140, 117))
+        self.inputBBox = afwGeom.Box2I(afwGeom.Point2I(-20, 40), afwGeom.Extent2I(150, 100))
+
+    def makeMaskedImage(self, MaskedImageT):
+        maskedImage = MaskedImageT(self.inputBBox)
+        shape = maskedImage.getImage().getArray().shape
+        maskedImage.getImage().getArray()[:] = np.random.normal(size=shape)
+        maskedImage.getImage().getArray()[0, 0:3] = np.nan
+        maskedImage.getVariance().getArray()[:] = np.random.uniform(0.5, 1.5, size=shape)
+        random = np.random.random_sample(shape)
+        maskedImage.getMask().getArray()[:] = np.where(random < 0.1, self.badPixelMask, 0) | \
+            np.where(random > 0.8, self.satMask, 0)
+        return maskedImage
+
+    def testAgainstCpp(self):
+        """Test that the NumPy engine matches the C++ kernel exactly
+        """
+        for CoaddT, InputT, ImageT, weight in (
+            (afwImage.MaskedImageF, afwImage.MaskedImageF, afwImage.ImageF, 0.7),
+            (afwImage.MaskedImageD, afwImage.MaskedImageD, afwImage.ImageD, 0.7),
+            (afwImage.MaskedImageD, afwImage.MaskedImageF, afwImage.ImageF, 0.7),
+            (afwImage.MaskedImageF, afwImage.MaskedImageF, afwImage.ImageU, 2),
+        ):
+            maskedImage = self.makeMaskedImage(InputT)
+            cppCoadd = CoaddT(self.coaddBBox)
+            cppWeightMap = ImageT(self.coaddBBox)
+            overlapBBox = coaddChiSq.addToCoadd(cppCoadd, cppWeightMap, maskedImage, self.badPixelMask,
+                                                weight)
+
+            coadd = CoaddT(self.coaddBBox)
+            weightMap = ImageT(self.coaddBBox)
+            coaddView = coadd.Factory(coadd, overlapBBox, afwImage.PARENT, False)
+            weightMapView = weightMap.Factory(weightMap, overlapBBox, afwImage.PARENT, False)
+            inputView = maskedImage.Factory(maskedImage, overlapBBox, afwImage.PARENT, False)
+            for chunkSize in (1, 1000, 1 << 20):
+                numGood = numpyEngine.addToCoadd(
+                    coadd=coaddView.getImage().getArray(),
+                    coaddMask=coaddView.getMask().getArray(),
+                    weightMap=weightMapView.getArray(),
+                    image=inputView.getImage().getArray(),
+                    mask=inputView.getMask().getArray(),
+                    variance=inputView.getVariance().getArray(),
+                    badPixelMask=self.badPixelMask,
+                    weight=weight,
+                    chunkSize=chunkSize,
+                )
+                self.assertEqual(numGood, np.count_nonzero(
+                    (inputView.getMask().getArray() & self.badPixelMask) == 0))
+            for i in range(2):
+                coaddChiSq.addToCoadd(cppCoadd, cppWeightMap, maskedImage, self.badPixelMask, weight)
+
+            np.testing.assert_array_equal(coadd.getImage().getArray(), cppCoadd.getImage().getArray())
+            np.testing.assert_array_equal(coadd.getMask().getArray(), cppCoadd.getMask().getArray())
+            np.testing.assert_array_equal(weightMap.getArray(), cppWeightMap.getArray())
+
+    def testBadShapes(self):
+        arr = np.zeros((3, 4), dtype=np.float32)
+        mask = np.zeros((3, 4), dtype=np.int32)
+        with self.assertRaises(ValueError):
+            numpyEngine.addToCoadd(arr, mask, arr, arr[:2], mask, arr, 1, 1.0)
+        with self.assertRaises(ValueError):
+            numpyEngine.addToCoadd(arr, mask, arr, arr, mask, arr, 1, 1.0, chunkSize=0)
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
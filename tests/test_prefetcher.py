@@ -0,0 +1,83 @@
+#
+# LSST Data Management System
+# Copyright 2008-2018 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+"""Test reading files ahead of their use
+"""
+import os
+import tempfile
+import unittest
+
+import lsst.utils.tests
+from lsst.coadd.chisquared.prefetcher import Prefetcher
+
+
+class PrefetcherTestCase(unittest.TestCase):
+
+    def testPrefetcher(self):
+        """Test that files are yielded in order, once read, and that
+        missing files are yielded too
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            pathList = []
+            for i, size in enumerate((0, 10, 5000)):
+                path = os.path.join(directory, "file%d" % (i,))
+                with open(path, "wb") as outfile:
+                    outfile.write(b"x" * size)
+                pathList.append(path)
+            pathList.insert(1, os.path.join(directory, "missing"))
+
+            prefetcher = Prefetcher(pathList, numAhead=2, bufferSize=1024)
+            try:
+                self.assertEqual(list(prefetcher), pathList)
+            finally:
+                prefetcher.close()
+            self.assertEqual(prefetcher.readBytes, 5010)
+            self.assertGreaterEqual(prefetcher.readTime, 0.0)
+            self.assertGreaterEqual(prefetcher.waitTime, 0.0)
+            self.assertEqual(sorted(prefetcher.readTimes), sorted(pathList))
+            self.assertAlmostEqual(sum(prefetcher.readTimes.values()), prefetcher.readTime)
+            # the I/O wait hidden from the iteration is the reading that it did not wait for
+            self.assertGreaterEqual(prefetcher.hiddenTime, 0.0)
+            self.assertLessEqual(prefetcher.hiddenTime, prefetcher.readTime)
+
+            # closing before all files are yielded stops the thread
+            prefetcher = Prefetcher(pathList * 10, numAhead=1)
+            self.assertEqual(next(iter(prefetcher)), pathList[0])
+            prefetcher.close()
+            self.assertLess(prefetcher.readBytes, 10 * 5010)
+
+            for numAhead in (0, -1):
+                with self.assertRaises(ValueError):
+                    Prefetcher(pathList, numAhead=numAhead)
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,178 @@
+#
+# LSST Data Management System
+# Copyright 2008-2016 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+
+"""Test a chi-squared coadd accumulated in shared memory by several
+processes
+"""
+import concurrent.futures
+import os
+import tempfile
+import unittest
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import lsst.utils.tests
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.afw.image.testUtils as afwTestUtils
+import lsst.coadd.chisquared as coaddChiSq
+from lsst.coadd.chisquared.sharedMemoryCoadd import SharedMemoryCoadd, SharedMemoryCoaddWriter
+
+# writer of a worker process, set by initWriter
+_writer = None
+
+
+def initWriter(handle):
+    """Attach a writer to the shared coadd in a worker process
+    """
+    global _writer
+    _writer = SharedMemoryCoaddWriter(handle)
+
+
+def addExposureFile(exposurePath):
+    """Add an exposure read from a file in a worker process and return the
+    statistics
+    """
+    return _writer.addExposure(afwImage.ExposureF(exposurePath))[1]
+
+
+def makeExposure(xy0, wcs):
+    """Make a Gaussian noise exposure with some bad pixels
+    """
+    maskedImage = afwTestUtils.makeGaussianNoiseMaskedImage(dimensions=(90, 60), sigma=1.0, variance=1.0)
+    maskedImage.setXY0(afwGeom.Point2I(*xy0))
+    maskArr = maskedImage.getMask().getArray()
+    maskArr[np.random.random_sample(maskArr.shape) < 0.1] = afwImage.Mask.getPlaneBitMask("EDGE")
+    return afwImage.makeExposure(maskedImage, wcs)
+
+
+class SharedMemoryCoaddTestCase(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        self.bbox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(120, 80))
+        self.wcs = afwGeom.makeSkyWcs(crpix=afwGeom.Point2D(60, 40),
+                                      crval=afwGeom.SpherePoint(10.0, 20.0, afwGeom.degrees),
+                                      cdMatrix=afwGeom.makeCdMatrix(scale=0.2*afwGeom.arcseconds))
+        self.exposureList = [makeExposure(xy0, self.wcs)
+                             for xy0 in ((0, 0), (-10, 5), (40, 30), (25, -20), (100, 70))]
+
+    def makeSerialCoadd(self):
+        coadd = coaddChiSq.Coadd(bbox=self.bbox, wcs=self.wcs, badMaskPlanes=["EDGE"],
+                                 doubleAccumulator=True)
+        for i, exposure in enumerate(self.exposureList):
+            coadd.addExposure(exposure, exposureId=i)
+        return coadd
+
+    def testAddInProcess(self):
+        """Test that adding exposures one stripe at a time matches Coadd
+        """
+        serialCoadd = self.makeSerialCoadd()
+        for stripeRows in (1, 7, 200):
+            with SharedMemoryCoadd(bbox=self.bbox, wcs=self.wcs, badMaskPlanes=["EDGE"],
+                                   stripeRows=stripeRows, doubleAccumulator=True) as coadd:
+                self.assertEqual(coadd.getStripeRows(), stripeRows)
+                for i, exposure in enumerate(self.exposureList):
+                    coadd.addExposure(exposure, exposureId=i)
+                self.assertEqual(coadd.getConsumedIds(), serialCoadd.getConsumedIds())
+                self.assertMaskedImagesEqual(coadd.getCoadd().getMaskedImage(),
+                                             serialCoadd.getCoadd().getMaskedImage())
+                np.testing.assert_array_equal(coadd.getWeightMap().getArray(),
+                                              serialCoadd.getWeightMap().getArray())
+
+                # merging and checkpoints use the shared accumulator
+                mergedCoadd = coaddChiSq.Coadd(bbox=self.bbox, wcs=self.wcs, badMaskPlanes=["EDGE"],
+                                               doubleAccumulator=True)
+                mergedCoadd.merge(coadd)
+                self.assertMaskedImagesEqual(mergedCoadd.getCoadd().getMaskedImage(),
+                                             serialCoadd.getCoadd().getMaskedImage())
+                with tempfile.TemporaryDirectory() as checkpointDir:
+                    coadd.enableCheckpoints(checkpointDir, everyN=1)
+                    coadd.writeCheckpoint(wait=True)
+                    restoredCoadd = SharedMemoryCoadd.fromCheckpoint(checkpointDir, stripeRows=stripeRows)
+                    with restoredCoadd:
+                        self.assertMaskedImagesEqual(restoredCoadd.getCoadd().getMaskedImage(),
+                                                     coadd.getCoadd().getMaskedImage())
+
+    def testAddInWorkers(self):
+        """Test that exposures added by several worker processes at once
+        sum to the same coadd as Coadd
+        """
+        serialCoadd = self.makeSerialCoadd()
+        with tempfile.TemporaryDirectory() as directory:
+            exposurePathList = []
+            for i, exposure in enumerate(self.exposureList):
+                exposurePathList.append(os.path.join(directory, "exposure%d.fits" % (i,)))
+                exposure.writeFits(exposurePathList[-1])
+
+            with SharedMemoryCoadd(bbox=self.bbox, wcs=self.wcs, badMaskPlanes=["EDGE"], stripeRows=8,
+                                   doubleAccumulator=True) as coadd:
+                with concurrent.futures.ProcessPoolExecutor(max_workers=3, initializer=initWriter,
+                                                            initargs=(coadd.getHandle(),)) as executor:
+                    futures = [executor.submit(addExposureFile, exposurePath)
+                               for exposurePath in exposurePathList]
+                    for i, future in enumerate(futures):
+                        coadd.recordExposure(future.result(), exposureId=i)
+                shmNames = coadd.getHandle().shmNames
+
+                self.assertEqual(coadd.getConsumedIds(), serialCoadd.getConsumedIds())
+                self.assertEqual(coadd.getTotalStatistics().numAccepted,
+                                 serialCoadd.getTotalStatistics().numAccepted)
+                np.testing.assert_array_equal(coadd.getWeightMap().getArray(),
+                                              serialCoadd.getWeightMap().getArray())
+                # the order of summation depends on the workers, so the sums may differ by rounding
+                maskedImage = coadd.getCoadd().getMaskedImage()
+                serialMaskedImage = serialCoadd.getCoadd().getMaskedImage()
+                np.testing.assert_allclose(maskedImage.getImage().getArray(),
+                                           serialMaskedImage.getImage().getArray(), rtol=1e-6)
+                np.testing.assert_array_equal(maskedImage.getMask().getArray(),
+                                              serialMaskedImage.getMask().getArray())
+
+            # closing the coadd frees the shared memory
+            for name in shmNames:
+                with self.assertRaises(FileNotFoundError):
+                    shared_memory.SharedMemory(name=name)
+
+    def testBadArgs(self):
+        with self.assertRaises(ValueError):
+            SharedMemoryCoadd(bbox=self.bbox, wcs=self.wcs, badMaskPlanes=["EDGE"], stripeRows=0)
+
+    def assertMaskedImagesEqual(self, maskedImage1, maskedImage2):
+        """Assert that the image and mask planes of two masked images are identical
+        """
+        np.testing.assert_array_equal(maskedImage1.getImage().getArray(), maskedImage2.getImage().getArray())
+        np.testing.assert_array_equal(maskedImage1.getMask().getArray(), maskedImage2.getMask().getArray())
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,101 @@
+#
+# LSST Data Management System
+# Copyright 2008-2018 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+"""Test tracing of spans
+"""
+import json
+import os
+import tempfile
+import threading
+import unittest
+
+import lsst.utils.tests
+from lsst.coadd.chisquared.tracing import NullTracer, Span, Tracer
+
+
+class TracingTestCase(unittest.TestCase):
+
+    def testTracer(self):
+        """Test recording, summarizing and exporting spans
+        """
+        tracer = Tracer()
+        with tracer.span("read", exposure="a.fits"):
+            pass
+
+        def warp():
+            with tracer.span("warp"):
+                pass
+
+        threads = [threading.Thread(target=warp) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        tracer.addSpans([Span(name="warp", startTime=0.0, duration=2.0, pid=1, tid=2, args=None)])
+
+        spans = tracer.getSpans()
+        self.assertEqual(len(spans), 5)
+        # spans are sorted by start time
+        self.assertEqual(spans[0].duration, 2.0)
+        self.assertEqual(spans[1].args, dict(exposure="a.fits"))
+
+        summary = tracer.getSummary()
+        self.assertEqual(list(summary), ["warp", "read"])
+        self.assertEqual(summary["warp"]["count"], 4)
+        self.assertEqual(summary["warp"]["max"], 2.0)
+        self.assertIn("warp", tracer.formatSummary())
+
+        with tempfile.TemporaryDirectory() as directory:
+            tracePath = os.path.join(directory, "trace.json")
+            tracer.writeChromeTrace(tracePath)
+            with open(tracePath, "r") as infile:
+                trace = json.load(infile)
+        events = trace["traceEvents"]
+        self.assertEqual(len(events), 5)
+        self.assertEqual(events[0], dict(name="warp", cat="coadd", ph="X", ts=0.0, dur=2e6, pid=1, tid=2))
+        self.assertEqual(events[1]["args"], dict(exposure="a.fits"))
+
+        tracer.clear()
+        self.assertEqual(tracer.getSpans(), [])
+
+    def testNullTracer(self):
+        """Test that a NullTracer records nothing
+        """
+        tracer = NullTracer()
+        with tracer.span("read", exposure="a.fits"):
+            pass
+        tracer.addSpans([Span(name="warp", startTime=0.0, duration=2.0, pid=1, tid=2, args=None)])
+        self.assertEqual(tracer.getSpans(), [])
+        self.assertFalse(tracer.enabled)
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,182 @@
+#
+# LSST Data Management System
+# Copyright 2008-2018 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+"""Test the process-pool warp-and-coadd driver
+"""
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.afw.image.testUtils as afwTestUtils
+from lsst.coadd.chisquared.exposureIndex import ExposureIndex
+from lsst.coadd.chisquared.warpAndCoadd import WarpAndCoaddConfig, warpAndCoadd
+
+
+def makeExposure(crpix, crval=(10.0, 20.0)):
+    """Make a Gaussian noise exposure with a simple TAN WCS
+    """
+    maskedImage = afwTestUtils.makeGaussianNoiseMaskedImage(dimensions=(100, 80), sigma=1.0, variance=1.0)
+    wcs = afwGeom.makeSkyWcs(crpix=afwGeom.Point2D(*crpix),
+                             crval=afwGeom.SpherePoint(crval[0], crval[1], afwGeom.degrees),
+                             cdMatrix=afwGeom.makeCdMatrix(scale=0.2*afwGeom.arcseconds))
+    return afwImage.makeExposure(maskedImage, wcs)
+
+
+def listSharedMemory():
+    """Return the names of the shared memory blocks that exist, if known
+    """
+    if not os.path.isdir("/dev/shm"):
+        return set()
+    return set(name for name in os.listdir("/dev/shm") if name.startswith("psm_"))
+
+
+class WarpAndCoaddTestCase(unittest.TestCase):
+
+    def testWarpAndCoadd(self):
+        """Test that exposures are warped and added, and failures counted
+        """
+        np.random.seed(0)
+        with tempfile.TemporaryDirectory() as directory:
+            exposurePathList = []
+            for i, crpix in enumerate(((50, 40), (45, 42), (58.5, 33.2))):
+                exposurePath = os.path.join(directory, "exposure%d.fits" % (i,))
+                makeExposure(crpix).writeFits(exposurePath)
+                exposurePathList.append(exposurePath)
+            exposurePathList.insert(2, os.path.join(directory, "missing.fits"))
+            # only about half of this exposure can be warped into the coadd
+            partialPath = os.path.join(directory, "partial.fits")
+            makeExposure((110, 40)).writeFits(partialPath)
+            exposurePathList.append(partialPath)
+            farPath = os.path.join(directory, "far.fits")
+            makeExposure((50, 40), crval=(30.0, 20.0)).writeFits(farPath)
+            exposurePathList.append(farPath)
+            coaddPath = os.path.join(directory, "coadd.fits")
+
+            sharedMemoryBefore = listSharedMemory()
+            config = WarpAndCoaddConfig()
+            config.numWorkers = 2
+            config.maxInFlight = 1
+            config.numPrefetch = 2
+            config.tracePath = os.path.join(directory, "trace.json")
+            result = warpAndCoadd(coaddPath, exposurePathList, config)
+            self.assertEqual(result.numExposuresInCoadd, 4)
+            self.assertEqual(result.numExposuresWarped, 3)
+            self.assertEqual(result.numExposuresFailed, 1)
+            self.assertEqual(result.numExposuresSkipped, 1)
+            # every input but the reference and the skipped one is prefetched
+            self.assertEqual(result.prefetchBytes,
+                             sum(os.path.getsize(path) for path in exposurePathList[1:-1]
+                                 if os.path.exists(path)))
+            self.assertGreaterEqual(result.prefetchHiddenTime, 0.0)
+            self.assertLessEqual(result.prefetchHiddenTime, result.prefetchTime)
+            for path, (prefetchTime, workerTime) in result.exposureReadTimes.items():
+                self.assertIsNotNone(prefetchTime)
+                self.assertGreaterEqual(workerTime, 0.0)
+            # the partial exposure is read only where it overlaps the coadd
+            self.assertGreater(result.numPixelsRead, 2 * 100 * 80)
+            self.assertLess(result.numPixelsRead, 2.6 * 100 * 80)
+            self.assertEqual(result.coadd.getConsumedIds(),
+                             exposurePathList[0:2] + exposurePathList[3:5])
+            self.assertEqual(result.coadd.getBBox(), afwImage.ExposureF(exposurePathList[0]).getBBox())
+            self.assertEqual(list(result.exposureStatistics), result.coadd.getConsumedIds())
+            self.assertEqual(result.exposureStatistics[exposurePathList[0]].numAccepted, 100 * 80)
+
+            # spans are recorded by the workers as well as the main process
+            spanNames = set(span.name for span in result.tracer.getSpans())
+            self.assertTrue(spanNames >= {"read", "warp", "addExposure", "write"})
+            self.assertTrue(os.path.exists(config.tracePath))
+
+            weightMap = afwImage.ImageF(os.path.join(directory, "coadd_weight.fits"))
+            self.assertEqual(weightMap.getArray().max(), 4)
+            self.assertEqual(result.numWarpCacheHits, 0)
+
+            # a second run with a warp cache reads the warped exposures from it
+            config.tracePath = None
+            config.warpCacheDir = os.path.join(directory, "warpCache")
+            for expectedHits in (0, 3):
+                cachedResult = warpAndCoadd(coaddPath, exposurePathList, config)
+                self.assertEqual(cachedResult.numWarpCacheHits, expectedHits)
+                np.testing.assert_array_equal(cachedResult.coadd.getWeightMap().getArray(),
+                                              result.coadd.getWeightMap().getArray())
+                np.testing.assert_array_equal(
+                    cachedResult.coadd.getCoadd().getMaskedImage().getImage().getArray(),
+                    result.coadd.getCoadd().getMaskedImage().getImage().getArray())
+
+            # workers can add the exposures to an accumulator in shared memory instead
+            config.warpCacheDir = None
+            config.doSharedAccumulator = True
+            config.stripeRows = 16
+            sharedResult = warpAndCoadd(coaddPath, exposurePathList, config)
+            self.assertEqual(sharedResult.numExposuresWarped, 3)
+            self.assertEqual(sharedResult.coadd.getConsumedIds(), result.coadd.getConsumedIds())
+            self.assertEqual(list(sharedResult.exposureStatistics), list(result.exposureStatistics))
+            np.testing.assert_array_equal(sharedResult.coadd.getWeightMap().getArray(),
+                                          result.coadd.getWeightMap().getArray())
+            np.testing.assert_allclose(sharedResult.coadd.getCoadd().getMaskedImage().getImage().getArray(),
+                                       result.coadd.getCoadd().getMaskedImage().getImage().getArray(),
+                                       rtol=1e-5, atol=1e-5)
+            config.checkpointDir = os.path.join(directory, "checkpoint")
+            with self.assertRaises(ValueError):
+                warpAndCoadd(coaddPath, exposurePathList, config)
+            # all shared memory blocks have been freed
+            self.assertEqual(listSharedMemory(), sharedMemoryBefore)
+
+    def testExposureIndex(self):
+        """Test that only listed exposures the index excludes count as skipped
+        """
+        np.random.seed(1)
+        with tempfile.TemporaryDirectory() as directory:
+            exposurePathList = []
+            for i, (crpix, crval) in enumerate((((50, 40), (10.0, 20.0)), ((45, 42), (10.0, 20.0)),
+                                                ((50, 40), (30.0, 20.0)), ((50, 40), (50.0, 20.0)))):
+                exposurePath = os.path.join(directory, "exposure%d.fits" % (i,))
+                makeExposure(crpix, crval=crval).writeFits(exposurePath)
+                exposurePathList.append(exposurePath)
+            coaddPath = os.path.join(directory, "coadd.fits")
+
+            config = WarpAndCoaddConfig()
+            config.numWorkers = 1
+            with ExposureIndex(os.path.join(directory, "index.sqlite3")) as exposureIndex:
+                self.assertEqual(exposureIndex.update(exposurePathList), 4)
+                # the last exposure is in the index but not in the list, so it is not counted
+                result = warpAndCoadd(coaddPath, exposurePathList[:3], config, exposureIndex=exposureIndex)
+            self.assertEqual(result.numExposuresWarped, 1)
+            self.assertEqual(result.numExposuresSkipped, 1)
+            self.assertEqual(result.coadd.getConsumedIds(), exposurePathList[:2])
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,146 @@
+#
+# LSST Data Management System
+# Copyright 2008-2018 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+
+"""Test the cache of warped exposures
+"""
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.afw.image.testUtils as afwTestUtils
+import lsst.afw.math as afwMath
+import lsst.coadd.chisquared as coaddChiSq
+from lsst.coadd.chisquared.warpCache import CachingWarper, WarpCache
+
+
+def makeExposure(crpix, crval=(10.0, 20.0)):
+    """Make a Gaussian noise exposure with a simple TAN WCS
+    """
+    maskedImage = afwTestUtils.makeGaussianNoiseMaskedImage(dimensions=(60, 50), sigma=1.0, variance=1.0)
+    wcs = afwGeom.makeSkyWcs(crpix=afwGeom.Point2D(*crpix),
+                             crval=afwGeom.SpherePoint(crval[0], crval[1], afwGeom.degrees),
+                             cdMatrix=afwGeom.makeCdMatrix(scale=0.2*afwGeom.arcseconds))
+    exposure = afwImage.makeExposure(maskedImage, wcs)
+    exposure.setFilter(afwImage.Filter("g", True))
+    return exposure
+
+
+class WarpCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        self.coaddExposure = makeExposure((30, 25))
+        self.exposureList = [makeExposure(crpix) for crpix in ((27.5, 22.1), (33.2, 28.7), (31.0, 21.4))]
+        self.warpConfig = afwMath.Warper.ConfigClass()
+
+    def testCachingWarper(self):
+        """Test that cached warps match fresh ones and can be added to a coadd
+        """
+        destWcs = self.coaddExposure.getWcs()
+        maxBBox = self.coaddExposure.getBBox()
+        warper = afwMath.Warper.fromConfig(self.warpConfig)
+        with tempfile.TemporaryDirectory() as cacheDir:
+            cachingWarper = CachingWarper.fromConfig(self.warpConfig, cacheDir)
+            coadd = coaddChiSq.Coadd(bbox=maxBBox, wcs=destWcs, badMaskPlanes=["EDGE", "NO_DATA"])
+            expectedCoadd = coaddChiSq.Coadd(bbox=maxBBox, wcs=destWcs, badMaskPlanes=["EDGE", "NO_DATA"])
+            for exposure in self.exposureList:
+                expected = warper.warpExposure(destWcs=destWcs, srcExposure=exposure, maxBBox=maxBBox)
+                cachingWarper.warpExposure(destWcs=destWcs, srcExposure=exposure, maxBBox=maxBBox)
+                cached = cachingWarper.warpExposure(destWcs=destWcs, srcExposure=exposure, maxBBox=maxBBox)
+                self.assertEqual(cached.getBBox(), expected.getBBox())
+                self.assertEqual(cached.getFilter().getName(), "g")
+                cachedMaskedImage = cached.getMaskedImage()
+                expectedMaskedImage = expected.getMaskedImage()
+                for plane, expectedPlane in (
+                        (cachedMaskedImage.getImage(), expectedMaskedImage.getImage()),
+                        (cachedMaskedImage.getMask(), expectedMaskedImage.getMask()),
+                        (cachedMaskedImage.getVariance(), expectedMaskedImage.getVariance())):
+                    np.testing.assert_array_equal(plane.getArray(), expectedPlane.getArray())
+                coadd.addExposure(cached)
+                expectedCoadd.addExposure(expected)
+            self.assertEqual((cachingWarper.numHits, cachingWarper.numMisses), (3, 3))
+            np.testing.assert_array_equal(coadd.getCoadd().getMaskedImage().getImage().getArray(),
+                                          expectedCoadd.getCoadd().getMaskedImage().getImage().getArray())
+            np.testing.assert_array_equal(coadd.getWeightMap().getArray(),
+                                          expectedCoadd.getWeightMap().getArray())
+
+            # the key depends on the warping kernel and the destination bbox
+            bilinearConfig = afwMath.Warper.ConfigClass()
+            bilinearConfig.warpingKernelName = "bilinear"
+            bilinearWarper = CachingWarper(bilinearConfig, cachingWarper.getCache())
+            bilinearWarper.warpExposure(destWcs=destWcs, srcExposure=self.exposureList[0], maxBBox=maxBBox)
+            cachingWarper.warpExposure(destWcs=destWcs, srcExposure=self.exposureList[0],
+                                       maxBBox=afwGeom.Box2I(maxBBox.getMin(), afwGeom.Extent2I(20, 20)))
+            self.assertEqual((bilinearWarper.numHits, cachingWarper.numHits), (0, 3))
+            self.assertEqual(len(cachingWarper.getCache().getEntries()), 5)
+
+    def testEviction(self):
+        """Test that the least recently used entries are evicted
+        """
+        exposure = self.exposureList[0]
+        entrySize = 3 * exposure.getWidth() * exposure.getHeight() * 4
+        with tempfile.TemporaryDirectory() as cacheDir:
+            # room for two entries and their metadata, not three
+            cache = WarpCache(cacheDir, maxBytes=int(2.5 * entrySize))
+            self.assertTrue(cache.put("a", exposure))
+            self.assertTrue(cache.put("b", exposure))
+            self.assertFalse(cache.put("b", exposure))
+            self.assertIsNotNone(cache.get("a", exposure.getWcs()))
+            self.assertTrue(cache.put("c", exposure))
+            self.assertEqual([key for key, size in cache.getEntries()], ["a", "c"])
+            self.assertIsNone(cache.get("b", exposure.getWcs()))
+            self.assertLessEqual(cache.getNumBytes(), cache.getMaxBytes())
+            self.assertEqual(sorted(os.listdir(cacheDir)), ["a", "c"])
+
+            # cached planes are mapped copy-on-write, so changing them leaves the cache intact
+            cached = cache.get("c", exposure.getWcs())
+            self.assertEqual(cached.getBBox(), exposure.getBBox())
+            cached.getMaskedImage().getImage().getArray()[:] = 0
+            cached = cache.get("c", exposure.getWcs())
+            np.testing.assert_array_equal(cached.getMaskedImage().getImage().getArray(),
+                                          exposure.getMaskedImage().getImage().getArray())
+
+            self.assertFalse(WarpCache(cacheDir, maxBytes=entrySize // 2).put("d", exposure))
+            cache.clear()
+            self.assertEqual(cache.getEntries(), [])
+
+        with self.assertRaises(ValueError):
+            WarpCache(cacheDir, maxBytes=0)
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()